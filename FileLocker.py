@@ -1,15 +1,389 @@
-import wx
 import sys
 import os
 import argparse
+import signal
+import time
 from getpass import getpass
+from typing import TYPE_CHECKING, Optional
 
-from gui_main import MainWindow
+# wx, the GUI and the crypto engine are imported where they're used, so a CLI run
+# that hands its job to the daemon doesn't pay for loading them
 from core_settings import Settings
-from core_encryption import Encryption
-import nvda
+from core_control import OperationControl, OperationCancelled
 from translate import _
 
+if TYPE_CHECKING:
+    from core_encryption import Encryption
+
+KDF_CHOICES = ["pbkdf2-sha1", "pbkdf2-sha256", "scrypt"] # core_header.KDF_NAMES
+
+def add_job_arguments(parser):
+    """Options shared by every command that runs an encryption job."""
+    parser.add_argument("--limit-mb", type=float, default=None, help=_("Limit disk throughput to this many MB/s (0 = unlimited)."))
+    parser.add_argument("--low-priority", action="store_true", default=None, help=_("Run with background CPU and disk priority."))
+    parser.add_argument("--stats", action="store_true", help=_("Print a timing breakdown of the operation when it finishes."))
+    parser.add_argument("--cipher-backend", choices=["auto", "pycryptodome", "cryptography"], default=None,
+                        help=_("AES implementation to use (default: the cipher_backend setting, auto picks the fastest)."))
+    parser.add_argument("--io-mode", choices=["buffered", "stream", "direct"], default=None,
+                        help=_("How files are read and written: buffered, stream (drop them from the page cache as it goes) "
+                               "or direct (O_DIRECT writes). Default: the io_mode setting."))
+
+def create_control(args, settings) -> OperationControl:
+    """Build the job control from CLI flags, falling back to the saved settings."""
+    rate_limit = args.limit_mb if args.limit_mb is not None else settings.get('io_rate_limit_mb')
+    low_priority = args.low_priority if args.low_priority is not None else settings.get('low_priority_mode')
+    control = OperationControl(rate_limit_mb=rate_limit, low_priority=low_priority)
+
+    # Ctrl+C cancels the job so the half written output gets rolled back
+    def on_interrupt(signum, frame):
+        print(_("Cancelling, please wait..."), file=sys.stderr)
+        control.cancel()
+    signal.signal(signal.SIGINT, on_interrupt)
+    return control
+
+def run_stream(args, encryption: "Encryption", control: OperationControl, password: str):
+    """Pipeline mode: lock/unlock stdin to stdout, all messages go to stderr."""
+    if sys.stdout.isatty():
+        print(_("Error: Refusing to write binary data to a terminal, redirect stdout."), file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == "encrypt":
+        success, message = encryption.encrypt_stream(sys.stdin.buffer, sys.stdout.buffer, password, control=control)
+    else:
+        success, message = encryption.decrypt_stream(sys.stdin.buffer, sys.stdout.buffer, password, control=control)
+
+    if args.stats and encryption.last_metrics:
+        print(encryption.last_metrics.summary(), file=sys.stderr)
+    if not success:
+        print(_("Operation failed: {}").format(message), file=sys.stderr)
+        sys.exit(130 if control.is_cancelled() else 1)
+    sys.exit(0)
+
+def run_migrate(args, encryption: "Encryption", control: OperationControl, password: str):
+    """Bulk-convert legacy core.py files under a path into the current format."""
+    import core_legacy
+
+    def on_result(path, success, message):
+        if success:
+            print(_("Migrated: {}").format(path))
+        else:
+            print(_("Failed: {} ({})").format(path, message))
+
+    migrated, failures = core_legacy.migrate_tree(
+        encryption, args.path, password,
+        workers=args.workers, resume_log=args.resume_log,
+        control=control, on_result=on_result
+    )
+    print(_("{} file(s) migrated, {} failed.").format(migrated, len(failures)))
+    if control.is_cancelled():
+        sys.exit(130)
+    sys.exit(1 if failures else 0)
+
+def run_rekey(args, encryption: "Encryption", control: OperationControl, password: str):
+    """Change the password of one locked item, or of every locked item under a folder."""
+    import core_header
+
+    new_password = args.new_password
+    if not new_password:
+        new_password = getpass(_("Enter new password: "))
+        if not new_password:
+            print(_("Error: Password cannot be empty."))
+            sys.exit(1)
+        if getpass(_("Confirm new password: ")) != new_password:
+            print(_("Error: Passwords do not match."))
+            sys.exit(1)
+
+    if os.path.isfile(args.path):
+        success, message = encryption.rekey(args.path, password, new_password, control=control)
+        if args.stats and encryption.last_metrics:
+            print(encryption.last_metrics.summary())
+        if success:
+            print(_("Password changed: {}").format(args.path))
+            sys.exit(0)
+        print(_("Failed: {} ({})").format(args.path, message))
+        sys.exit(130 if control.is_cancelled() else 1)
+
+    def on_result(path, success, message):
+        if success:
+            print(_("Password changed: {}").format(path))
+        else:
+            print(_("Failed: {} ({})").format(path, message))
+
+    rekeyed, failures = core_header.rekey_tree(
+        encryption, args.path, password, new_password,
+        workers=args.workers, control=control, on_result=on_result
+    )
+    print(_("{} item(s) rekeyed, {} failed.").format(rekeyed, len(failures)))
+    if control.is_cancelled():
+        sys.exit(130)
+    sys.exit(1 if failures else 0)
+
+def run_unlock_tree(args, encryption: "Encryption", control: OperationControl, password: str):
+    """Unlock every locked item under a folder, deriving all the keys in parallel up front."""
+    import core_header
+
+    def on_result(path, success, message):
+        if success:
+            print(_("Unlocked: {}").format(path))
+        else:
+            print(_("Failed: {} ({})").format(path, message))
+
+    unlocked, failures = core_header.unlock_tree(
+        encryption, args.path, password,
+        workers=args.workers, control=control, on_result=on_result
+    )
+    print(_("{} item(s) unlocked, {} failed.").format(unlocked, len(failures)))
+    if control.is_cancelled():
+        sys.exit(130)
+    sys.exit(1 if failures else 0)
+
+def find_candidate_password(args, encryption: "Encryption", control: OperationControl, password: Optional[str]):
+    """
+    Work out which of the known passwords opens args.path. Returns (password, key,
+    keep_input). A password given with -p is tried on its own first and, if it fits,
+    used just like it would be without the other candidates.
+    """
+    candidates = [password] if password else []
+    if args.candidates:
+        with open(args.candidates, 'r', encoding='utf-8') as f:
+            candidates += [line.rstrip('\r\n') for line in f]
+    if args.try_history:
+        from core_history import PasswordHistory
+        candidates += PasswordHistory().candidate_passwords(args.path)
+
+    print(_("Trying {} password(s)...").format(len(set(filter(None, candidates)))))
+    try:
+        if password:
+            found = encryption.find_password(args.path, [password], control=control)
+            if found:
+                return password, found[0].key, False
+        found = encryption.find_password(args.path, candidates[1 if password else 0:], workers=args.workers,
+                                         control=control)
+    except OperationCancelled:
+        print(_("Operation cancelled. No changes were made."))
+        sys.exit(130)
+    except (OSError, ValueError) as e:
+        print(_("Error: {}").format(e))
+        sys.exit(1)
+    if not found:
+        print(_("None of the passwords fit."))
+        sys.exit(1)
+    if len(found) > 1:
+        # v1 files only have their padding to check, which some wrong passwords pass too
+        print(_("{} of the passwords fit this file and it's too old to tell which one is right. "
+                "Nothing was unlocked, run decrypt with the right one as -p.").format(len(found)))
+        sys.exit(1)
+    if not found[0].exact:
+        print(_("This file is too old to fully confirm the password, so the locked file is kept. "
+                "Delete it yourself once the unlocked file checks out."))
+    return found[0].password, found[0].key, not found[0].exact
+
+def run_list(args, encryption: "Encryption", password: str):
+    """Print what's inside a locked folder archive without unlocking it."""
+    from datetime import datetime
+
+    entries, message = encryption.list_archive(args.path, password)
+    if entries is None:
+        print(_("Operation failed: {}").format(message))
+        sys.exit(1)
+    for entry in entries:
+        modified = datetime.fromtimestamp(entry.mtime).strftime('%Y-%m-%d %H:%M') if entry.mtime else ""
+        size = "" if entry.is_dir else f"{entry.size:,}"
+        print(f"{size:>15}  {modified:<16}  {entry.name}{'/' if entry.is_dir else ''}")
+    print(_("{} item(s).").format(len(entries)))
+    if args.stats and encryption.last_metrics:
+        print(encryption.last_metrics.summary())
+    sys.exit(0)
+
+def run_extract(args, encryption: "Encryption", control: OperationControl, password: str):
+    """Extract selected members from a locked folder archive, leaving the archive locked."""
+    success, message = encryption.extract_members(args.path, password, args.members, args.output, control=control)
+    if args.stats and encryption.last_metrics:
+        print(encryption.last_metrics.summary())
+    if success:
+        print(_("Operation completed successfully."))
+        sys.exit(0)
+    print(_("Operation failed: {}").format(message))
+    sys.exit(130 if control.is_cancelled() else 1)
+
+def run_watch(args, encryption: "Encryption", control: OperationControl, password: str):
+    """Headless watch mode: lock everything that lands in a folder until Ctrl+C."""
+    if not os.path.isdir(args.path):
+        print(_("Error: Not a folder: {}").format(args.path))
+        sys.exit(1)
+
+    def on_result(path, success, message):
+        if success:
+            print(_("Locked: {}").format(path), flush=True)
+        else:
+            print(_("Failed: {} ({})").format(path, message), flush=True)
+
+    print(_("Watching {} for new files, press Ctrl+C to stop.").format(args.path), flush=True)
+    success, message = encryption.watch_folder(
+        args.path, password, workers=args.workers, settle_seconds=args.settle,
+        state_path=args.state_file, control=control, on_result=on_result, use_polling=args.poll
+    )
+    if not success:
+        print(_("Operation failed: {}").format(message))
+        sys.exit(1)
+    print(_("Stopped watching."))
+    sys.exit(0)
+
+def print_verify_result(path: str, report, message: Optional[str], single_file: bool) -> bool:
+    """Print what verify found for one file. Returns False if that makes the run fail."""
+    if report is None:
+        # In a folder, items locked without integrity data (folders, older files) are just skipped
+        print(_("{}: can't verify ({})").format(path, message))
+        return not single_file
+    if report.intact:
+        print(_("{}: OK, {} chunk(s) checked.").format(path, report.chunks))
+    elif report.damaged:
+        print(_("{}: DAMAGED").format(path))
+        for start, end in report.damaged:
+            print(_("  bytes {:,} to {:,}").format(start, end))
+    else:
+        print(_("{}: content OK, but its integrity data is damaged.").format(path))
+    return report.intact
+
+def run_verify(args, settings):
+    """Check locked files against their integrity data, no password needed."""
+    from core_encryption import Encryption
+    from core_header import find_locked_files
+
+    encryption = Encryption(workers=args.workers or settings.get('folder_workers') or None)
+    control = create_control(args, settings)
+    single_file = os.path.isfile(args.path)
+    all_intact = True
+    for path in find_locked_files(encryption, args.path):
+        report, message = encryption.verify_file(path, control=control)
+        if args.stats and encryption.last_metrics:
+            print(encryption.last_metrics.summary())
+        if report is None and control.is_cancelled():
+            sys.exit(130)
+        all_intact = print_verify_result(path, report, message, single_file) and all_intact
+    sys.exit(0 if all_intact else 1)
+
+def run_remote(args, password: Optional[str] = None):
+    """
+    Hand encrypt/decrypt/verify over to a running daemon (FileLocker daemon), printing
+    what the local run would. Returns without doing anything if no daemon is running.
+    """
+    import core_daemon
+
+    connection = None if args.no_daemon else core_daemon.connect()
+    if connection is None:
+        return
+    options = {name: getattr(args, name, None) for name in core_daemon.JOB_OPTIONS}
+    op = {'encrypt': 'lock', 'decrypt': 'unlock', 'verify': 'verify'}[args.command]
+    job = None
+
+    # Ctrl+C cancels the job on the daemon, which then reports back once it's rolled back
+    def on_interrupt(signum, frame):
+        print(_("Cancelling, please wait..."), file=sys.stderr)
+        if job is not None:
+            try:
+                core_daemon.call('cancel', job=job)
+            except core_daemon.DaemonError:
+                pass
+    signal.signal(signal.SIGINT, on_interrupt)
+
+    single_file = os.path.isfile(args.path)
+    all_intact = True
+    messages = {
+        'encrypt_file': _("Encrypting file: {}"),
+        'encrypt_folder': _("Encrypting folder: {}"),
+        'decrypt_file': _("Decrypting file: {}"),
+        'decrypt_legacy_file': _("Decrypting legacy file: {}"),
+        'decrypt_folder': _("Decrypting folder: {}"),
+    }
+    try:
+        for event in connection.request(op, path=os.path.abspath(args.path), password=password, options=options):
+            kind = event['event']
+            if kind == 'accepted':
+                job = event['job']
+                if event['operation'] in messages:
+                    print(messages[event['operation']].format(args.path))
+            elif kind == 'result':
+                if event['success']:
+                    print(_("Unlocked: {}").format(event['path']))
+                else:
+                    print(_("Failed: {} ({})").format(event['path'], event['message']))
+            elif kind == 'report':
+                if event['stats']:
+                    print(event['stats'])
+                report = event['report'] and argparse.Namespace(**event['report'])
+                all_intact = print_verify_result(event['path'], report, event['message'], single_file) and all_intact
+            elif kind == 'done':
+                break
+        else:
+            raise core_daemon.DaemonError(_("The daemon closed the connection without finishing the job."))
+    except core_daemon.DaemonError as e:
+        print(_("Error: {}").format(e))
+        sys.exit(1)
+
+    if event.get('stats'):
+        print(event['stats'])
+    if 'unlocked' in event:
+        print(_("{} item(s) unlocked, {} failed.").format(event['unlocked'], event['failed']))
+    if event['cancelled']:
+        print(_("Operation cancelled. No changes were made."))
+        sys.exit(130)
+    if op == 'verify':
+        sys.exit(0 if all_intact else 1)
+    if 'unlocked' in event:
+        sys.exit(0 if event['success'] else 1)
+    if event['success']:
+        print(_("Operation completed successfully."))
+        sys.exit(0)
+    print(_("Operation failed. Please check the password or file integrity."))
+    if event['message']:
+        print(event['message'])
+    sys.exit(1)
+
+def run_daemon(args, settings):
+    """Run the job daemon in the foreground, or talk to the one that's running."""
+    import core_daemon
+
+    try:
+        if args.status or args.stop:
+            if args.stop:
+                core_daemon.call('shutdown')
+                print(_("The daemon will stop once its running jobs are done."))
+                sys.exit(0)
+            pong = core_daemon.call('ping')
+            jobs = core_daemon.call('status')['jobs']
+            print(_("Daemon running (pid {}, {} worker(s), {} job(s) running).").format(pong['pid'], pong['workers'], pong['running']))
+            for job in jobs:
+                print(f"  #{job['job']:<5} {job['state']:<8} {job['percent']:>5.1f}%  {job['op']:<7} {job['path']}")
+            sys.exit(0)
+
+        def on_ready(address):
+            where = address if isinstance(address, str) else "{}:{}".format(*address)
+            print(_("File Locker daemon listening on {}, press Ctrl+C to stop.").format(where), flush=True)
+        core_daemon.serve(settings, workers=args.workers, tcp_port=args.tcp, on_ready=on_ready)
+    except core_daemon.DaemonError as e:
+        print(_("Error: {}").format(e))
+        sys.exit(1)
+    print(_("Daemon stopped."))
+    sys.exit(0)
+
+def run_calibrate(args, settings):
+    from core_header import KdfParams
+
+    algorithm = args.algorithm or settings.get('kdf_algorithm')
+    print(_("Calibrating {} for {:.0f} ms...").format(algorithm, args.target_ms))
+    params = KdfParams.calibrate(algorithm, args.target_ms)
+    start = time.perf_counter()
+    params.derive("calibration")
+    elapsed = (time.perf_counter() - start) * 1000
+    print(_("{}: cost {} takes {:.0f} ms here.").format(algorithm, params.iterations, elapsed))
+    if args.save:
+        settings.set('kdf_algorithm', algorithm)
+        settings.set('kdf_cost', params.iterations)
+        settings.set('kdf_target_ms', int(args.target_ms))
+        print(_("Saved. Existing files keep the settings they were locked with."))
+    sys.exit(0)
+
 def run_cli():
     """Handles command-line interface operations."""
     parser = argparse.ArgumentParser(
@@ -19,19 +393,103 @@ def run_cli():
 
     # Encrypt command
     parser_encrypt = subparsers.add_parser("encrypt", help=_("Encrypt a file or folder."))
-    parser_encrypt.add_argument("path", help=_("Path to the file or folder to encrypt."))
+    parser_encrypt.add_argument("path", help=_("Path to the file or folder to encrypt, or - to lock stdin to stdout."))
     parser_encrypt.add_argument("-p", "--password", help=_("Password for encryption. If not provided, you will be prompted."))
+    parser_encrypt.add_argument("--workers", type=int, default=None, help=_("Threads used to build folder archives (default: CPU count)."))
+    parser_encrypt.add_argument("--exclude", action="append", default=[], metavar="PATTERN", help=_("Leave matching files/folders out when locking a folder (gitignore style, repeatable)."))
+    parser_encrypt.add_argument("--include", action="append", default=[], metavar="PATTERN", help=_("Lock matching items even if an exclude pattern caught them (repeatable)."))
+    add_job_arguments(parser_encrypt)
+    parser_encrypt.add_argument("--no-daemon", action="store_true", help=_("Run here even if a File Locker daemon is running."))
 
     # Decrypt command
     parser_decrypt = subparsers.add_parser("decrypt", help=_("Decrypt a file or folder."))
-    parser_decrypt.add_argument("path", help=_("Path to the .locked or .flka file to decrypt."))
+    parser_decrypt.add_argument("path", help=_("Path to the .locked or .flka file to decrypt, a folder to unlock everything in it, or - to unlock stdin to stdout."))
     parser_decrypt.add_argument("-p", "--password", help=_("Password for decryption. If not provided, you will be prompted."))
+    parser_decrypt.add_argument("--workers", type=int, default=None, help=_("Threads used to extract folder archives and derive keys (default: CPU count)."))
+    parser_decrypt.add_argument("--try-history", action="store_true", help=_("Instead of asking for the password, try every password in the password history."))
+    parser_decrypt.add_argument("--candidates", default=None, metavar="FILE", help=_("Instead of asking for the password, try every password in this file (one per line)."))
+    add_job_arguments(parser_decrypt)
+    parser_decrypt.add_argument("--no-daemon", action="store_true", help=_("Run here even if a File Locker daemon is running."))
     
+    # Legacy migration command
+    parser_migrate = subparsers.add_parser("migrate", help=_("Convert .locked files from the old engine to the current format."))
+    parser_migrate.add_argument("path", help=_("A legacy .locked file or a folder to scan for them."))
+    parser_migrate.add_argument("-p", "--password", help=_("Password of the legacy files. If not provided, you will be prompted."))
+    parser_migrate.add_argument("--workers", type=int, default=None, help=_("Number of files migrated in parallel (default: CPU count)."))
+    parser_migrate.add_argument("--resume-log", default=None, help=_("File recording finished migrations, so an interrupted run can resume."))
+    add_job_arguments(parser_migrate)
+
+    # Password change command
+    parser_rekey = subparsers.add_parser("rekey", help=_("Change the password of locked items without re-encrypting them."))
+    parser_rekey.add_argument("path", help=_("A .locked/.flka file, or a folder to scan for them."))
+    parser_rekey.add_argument("-p", "--password", help=_("Current password. If not provided, you will be prompted."))
+    parser_rekey.add_argument("--new-password", help=_("New password. If not provided, you will be prompted."))
+    parser_rekey.add_argument("--workers", type=int, default=None, help=_("Number of items rekeyed in parallel (default: CPU count)."))
+    add_job_arguments(parser_rekey)
+
+    # Archive listing and selective extraction
+    parser_list = subparsers.add_parser("list", help=_("List the contents of a locked folder archive."))
+    parser_list.add_argument("path", help=_("Path to the .flka archive."))
+    parser_list.add_argument("-p", "--password", help=_("Password of the archive. If not provided, you will be prompted."))
+    parser_list.add_argument("--stats", action="store_true", help=_("Print a timing breakdown of the operation when it finishes."))
+
+    parser_extract = subparsers.add_parser("extract", help=_("Extract selected files from a locked folder archive."))
+    parser_extract.add_argument("path", help=_("Path to the .flka archive."))
+    parser_extract.add_argument("members", nargs="+", help=_("Files or folders inside the archive to extract."))
+    parser_extract.add_argument("-p", "--password", help=_("Password of the archive. If not provided, you will be prompted."))
+    parser_extract.add_argument("-o", "--output", default=None, help=_("Folder to extract into (default: the archive name without .flka)."))
+    add_job_arguments(parser_extract)
+
+    # Watch folder command
+    parser_watch = subparsers.add_parser("watch", help=_("Keep running and lock every file written into a folder."))
+    parser_watch.add_argument("path", help=_("Folder to watch."))
+    parser_watch.add_argument("-p", "--password", help=_("Password for locking. If not provided, you will be prompted."))
+    parser_watch.add_argument("--workers", type=int, default=None, help=_("Number of files locked in parallel (default: CPU count)."))
+    parser_watch.add_argument("--settle", type=float, default=2.0, help=_("Seconds a file must stay unchanged before it gets locked."))
+    parser_watch.add_argument("--state-file", default=None, help=_("Where to keep the watch state (default: inside the watched folder)."))
+    parser_watch.add_argument("--poll", action="store_true", help=_("Poll the folder instead of using file system notifications."))
+    parser_watch.add_argument("--exclude", action="append", default=[], metavar="PATTERN", help=_("Never lock matching files (gitignore style, repeatable)."))
+    parser_watch.add_argument("--include", action="append", default=[], metavar="PATTERN", help=_("Lock matching files even if an exclude pattern caught them (repeatable)."))
+    add_job_arguments(parser_watch)
+
+    # Integrity check command
+    parser_verify = subparsers.add_parser("verify", help=_("Check locked files for corruption using their integrity data, no password needed."))
+    parser_verify.add_argument("path", help=_("A .locked file, or a folder to check every locked file in."))
+    parser_verify.add_argument("--workers", type=int, default=None, help=_("Threads hashing the file (default: CPU count)."))
+    add_job_arguments(parser_verify)
+    parser_verify.add_argument("--no-daemon", action="store_true", help=_("Run here even if a File Locker daemon is running."))
+
+    # KDF calibration command
+    parser_calibrate = subparsers.add_parser("calibrate-kdf", help=_("Measure this machine and pick key derivation settings for a target time."))
+    parser_calibrate.add_argument("--algorithm", choices=KDF_CHOICES, default=None, help=_("Key derivation function (default: the kdf_algorithm setting)."))
+    parser_calibrate.add_argument("--target-ms", type=float, default=500.0, help=_("How long one key derivation should take, in milliseconds."))
+    parser_calibrate.add_argument("--save", action="store_true", help=_("Use the result for everything locked from now on."))
+
+    # Job daemon command
+    parser_daemon = subparsers.add_parser("daemon", help=_("Keep running and take encrypt/decrypt/verify jobs from the CLI, which then starts up much faster."))
+    parser_daemon.add_argument("--workers", type=int, default=None, help=_("Jobs run at the same time (default: CPU count)."))
+    parser_daemon.add_argument("--tcp", type=int, default=None, metavar="PORT", help=_("Listen on 127.0.0.1:PORT instead of a Unix socket."))
+    parser_daemon.add_argument("--status", action="store_true", help=_("Show the running daemon and its jobs."))
+    parser_daemon.add_argument("--stop", action="store_true", help=_("Stop the running daemon once its jobs are done."))
+
     # Shell registration command
     subparsers.add_parser("register-shell", help=_("Register shell integration (Windows only)."))
 
     args = parser.parse_args()
 
+    if args.command == "calibrate-kdf":
+        run_calibrate(args, Settings())
+
+    if args.command == "daemon":
+        run_daemon(args, Settings())
+
+    if args.command == "verify":
+        if not os.path.exists(args.path):
+            print(_("Error: The specified path does not exist: {}").format(args.path))
+            sys.exit(1)
+        run_remote(args)
+        run_verify(args, Settings())
+
     if args.command == "register-shell":
         if sys.platform == 'win32':
             from core_paths import register_shell_integration
@@ -43,46 +501,104 @@ def run_cli():
             sys.exit(1)
 
     # --- Handle Encrypt/Decrypt ---
-    if not os.path.exists(args.path):
+    is_stream = args.path == "-"
+    if not is_stream and not os.path.exists(args.path):
         print(_("Error: The specified path does not exist: {}").format(args.path))
         sys.exit(1)
 
     password = args.password
-    if not password:
+    guessing = getattr(args, 'try_history', False) or getattr(args, 'candidates', None)
+    if guessing and (is_stream or os.path.isdir(args.path)):
+        print(_("Error: --try-history and --candidates work on a single locked file or folder archive."))
+        sys.exit(1)
+    if not password and not guessing:
         password = getpass(_("Enter password: "))
         if not password:
             print(_("Error: Password cannot be empty."))
             sys.exit(1)
-            
-    encryption = Encryption()
-    success = False
+
+    if args.command in ("encrypt", "decrypt") and not is_stream and not guessing:
+        run_remote(args, password)
+
+    from core_encryption import Encryption
+    from core_metrics import create_log_sink
+    from core_walk import PathFilter
+
+    settings = Settings()
+    log_sink = create_log_sink() if settings.get('metrics_log_enabled') else None
+    encryption = Encryption(metrics_sink=log_sink,
+                            workers=settings.get('folder_workers') or None,
+                            cipher_backend=getattr(args, 'cipher_backend', None) or settings.get('cipher_backend'),
+                            kdf_algorithm=settings.get('kdf_algorithm'),
+                            kdf_cost=settings.get('kdf_cost'),
+                            io_mode=getattr(args, 'io_mode', None) or settings.get('io_mode'))
+    if args.command in ("encrypt", "watch"):
+        encryption.path_filter = PathFilter.from_settings(settings, args.exclude, args.include)
+    if args.command in ("encrypt", "decrypt") and args.workers:
+        encryption.workers = args.workers
+    if args.command == "list":
+        run_list(args, encryption, password)
+
+    control = create_control(args, settings)
+    success, message = False, None
     
+    if is_stream:
+        run_stream(args, encryption, control, password)
+
+    if args.command == "migrate":
+        run_migrate(args, encryption, control, password)
+
+    if args.command == "rekey":
+        run_rekey(args, encryption, control, password)
+
+    if args.command == "extract":
+        run_extract(args, encryption, control, password)
+
+    if args.command == "watch":
+        run_watch(args, encryption, control, password)
+
     try:
         if args.command == "encrypt":
             if os.path.isdir(args.path):
                 print(_("Encrypting folder: {}").format(args.path))
-                success = encryption.encrypt_folder(args.path, password)
+                success, message = encryption.encrypt_folder(args.path, password, control=control)
             else:
                 print(_("Encrypting file: {}").format(args.path))
-                success = encryption.encrypt_file(args.path, password)
+                success, message = encryption.encrypt_file(args.path, password, control=control)
         
         elif args.command == "decrypt":
+            if os.path.isdir(args.path):
+                run_unlock_tree(args, encryption, control, password)
+            key, keep_input = None, False
+            if guessing:
+                password, key, keep_input = find_candidate_password(args, encryption, control, password)
             op_type = encryption.get_operation_type(args.path)
             if op_type == "decrypt_folder":
                 print(_("Decrypting folder: {}").format(args.path))
-                success = encryption.decrypt_folder(args.path, password)
+                success, message = encryption.decrypt_folder(args.path, password, control=control, key=key)
             elif op_type == "decrypt_file":
                 print(_("Decrypting file: {}").format(args.path))
-                success = encryption.decrypt_file(args.path, password)
+                success, message = encryption.decrypt_file(args.path, password, control=control, key=key, keep_input=keep_input)
+            elif op_type == "decrypt_legacy_file":
+                print(_("Decrypting legacy file: {}").format(args.path))
+                success, message = encryption.decrypt_legacy_file(args.path, password, control=control, key=key)
             else:
                 print(_("Error: Not a valid encrypted file or folder: {}").format(args.path))
                 sys.exit(1)
 
+        if args.stats and encryption.last_metrics:
+            print(encryption.last_metrics.summary())
+
         if success:
             print(_("Operation completed successfully."))
             sys.exit(0)
+        elif control.is_cancelled():
+            print(_("Operation cancelled. No changes were made."))
+            sys.exit(130)
         else:
             print(_("Operation failed. Please check the password or file integrity."))
+            if message:
+                print(message)
             sys.exit(1)
             
     except Exception as e:
@@ -93,11 +609,15 @@ def main():
     """Main entry point for the application."""
     # Check if CLI arguments are provided (and it's not just the script name)
     # A simple check to see if a command like 'encrypt' or 'decrypt' is present.
-    cli_commands = {'encrypt', 'decrypt', 'register-shell'}
+    cli_commands = {'encrypt', 'decrypt', 'migrate', 'rekey', 'list', 'extract', 'watch', 'verify', 'daemon', 'calibrate-kdf', 'register-shell'}
     if len(sys.argv) > 1 and sys.argv[1] in cli_commands:
         run_cli()
     else:
         # Launch the GUI application
+        import wx
+        import nvda
+        from gui_main import MainWindow
+
         app = wx.App()
         settings = Settings()
         frame = MainWindow(settings)
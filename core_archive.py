@@ -0,0 +1,488 @@
+"""
+Seekable folder archive (FLA3).
+
+    header    v2 header from core_header (magic FLA3) with an extra INDEX field:
+              offset (8) + length (8) + iv (16) of the encrypted index
+    entries   file contents one after another, each deflated (or stored) and
+              AES-256-CBC encrypted on its own with the content key and its own IV
+    index     AES-256-CBC(zlib(JSON list of entries)), wherever the header points
+
+Since every entry is encrypted independently and the index says where it lives,
+listing only decrypts the index and extracting a member only reads that member.
+"""
+import json
+import os
+import stat
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterable, List, NamedTuple, Optional, Tuple
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from Crypto.Util.Padding import pad, unpad
+
+from translate import _ # import for errors
+from core_control import OperationControl
+from core_metrics import OperationMetrics
+import core_cipher
+import core_header
+from core_cipher import CipherSuite
+from core_header import KdfParams, LockHeader
+from core_space import preallocate
+
+METHOD_STORE = 0
+METHOD_DEFLATE = 8 # same numbers zip uses
+COMPRESS_LEVEL = 6
+
+# Files up to this size are read, compressed and encrypted whole by the worker pool.
+# Bigger ones get streamed by the writer thread so memory stays bounded.
+PARALLEL_MAX_FILE_SIZE = 4 * 1024 * 1024
+# How much prepared-but-not-yet-written data the pool may run ahead of the writer
+READ_AHEAD_BYTES = 64 * 1024 * 1024
+# Room for one entry's JSON record in the index, less its name
+INDEX_HEADROOM = 256
+
+class SourceItem(NamedTuple):
+    """A file or directory on disk that goes into an archive."""
+    path: str
+    arcname: str
+    is_dir: bool
+    size: int = 0
+    mtime: float = 0.0
+    mode: int = 0o644
+
+class ArchiveEntry:
+    """One file or directory in an archive, as recorded in the index."""
+    def __init__(self,
+                 name: str,
+                 is_dir: bool = False,
+                 size: int = 0,
+                 mtime: float = 0.0,
+                 mode: int = 0o644,
+                 offset: int = 0,
+                 length: int = 0,
+                 iv: bytes = b'',
+                 method: int = METHOD_DEFLATE):
+        self.name = name       # relative, always '/' separated
+        self.is_dir = is_dir
+        self.size = size       # plaintext size
+        self.mtime = mtime
+        self.mode = mode
+        self.offset = offset   # where the encrypted data starts in the archive
+        self.length = length   # encrypted length
+        self.iv = iv
+        self.method = method
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name, 'dir': self.is_dir, 'size': self.size, 'mtime': self.mtime, 'mode': self.mode,
+            'offset': self.offset, 'length': self.length, 'iv': self.iv.hex(), 'method': self.method,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ArchiveEntry":
+        return cls(data['name'], data['dir'], data['size'], data['mtime'], data['mode'],
+                   data['offset'], data['length'], bytes.fromhex(data['iv']), data['method'])
+
+def member_path(root: str, name: str) -> str:
+    """Where a member ends up under root. Refuses anything that could escape root."""
+    parts = name.replace('\\', '/').split('/')
+    if name.startswith(('/', '\\')) or ':' in parts[0] or any(part in ('', '.', '..') for part in parts):
+        raise ValueError(_("Unsafe path in archive: {}").format(name))
+    return os.path.join(root, *parts)
+
+def size_bound(items: Iterable[SourceItem]) -> int:
+    """
+    Most an archive of these items can take up. Deflate never grows stored data by more
+    than a few bytes per 16 KB block, plus one padding block per entry and its index record.
+    """
+    total = core_header.PREAMBLE_SIZE + core_header.DEFAULT_HEADER_SIZE + INDEX_HEADROOM
+    for item in items:
+        total += INDEX_HEADROOM + len(item.arcname.encode('utf-8'))
+        if not item.is_dir:
+            total += item.size + item.size // 1000 + 2 * AES.block_size
+    return total
+
+class ArchiveWriter:
+    """
+    Streams entries into a new FLA3 archive. The header gets written up front and
+    rewritten by close() once the index location is known, so out_file must be seekable.
+    """
+    def __init__(self,
+                 out_file,
+                 password: str,
+                 metrics: OperationMetrics,
+                 control: Optional[OperationControl] = None,
+                 chunk_size: int = 64 * 1024,
+                 ciphers: Optional[CipherSuite] = None,
+                 kdf: Optional[KdfParams] = None):
+        self._out = out_file
+        self.metrics = metrics
+        self.ciphers = ciphers or core_cipher.get_suite()
+        self.control = control
+        self.chunk_size = chunk_size
+        self.entries: List[ArchiveEntry] = []
+        with metrics.phase('kdf'):
+            self.header, self._key = LockHeader.create(core_header.ARCHIVE_MAGIC, password, kdf)
+        self._write(self.header.pack())
+
+    def _write(self, data: bytes):
+        with self.metrics.phase('write'):
+            self._out.write(data)
+        self.metrics.count('bytes_written', len(data))
+
+    def add_directory(self, arcname: str, mtime: float = 0.0, mode: int = 0o755) -> ArchiveEntry:
+        entry = ArchiveEntry(arcname, True, mtime=mtime, mode=mode, method=METHOD_STORE)
+        self.entries.append(entry)
+        return entry
+
+    def add_file(self, path: str, arcname: str) -> ArchiveEntry:
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            return self.add_stream(f, arcname, st.st_size, st.st_mtime, stat.S_IMODE(st.st_mode))
+
+    def add_stream(self, in_stream, arcname: str, size: int, mtime: float = 0.0, mode: int = 0o644) -> ArchiveEntry:
+        entry = ArchiveEntry(arcname, size=size, mtime=mtime, mode=mode, iv=get_random_bytes(AES.block_size))
+        entry.offset = self._out.tell()
+        cipher = self.ciphers.encryptor(self._key, entry.iv)
+
+        if size <= self.chunk_size:
+            # Small file: one shot
+            with self.metrics.phase('read'):
+                data = in_stream.read()
+            if self.control:
+                self.control.checkpoint(len(data))
+            self.metrics.count('bytes_read', len(data))
+            self._write(self._pack(entry, data))
+        else:
+            compressor = zlib.compressobj(COMPRESS_LEVEL)
+            carry = b''
+            entry.size = 0
+            while True:
+                with self.metrics.phase('read'):
+                    chunk = in_stream.read(self.chunk_size)
+                if not chunk:
+                    break
+                if self.control:
+                    self.control.checkpoint(len(chunk))
+                entry.size += len(chunk)
+                self.metrics.count('bytes_read', len(chunk))
+                self.metrics.count('chunks')
+                with self.metrics.phase('compress'):
+                    data = carry + compressor.compress(chunk)
+                cut = len(data) - len(data) % AES.block_size
+                carry = data[cut:]
+                if cut:
+                    with self.metrics.phase('cipher'):
+                        encrypted = cipher.encrypt(data[:cut])
+                    self._write(encrypted)
+                    entry.length += len(encrypted)
+            with self.metrics.phase('compress'):
+                data = carry + compressor.flush()
+            with self.metrics.phase('cipher'):
+                encrypted = cipher.encrypt(pad(data, AES.block_size))
+            self._write(encrypted)
+            entry.length += len(encrypted)
+
+        self.metrics.count('files')
+        self.entries.append(entry)
+        return entry
+
+    def _pack(self, entry: ArchiveEntry, data: bytes) -> bytes:
+        """Compress (or store, if deflate doesn't win anything) and encrypt a whole entry."""
+        with self.metrics.phase('compress'):
+            packed = zlib.compress(data, COMPRESS_LEVEL)
+        if len(packed) >= len(data):
+            packed, entry.method = data, METHOD_STORE
+        with self.metrics.phase('cipher'):
+            encrypted = self.ciphers.encryptor(self._key, entry.iv).encrypt(pad(packed, AES.block_size))
+        entry.size = len(data)
+        entry.length = len(encrypted)
+        return encrypted
+
+    def prepare_file(self, item: SourceItem) -> Tuple[ArchiveEntry, bytes]:
+        """
+        Read, compress and encrypt a small file without touching the output. Safe to call
+        from worker threads, add_prepared() then puts the result in the archive.
+        """
+        with self.metrics.phase('read'):
+            with open(item.path, 'rb') as f:
+                data = f.read()
+        if self.control:
+            self.control.checkpoint(len(data))
+        self.metrics.count('bytes_read', len(data))
+        entry = ArchiveEntry(item.arcname, mtime=item.mtime, mode=item.mode, iv=get_random_bytes(AES.block_size))
+        return entry, self._pack(entry, data)
+
+    def add_prepared(self, entry: ArchiveEntry, encrypted: bytes) -> ArchiveEntry:
+        entry.offset = self._out.tell()
+        self._write(encrypted)
+        self.metrics.count('files')
+        self.entries.append(entry)
+        return entry
+
+    def close(self):
+        """Write the encrypted index and point the header at it."""
+        index = zlib.compress(json.dumps([e.to_dict() for e in self.entries], separators=(',', ':')).encode('utf-8'))
+        iv = get_random_bytes(AES.block_size)
+        offset = self._out.tell()
+        with self.metrics.phase('cipher'):
+            encrypted = self.ciphers.encryptor(self._key, iv).encrypt(pad(index, AES.block_size))
+        self._write(encrypted)
+
+        self.header.fields[core_header.TAG_INDEX] = struct.pack('>QQ', offset, len(encrypted)) + iv
+        self._out.seek(0)
+        self._write(self.header.pack())
+        self._out.seek(0, os.SEEK_END)
+        self._out.flush()
+
+def write_items(writer: ArchiveWriter,
+                items: Iterable[SourceItem],
+                workers: Optional[int] = None,
+                progress_callback: Optional[Callable[[float], None]] = None,
+                total_size: Optional[int] = None):
+    """
+    Fill an archive from a list of files and directories using a worker pool. Workers
+    read, compress and encrypt small files ahead of time (up to READ_AHEAD_BYTES), the
+    calling thread writes everything in the original order so the output is deterministic.
+    Large files are streamed by the writer while the pool keeps preparing the next ones.
+    """
+    workers = workers or os.cpu_count() or 4
+    control = writer.control
+    pending = deque() # (item, future or None), in archive order
+    queued_bytes = 0
+    processed = 0
+    source = iter(items)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="filelocker-archive",
+                            initializer=control.apply_priority if control else None) as pool:
+        try:
+            while True:
+                while queued_bytes < READ_AHEAD_BYTES and len(pending) < workers * 64:
+                    item = next(source, None)
+                    if item is None:
+                        break
+                    future = None
+                    if not item.is_dir and item.size <= PARALLEL_MAX_FILE_SIZE:
+                        future = pool.submit(writer.prepare_file, item)
+                        queued_bytes += item.size
+                    pending.append((item, future))
+                if not pending:
+                    break
+
+                item, future = pending.popleft()
+                if item.is_dir:
+                    writer.add_directory(item.arcname, item.mtime, item.mode)
+                elif future:
+                    entry, encrypted = future.result()
+                    queued_bytes -= item.size
+                    writer.add_prepared(entry, encrypted)
+                else:
+                    writer.add_file(item.path, item.arcname)
+
+                processed += item.size
+                if progress_callback and total_size:
+                    progress_callback(min(processed / total_size * 100, 100.0))
+        except BaseException:
+            for queued_item, future in pending:
+                if future:
+                    future.cancel()
+            raise
+
+class ArchiveReader:
+    """Random access to an FLA3 archive: the index is loaded up front, entry data on demand."""
+    def __init__(self,
+                 in_file,
+                 password: str,
+                 metrics: OperationMetrics,
+                 chunk_size: int = 64 * 1024,
+                 ciphers: Optional[CipherSuite] = None,
+                 kek: Optional[bytes] = None):
+        self._in = in_file
+        self.ciphers = ciphers or core_cipher.get_suite()
+        self._owner = threading.current_thread()
+        name = getattr(in_file, 'name', None)
+        self._path = name if isinstance(name, str) else None
+        self._local = threading.local()
+        self._worker_handles = []
+        self._handles_lock = threading.Lock()
+        self.metrics = metrics
+        self.chunk_size = chunk_size - chunk_size % AES.block_size
+        self.header = LockHeader.read(in_file)
+        if self.header.magic != core_header.ARCHIVE_MAGIC:
+            raise ValueError(_("Not a valid locked folder archive or incorrect password"))
+        self.metrics.count('bytes_read', self.header.data_offset)
+        with metrics.phase('kdf'):
+            self._key = self.header.unwrap_with_kek(kek) if kek else self.header.unwrap(password)
+        self.entries = self._read_index()
+
+    def _read_index(self) -> List[ArchiveEntry]:
+        field = self.header.fields.get(core_header.TAG_INDEX, b'')
+        if len(field) != 32:
+            raise ValueError(_("Incorrect password or corrupted file."))
+        offset, length = struct.unpack_from('>QQ', field)
+        self._in.seek(offset)
+        with self.metrics.phase('read'):
+            encrypted = self._in.read(length)
+        self.metrics.count('bytes_read', len(encrypted))
+        if len(encrypted) != length or length % AES.block_size:
+            raise ValueError(_("Incorrect password or corrupted file."))
+        try:
+            with self.metrics.phase('cipher'):
+                index = unpad(self.ciphers.decryptor(self._key, field[16:]).decrypt(encrypted), AES.block_size)
+            return [ArchiveEntry.from_dict(item) for item in json.loads(zlib.decompress(index))]
+        except (ValueError, KeyError, TypeError, zlib.error):
+            raise ValueError(_("Incorrect password or corrupted file."))
+
+    def _source(self):
+        """The archive handle for the calling thread, workers get their own so they can seek freely."""
+        if threading.current_thread() is self._owner or not self._path:
+            return self._in
+        handle = getattr(self._local, 'handle', None)
+        if handle is None:
+            handle = open(self._path, 'rb')
+            self._local.handle = handle
+            with self._handles_lock:
+                self._worker_handles.append(handle)
+        return handle
+
+    def close(self):
+        """Close the handles opened for worker threads. The caller's in_file stays open."""
+        with self._handles_lock:
+            for handle in self._worker_handles:
+                handle.close()
+            self._worker_handles.clear()
+
+    def find(self, names: Iterable[str]) -> List[ArchiveEntry]:
+        """Entries matching the given member names, a directory name brings everything under it."""
+        wanted = [name.replace('\\', '/').strip('/') for name in names]
+        found = []
+        for name in wanted:
+            matches = [e for e in self.entries if e.name == name or e.name.startswith(name + '/')]
+            if not matches:
+                raise ValueError(_("Not found in archive: {}").format(name))
+            found.extend(e for e in matches if e not in found)
+        return found
+
+    def read_entry(self, entry: ArchiveEntry, out_stream, control: Optional[OperationControl] = None) -> int:
+        """Decrypt and decompress one entry into out_stream. Returns the plaintext size."""
+        if entry.is_dir:
+            return 0
+        if entry.length % AES.block_size or not entry.length:
+            raise ValueError(_("Incorrect password or corrupted file."))
+        cipher = self.ciphers.decryptor(self._key, entry.iv)
+        decompressor = zlib.decompressobj() if entry.method == METHOD_DEFLATE else None
+        source = self._source()
+        source.seek(entry.offset)
+        remaining = entry.length
+        written = 0
+        try:
+            while remaining:
+                with self.metrics.phase('read'):
+                    chunk = source.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    raise ValueError(_("Incorrect password or corrupted file."))
+                if control:
+                    control.checkpoint(len(chunk))
+                remaining -= len(chunk)
+                self.metrics.count('bytes_read', len(chunk))
+                self.metrics.count('chunks')
+                with self.metrics.phase('cipher'):
+                    data = cipher.decrypt(chunk)
+                if not remaining:
+                    data = unpad(data, AES.block_size)
+                if decompressor:
+                    with self.metrics.phase('decompress'):
+                        data = decompressor.decompress(data)
+                        if not remaining:
+                            data += decompressor.flush()
+                with self.metrics.phase('write'):
+                    out_stream.write(data)
+                written += len(data)
+        except zlib.error:
+            raise ValueError(_("Incorrect password or corrupted file."))
+        if written != entry.size:
+            raise ValueError(_("Incorrect password or corrupted file."))
+        self.metrics.count('bytes_written', written)
+        return written
+
+    def extract(self, entry: ArchiveEntry, root: str, control: Optional[OperationControl] = None) -> str:
+        """Write one entry under root, keeping its modification time and mode. Returns the path written."""
+        path = member_path(root, entry.name)
+        if entry.is_dir:
+            os.makedirs(path, exist_ok=True)
+            restore_mode(path, entry.mode)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.extract_file(entry, path, control)
+        return path
+
+    def extract_file(self, entry: ArchiveEntry, path: str, control: Optional[OperationControl] = None) -> ArchiveEntry:
+        """Write a file entry to path, whose directory must exist. Safe to call from worker threads."""
+        with open(path, 'wb') as out_file:
+            if entry.size > self.chunk_size: # small files go out in one write anyway
+                preallocate(out_file, entry.size)
+            self.read_entry(entry, out_file, control)
+        if entry.mtime:
+            os.utime(path, (entry.mtime, entry.mtime))
+        restore_mode(path, entry.mode)
+        self.metrics.count('files')
+        return entry
+
+def restore_mode(path: str, mode: int):
+    """
+    Give an extracted item the mode stored in the index. Only the permission bits, an
+    archive doesn't get to hand out setuid/setgid. Windows only knows read only.
+    """
+    os.chmod(path, mode & 0o777)
+
+def extract_entries(reader: ArchiveReader,
+                    entries: List[ArchiveEntry],
+                    root: str,
+                    workers: Optional[int] = None,
+                    control: Optional[OperationControl] = None,
+                    progress_callback: Optional[Callable[[float], None]] = None,
+                    extracted: Optional[List[str]] = None) -> List[str]:
+    """
+    Extract entries under root on a worker pool. Every member path gets validated and
+    the whole directory tree created before the first file is written. Paths are added
+    to `extracted` before they get written, so a cancelled run can be rolled back.
+    Directory modes are restored last, a read only one would keep its files out.
+    """
+    extracted = extracted if extracted is not None else []
+    targets = [(entry, member_path(root, entry.name)) for entry in entries]
+
+    directories = {path for entry, path in targets if entry.is_dir}
+    directories.update(os.path.dirname(path) for entry, path in targets if not entry.is_dir)
+    with reader.metrics.phase('mkdir'):
+        for directory in sorted(directories): # parents sort before their children
+            os.makedirs(directory, exist_ok=True)
+
+    files = [(entry, path) for entry, path in targets if not entry.is_dir]
+    total_size = sum(entry.size for entry, path in files) or 1
+    processed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4, thread_name_prefix="filelocker-extract",
+                                initializer=control.apply_priority if control else None) as pool:
+            futures = []
+            for entry, path in files:
+                extracted.append(path)
+                futures.append(pool.submit(reader.extract_file, entry, path, control))
+            try:
+                for future in as_completed(futures):
+                    processed += future.result().size
+                    if progress_callback:
+                        progress_callback(min(processed / total_size * 100, 100.0))
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        for entry, path in sorted(((entry, path) for entry, path in targets if entry.is_dir),
+                                  key=lambda target: target[1], reverse=True): # children first
+            restore_mode(path, entry.mode)
+    finally:
+        reader.close()
+    return extracted
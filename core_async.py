@@ -0,0 +1,156 @@
+"""
+asyncio front end for the Encryption engine.
+
+    from core_async import lock, unlock
+
+    new_path = await lock("report.pdf", password)
+
+    op = unlock("report.pdf.locked", password)
+    async for percent in op.progress():
+        print(percent)
+    path = await op
+
+All operations share one thread pool and one concurrency limit per process, no
+matter how many event loops there are, so thousands of requests just wait their
+turn in the pool's queue instead of each getting a thread.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+from translate import _ # import for errors
+from core_encryption import Encryption
+from core_control import OperationControl, OperationCancelled
+
+class OperationFailed(Exception):
+    """Raised by an awaited operation when the engine reported a failure."""
+
+# --- process wide shared state ---
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_max_concurrency = os.cpu_count() or 4
+# Taken by the job on its worker thread, so it holds across all event loops (an
+# asyncio.Semaphore belongs to one loop) and stays taken until the work really stopped
+_slots: Optional[threading.BoundedSemaphore] = None
+
+def configure(max_concurrency: Optional[int] = None, executor: Optional[ThreadPoolExecutor] = None):
+    """
+    Set the shared concurrency limit and/or executor. Call this once at startup,
+    before the first operation, it doesn't resize anything already in use.
+    """
+    global _executor, _max_concurrency
+    with _executor_lock:
+        if max_concurrency:
+            _max_concurrency = max_concurrency
+        if executor:
+            _executor = executor
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # pycryptodome, hashlib and zlib drop the GIL for the heavy parts, so threads scale
+            _executor = ThreadPoolExecutor(max_workers=_max_concurrency, thread_name_prefix="filelocker")
+        return _executor
+
+def _get_slots() -> threading.BoundedSemaphore:
+    global _slots
+    with _executor_lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(_max_concurrency)
+        return _slots
+
+class AsyncOperation:
+    """
+    One running lock/unlock. Await it for the output path, iterate progress()
+    for percentages, call cancel() to stop it (the output gets rolled back).
+    """
+    def __init__(self, coro_factory: Callable[["AsyncOperation"], Any], control: OperationControl):
+        self.control = control
+        self._progress: asyncio.Queue = asyncio.Queue()
+        self._last_percent = -1
+        self._task = asyncio.ensure_future(coro_factory(self))
+
+    def _report(self, percent: float):
+        """Called on the event loop with progress from the worker thread."""
+        if int(percent) != self._last_percent:
+            self._last_percent = int(percent)
+            self._progress.put_nowait(percent)
+
+    async def progress(self) -> AsyncIterator[float]:
+        """Yield progress percentages until the operation finishes."""
+        while True:
+            percent = await self._progress.get()
+            if percent is None:
+                return
+            yield percent
+
+    def cancel(self):
+        self.control.cancel()
+
+    def done(self) -> bool:
+        return self._task.done()
+
+    def __await__(self):
+        return self._task.__await__()
+
+class AsyncEncryption:
+    """Async facade over Encryption, one instance can be shared by the whole service."""
+    def __init__(self, metrics_sink: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.metrics_sink = metrics_sink
+
+    def lock(self, path: str, password: str, control: Optional[OperationControl] = None) -> AsyncOperation:
+        return AsyncOperation(lambda op: self._run(op, path, password, "encrypt"), control or OperationControl())
+
+    def unlock(self, path: str, password: str, control: Optional[OperationControl] = None) -> AsyncOperation:
+        return AsyncOperation(lambda op: self._run(op, path, password, "decrypt"), control or OperationControl())
+
+    async def _run(self, op: AsyncOperation, path: str, password: str, action: str) -> str:
+        loop = asyncio.get_running_loop()
+
+        def report(percent: float):
+            loop.call_soon_threadsafe(op._report, percent)
+
+        def job() -> str:
+            with _get_slots():
+                if op.control.is_cancelled(): # cancelled while still queued
+                    raise OperationCancelled()
+                return work()
+
+        def work() -> str:
+            # A fresh engine per job keeps last_metrics meaningful under concurrency
+            encryption = Encryption(metrics_sink=self.metrics_sink)
+            op_type = encryption.get_operation_type(path)
+            if op_type is None:
+                raise OperationFailed(_("Item not found: {}").format(path))
+            if not op_type.startswith(action):
+                raise OperationFailed(_("Not a valid encrypted file or folder: {}").format(path)
+                                      if action == "decrypt" else _("Item is already locked: {}").format(path))
+            success, message = getattr(encryption, op_type)(path, password, report, control=op.control)
+            if not success:
+                if op.control.is_cancelled():
+                    raise OperationCancelled()
+                raise OperationFailed(message)
+            return encryption.get_output_path(path, op_type)
+
+        try:
+            return await loop.run_in_executor(get_executor(), job)
+        except asyncio.CancelledError:
+            # The task got cancelled, tell the worker so it rolls back. It keeps its
+            # slot until it has, a job that hadn't started yet never takes one.
+            op.control.cancel()
+            raise
+        finally:
+            op._progress.put_nowait(None)
+
+_default = AsyncEncryption()
+
+def lock(path: str, password: str, control: Optional[OperationControl] = None) -> AsyncOperation:
+    """Lock a file or folder, `await` the result to get the locked path."""
+    return _default.lock(path, password, control)
+
+def unlock(path: str, password: str, control: Optional[OperationControl] = None) -> AsyncOperation:
+    """Unlock a .locked file or .flka archive, `await` the result to get the restored path."""
+    return _default.unlock(path, password, control)
@@ -0,0 +1,143 @@
+"""
+AES-CBC backends for the bulk encryption work.
+
+Both crypto libraries we already depend on can do AES-CBC: pycryptodome and
+cryptography (OpenSSL). Which one is faster depends on the machine and how the
+wheels were built (AES-NI, pipelined CBC decryption in OpenSSL, ...), so on first
+use a quick benchmark picks the fastest available one for each direction. The
+`cipher_backend` setting can force one instead.
+
+It's plain AES-256-CBC either way, so the output is byte for byte the same no
+matter which backend wrote or reads it. Padding stays with the callers.
+"""
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from translate import _ # import for errors
+
+AUTO = 'auto'
+BENCHMARK_SIZE = 1024 * 1024
+BLOCK_SIZE = 16
+
+class PycryptodomeBackend:
+    name = 'pycryptodome'
+
+    def __init__(self):
+        from Crypto.Cipher import AES
+        self._aes = AES
+
+    def encryptor(self, key: bytes, iv: bytes):
+        return self._aes.new(key, self._aes.MODE_CBC, iv)
+
+    def decryptor(self, key: bytes, iv: bytes):
+        return self._aes.new(key, self._aes.MODE_CBC, iv)
+
+class _OpenSSLCipher:
+    """Gives a cryptography context the encrypt()/decrypt(data, output=) calls pycryptodome has."""
+    def __init__(self, context):
+        self._context = context
+
+    def _update(self, data, output=None):
+        result = self._context.update(data)
+        if output is None:
+            return result
+        memoryview(output).cast('B')[:len(result)] = result
+        return None
+
+    encrypt = _update
+    decrypt = _update
+
+class CryptographyBackend:
+    name = 'cryptography'
+
+    def __init__(self):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        self._cipher = Cipher
+        self._algorithms = algorithms
+        self._modes = modes
+
+    def _new(self, key: bytes, iv: bytes):
+        return self._cipher(self._algorithms.AES(key), self._modes.CBC(iv))
+
+    def encryptor(self, key: bytes, iv: bytes):
+        return _OpenSSLCipher(self._new(key, iv).encryptor())
+
+    def decryptor(self, key: bytes, iv: bytes):
+        return _OpenSSLCipher(self._new(key, iv).decryptor())
+
+BACKENDS = {backend.name: backend for backend in (PycryptodomeBackend, CryptographyBackend)}
+
+def available_backends() -> List[str]:
+    """Names of the backends whose library can be imported here."""
+    names = []
+    for name, backend in BACKENDS.items():
+        try:
+            backend()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def benchmark(size: int = BENCHMARK_SIZE, rounds: int = 3) -> Dict[str, Dict[str, float]]:
+    """MB/s for every available backend, {'pycryptodome': {'encrypt': ..., 'decrypt': ...}}."""
+    key = os.urandom(32)
+    iv = os.urandom(BLOCK_SIZE)
+    data = os.urandom(size - size % BLOCK_SIZE)
+    results = {}
+    for name in available_backends():
+        backend = BACKENDS[name]()
+        speeds = {}
+        for mode in ('encrypt', 'decrypt'):
+            best = None
+            for _round in range(rounds):
+                cipher = getattr(backend, mode + 'or')(key, iv)
+                start = time.perf_counter()
+                getattr(cipher, mode)(data)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            speeds[mode] = len(data) / (1024 * 1024) / max(best, 1e-9)
+        results[name] = speeds
+    return results
+
+class CipherSuite:
+    """The backend used for each direction. Encryption keeps one as `ciphers`."""
+    def __init__(self, encrypt_backend, decrypt_backend):
+        self.encrypt_backend = encrypt_backend
+        self.decrypt_backend = decrypt_backend
+
+    def encryptor(self, key: bytes, iv: bytes):
+        return self.encrypt_backend.encryptor(key, iv)
+
+    def decryptor(self, key: bytes, iv: bytes):
+        return self.decrypt_backend.decryptor(key, iv)
+
+    def describe(self) -> str:
+        if self.encrypt_backend.name == self.decrypt_backend.name:
+            return self.encrypt_backend.name
+        return "{} (encrypt), {} (decrypt)".format(self.encrypt_backend.name, self.decrypt_backend.name)
+
+_auto_suite: Optional[CipherSuite] = None
+_auto_lock = threading.Lock()
+
+def get_suite(preference: Optional[str] = AUTO) -> CipherSuite:
+    """
+    Suite for a backend name, or the benchmarked fastest one for 'auto'/None.
+    The benchmark runs once per process, the first time it's needed.
+    """
+    global _auto_suite
+    if preference and preference != AUTO:
+        if preference not in BACKENDS:
+            raise ValueError(_("Unknown cipher backend: {}").format(preference))
+        backend = BACKENDS[preference]()
+        return CipherSuite(backend, backend)
+
+    with _auto_lock:
+        if _auto_suite is None:
+            speeds = benchmark()
+            if not speeds:
+                raise ImportError(_("No AES backend available, install pycryptodome or cryptography."))
+            fastest = {mode: max(speeds, key=lambda name: speeds[name][mode]) for mode in ('encrypt', 'decrypt')}
+            _auto_suite = CipherSuite(BACKENDS[fastest['encrypt']](), BACKENDS[fastest['decrypt']]())
+        return _auto_suite
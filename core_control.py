@@ -0,0 +1,177 @@
+import ctypes
+import functools
+import inspect
+import os
+import platform
+import sys
+import threading
+import time
+from typing import Callable, Optional
+
+from translate import _ # import for errors
+
+class OperationCancelled(Exception):
+    """Raised from inside an operation once its control has been cancelled."""
+    def __init__(self, message: Optional[str] = None):
+        super().__init__(message or _("Operation cancelled."))
+
+class RateLimiter:
+    """Token bucket that keeps throughput under a number of bytes per second."""
+    def __init__(self, bytes_per_second: float, burst: Optional[float] = None):
+        self.rate = float(bytes_per_second)
+        # Allow about a quarter second worth of data to go through without waiting
+        self.capacity = float(burst if burst is not None else max(self.rate / 4, 64 * 1024))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int, wait: Optional[Callable] = None):
+        """
+        Take `amount` bytes out of the bucket, sleeping until enough tokens are available.
+        `wait` is called with the number of seconds to sleep, so callers can make the
+        sleep interruptible (e.g. threading.Event.wait).
+        """
+        if self.rate <= 0 or amount <= 0:
+            return
+        wait = wait or time.sleep
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            deficit = -self.tokens
+        if deficit > 0:
+            wait(deficit / self.rate)
+
+class OperationControl:
+    """
+    Cancel/pause token handed to an Encryption operation.
+    The operation calls checkpoint() between chunks; the owner (GUI, CLI, service)
+    calls cancel(), pause() and resume() from any thread.
+    """
+    def __init__(self, rate_limit_mb: float = 0, low_priority: bool = False):
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+        self.low_priority = low_priority
+        self.limiter = RateLimiter(rate_limit_mb * 1024 * 1024) if rate_limit_mb and rate_limit_mb > 0 else None
+
+    def cancel(self):
+        self._cancelled.set()
+        self._running.set() # wake up a paused operation so it can roll back
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def pause(self):
+        if not self.is_cancelled():
+            self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def is_paused(self) -> bool:
+        return not self._running.is_set()
+
+    def checkpoint(self, processed_bytes: int = 0):
+        """Block while paused, raise OperationCancelled if cancelled, then apply throttling."""
+        if not self._running.is_set():
+            self._running.wait()
+        if self._cancelled.is_set():
+            raise OperationCancelled()
+        if self.limiter:
+            self.limiter.consume(processed_bytes, wait=self._cancelled.wait)
+            if self._cancelled.is_set():
+                raise OperationCancelled()
+
+    def apply_priority(self):
+        """
+        Drop the calling thread to background CPU/IO priority if requested. Only for
+        threads the operation started itself (pool initializers), see in_background.
+        """
+        if self.low_priority:
+            _background.active = True
+            set_thread_background_priority()
+
+# Set on threads that already run at the lowered priority
+_background = threading.local()
+
+def in_background(operation):
+    """
+    Decorator for operations taking a control argument. A lowered priority can't be
+    raised again without privileges, so with control.low_priority set the operation
+    runs on a thread of its own that gets it, and the caller's thread (maybe a pool
+    worker that runs normal jobs next) keeps its priority. Blocks until it's done.
+    """
+    signature = inspect.signature(operation)
+
+    @functools.wraps(operation)
+    def wrapper(*args, **kwargs):
+        control = signature.bind_partial(*args, **kwargs).arguments.get('control')
+        if control is None or not control.low_priority or getattr(_background, 'active', False):
+            return operation(*args, **kwargs)
+        outcome = {}
+        def run():
+            control.apply_priority()
+            try:
+                outcome['result'] = operation(*args, **kwargs)
+            except BaseException as e:
+                outcome['error'] = e
+        thread = threading.Thread(target=run, name="filelocker-background", daemon=True)
+        thread.start()
+        thread.join()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+    return wrapper
+
+# Linux ioprio_set syscall numbers, they differ per architecture
+_IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'amd64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'arm64': 30,
+}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+
+def set_thread_background_priority() -> bool:
+    """
+    Lower CPU and disk priority of the calling thread only, so the rest of the
+    program (e.g. the GUI thread) stays responsive. Returns True if anything was applied.
+    This can't be undone without privileges, so only call it on worker threads.
+    """
+    try:
+        if sys.platform == 'win32':
+            THREAD_MODE_BACKGROUND_BEGIN = 0x00010000
+            kernel32 = ctypes.windll.kernel32
+            return bool(kernel32.SetThreadPriority(kernel32.GetCurrentThread(), THREAD_MODE_BACKGROUND_BEGIN))
+
+        if sys.platform.startswith('linux'):
+            applied = False
+            tid = threading.get_native_id()
+            try:
+                # On Linux the "process" priority of a tid only affects that thread
+                os.setpriority(os.PRIO_PROCESS, tid, 19)
+                applied = True
+            except OSError:
+                pass
+            syscall_nr = _IOPRIO_SET_SYSCALLS.get(platform.machine().lower())
+            if syscall_nr is not None:
+                libc = ctypes.CDLL(None, use_errno=True)
+                ioprio = _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT
+                if libc.syscall(syscall_nr, _IOPRIO_WHO_PROCESS, tid, ioprio) == 0:
+                    applied = True
+            return applied
+
+        if sys.platform == 'darwin':
+            PRIO_DARWIN_THREAD = 3
+            PRIO_DARWIN_BG = 0x1000
+            libc = ctypes.CDLL(None, use_errno=True)
+            return libc.setpriority(PRIO_DARWIN_THREAD, 0, PRIO_DARWIN_BG) == 0
+    except Exception:
+        pass
+    return False
@@ -0,0 +1,476 @@
+"""
+Local daemon: one long running File Locker process that takes jobs over a socket.
+
+Every CLI run otherwise pays for starting Python, importing the crypto libraries,
+loading the settings and, on its first job, benchmarking the AES and PBKDF2
+backends. `FileLocker daemon` does all of that once, then runs lock, unlock and
+verify jobs on a shared worker pool. While it's running the CLI hands those
+commands over to it, so a job costs a socket round trip plus the actual work.
+
+It listens on a Unix domain socket in a directory only the owner can open, or on
+127.0.0.1 with --tcp (and on systems without AF_UNIX). The address and a random
+token go into daemon.json in that directory and every request has to carry the
+token, so other users on the machine can't submit jobs through the TCP port.
+
+Requests and replies are single lines of JSON:
+
+    {"token": ..., "op": "lock", "path": ..., "password": ..., "options": {...}}
+        {"event": "accepted", "job": 1, "operation": "encrypt_file"}
+        {"event": "progress", "job": 1, "percent": 42.0}         repeated
+        {"event": "result", "job": 1, "path": ..., ...}          per item, unlocking a folder
+        {"event": "report", "job": 1, "path": ..., ...}          per file, verify
+        {"event": "done", "job": 1, "success": true, ...}
+    {"token": ..., "op": "status"}              -> {"event": "status", "jobs": [...]}
+    {"token": ..., "op": "cancel", "job": 1}    -> {"event": "ok"}
+    {"token": ..., "op": "ping"} / "shutdown"
+
+A lock/unlock/verify request with "detach": true gets its reply right after
+"accepted" and the job carries on, follow it with "status". Otherwise closing the
+connection cancels the job, which rolls back its output like Ctrl+C would.
+"""
+import hmac
+import json
+import os
+import secrets
+import select
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from translate import _ # import for errors
+from core_control import OperationControl
+
+STATE_FILE_NAME = 'daemon.json'
+SOCKET_NAME = 'daemon.sock'
+CONNECT_TIMEOUT = 0.5
+MAX_REQUEST_SIZE = 1024 * 1024
+# Finished jobs stay visible to "status" for this many seconds
+FINISHED_JOB_TTL = 3600
+# CLI options a job request can carry, the rest comes from the daemon's settings
+JOB_OPTIONS = ('workers', 'exclude', 'include', 'limit_mb', 'low_priority', 'stats', 'cipher_backend', 'io_mode')
+JOB_OPS = ('lock', 'unlock', 'verify')
+
+class DaemonError(Exception):
+    """The daemon refused a request, or went away in the middle of one."""
+
+def runtime_dir() -> str:
+    """Per-user directory for the socket and daemon.json."""
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    user = os.getuid() if hasattr(os, 'getuid') else os.environ.get('USERNAME', 'user')
+    return os.path.join(base, 'filelocker-{}'.format(user))
+
+def _private_dir() -> str:
+    path = runtime_dir()
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        info = os.stat(path)
+        if info.st_uid != os.getuid() or info.st_mode & 0o077:
+            raise DaemonError(_("{} must belong to you and be private (mode 700).").format(path))
+    return path
+
+def read_state() -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(runtime_dir(), STATE_FILE_NAME), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) and 'address' in state and 'token' in state else None
+    except (OSError, ValueError):
+        return None
+
+# --- client side ---
+
+class Connection:
+    """A connection to the running daemon, good for one request and its replies."""
+    def __init__(self, sock: socket.socket, token: str):
+        self._sock = sock
+        self._token = token
+        self._reader = sock.makefile('rb')
+
+    def request(self, op: str, **fields) -> Iterator[Dict[str, Any]]:
+        """Send a request and yield the replies until the daemon closes the connection."""
+        message = dict(fields, op=op, token=self._token)
+        try:
+            self._sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            for line in self._reader:
+                event = json.loads(line)
+                if event.get('event') == 'error':
+                    raise DaemonError(event.get('message'))
+                yield event
+        except (OSError, ValueError) as e:
+            raise DaemonError(_("Lost the connection to the daemon: {}").format(e))
+        finally:
+            self.close()
+
+    def close(self):
+        self._reader.close()
+        self._sock.close()
+
+def connect(timeout: float = CONNECT_TIMEOUT) -> Optional[Connection]:
+    """Connect to the running daemon, None if there isn't one."""
+    state = read_state()
+    if state is None:
+        return None
+    address = state['address']
+    try:
+        if isinstance(address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection((address[0], address[1]), timeout)
+    except (OSError, AttributeError, IndexError, TypeError):
+        return None # stale daemon.json, nothing listening any more
+    sock.settimeout(None)
+    return Connection(sock, state['token'])
+
+def call(op: str, **fields) -> Dict[str, Any]:
+    """One request with a single reply (ping, status, cancel, shutdown)."""
+    connection = connect()
+    if connection is None:
+        raise DaemonError(_("The File Locker daemon is not running."))
+    for event in connection.request(op, **fields):
+        return event
+    raise DaemonError(_("The daemon closed the connection without replying."))
+
+# --- server side ---
+
+class Job:
+    """A lock/unlock/verify running on the daemon's pool. Progress is kept as the latest percent only."""
+    def __init__(self, job_id: int, op: str, path: str, control: OperationControl):
+        self.id = job_id
+        self.op = op
+        self.path = path
+        self.control = control
+        self.operation: Optional[str] = None
+        self.state = 'queued'
+        self.percent = 0.0
+        self.success: Optional[bool] = None
+        self.message: Optional[str] = None
+        self.submitted = time.time()
+        self.finished: Optional[float] = None
+        self._events: List[Dict[str, Any]] = []
+        self._changed = threading.Condition()
+
+    def set_progress(self, percent: float):
+        with self._changed:
+            self.percent = percent
+            self._changed.notify_all()
+
+    def emit(self, event: Dict[str, Any]):
+        with self._changed:
+            self._events.append(dict(event, job=self.id))
+            self._changed.notify_all()
+
+    def finish(self, success: bool, message: Optional[str], **extra):
+        with self._changed:
+            self.state = 'done'
+            self.success = success
+            self.message = message
+            self.finished = time.time()
+            self._events.append(dict(extra, event='done', job=self.id, success=success, message=message,
+                                     cancelled=self.control.is_cancelled()))
+            self._changed.notify_all()
+
+    def wait(self, seen: int, timeout: float):
+        """(events after the first `seen`, current percent, whether it's finished), waiting for news up to timeout."""
+        with self._changed:
+            if len(self._events) == seen and self.state != 'done':
+                self._changed.wait(timeout)
+            return self._events[seen:], self.percent, self.state == 'done'
+
+    def describe(self) -> Dict[str, Any]:
+        return {'job': self.id, 'op': self.op, 'path': self.path, 'operation': self.operation,
+                'state': self.state, 'percent': round(self.percent, 1), 'success': self.success,
+                'message': self.message, 'submitted': self.submitted, 'finished': self.finished}
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon: Daemon = self.server.daemon
+        try:
+            request = json.loads(self.rfile.readline(MAX_REQUEST_SIZE))
+        except ValueError:
+            return self.send({'event': 'error', 'message': _("Malformed request.")})
+        if not isinstance(request, dict) or not hmac.compare_digest(str(request.get('token', '')), daemon.token):
+            return self.send({'event': 'error', 'message': _("Not authorized.")})
+        try:
+            daemon.handle(request, self.send, self.connection)
+        except OSError:
+            pass # the client went away
+
+    def send(self, event: Dict[str, Any]):
+        self.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+
+def _client_gone(connection: socket.socket) -> bool:
+    readable, _writable, _error = select.select([connection], [], [], 0)
+    return bool(readable) and not connection.recv(1, socket.MSG_PEEK)
+
+class Daemon:
+    """
+    The server. Jobs get a fresh Encryption each (they keep per-operation state), but
+    everything expensive is per process and stays warm: imports, the backend and
+    KDF benchmarks, the settings and the metrics log.
+    """
+    def __init__(self, settings, workers: Optional[int] = None, tcp_port: Optional[int] = None):
+        self.settings = settings
+        self.workers = workers or os.cpu_count() or 4
+        self.tcp_port = tcp_port
+        self.token = secrets.token_hex(32)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="filelocker-job")
+        # Low priority jobs get workers of their own that stay at background priority, a
+        # lowered thread can't be raised again, so it must never run a normal job after that
+        self.background_pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="filelocker-background-job",
+                                                  initializer=OperationControl(low_priority=True).apply_priority)
+        self.stopping = False
+        self.jobs: Dict[int, Job] = {}
+        self.server: Optional[socketserver.BaseServer] = None
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._settings_mtime = self._mtime()
+        self._log_sink: Optional[Callable] = None
+
+    def _mtime(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.settings.settings_file)
+        except OSError:
+            return None
+
+    def current_settings(self):
+        """The settings, reloaded if settings.config changed since the last job."""
+        with self._lock:
+            mtime = self._mtime()
+            if mtime != self._settings_mtime:
+                self.settings.settings = self.settings.load_settings()
+                self._settings_mtime = mtime
+            return self.settings
+
+    def warm_up(self):
+        """Pay for the imports and backend benchmarks now instead of in the first job."""
+        import core_cipher
+        import core_kdf
+        import core_encryption # noqa: F401
+        import core_archive # noqa: F401
+        core_cipher.get_suite(self.settings.get('cipher_backend'))
+        core_kdf.engine_names()
+
+    # --- serving ---
+
+    def serve_forever(self, on_ready: Optional[Callable[[Any], None]] = None):
+        directory = _private_dir()
+        if connect() is not None:
+            raise DaemonError(_("A File Locker daemon is already running."))
+        if self.tcp_port is not None or not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+            server = socketserver.ThreadingTCPServer(('127.0.0.1', self.tcp_port or 0), _Handler, bind_and_activate=False)
+            server.allow_reuse_address = True
+            server.server_bind()
+            server.server_activate()
+            address: Any = list(server.server_address[:2])
+        else:
+            address = os.path.join(directory, SOCKET_NAME)
+            if os.path.exists(address):
+                os.remove(address) # left behind by a daemon that didn't shut down cleanly
+            server = socketserver.ThreadingUnixStreamServer(address, _Handler)
+            os.chmod(address, 0o600)
+        server.daemon_threads = True
+        server.daemon = self
+        self.server = server
+
+        state_path = os.path.join(directory, STATE_FILE_NAME)
+        fd = os.open(state_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'address': address, 'token': self.token, 'pid': os.getpid()}, f)
+        try:
+            if on_ready:
+                on_ready(address)
+            server.serve_forever(poll_interval=0.5)
+        finally:
+            server.server_close()
+            state = read_state()
+            if state is not None and state.get('token') == self.token:
+                os.remove(state_path)
+            if isinstance(address, str) and os.path.exists(address):
+                os.remove(address)
+
+    def stop(self, cancel_jobs: bool = False):
+        """Stop taking requests and wait for the jobs, cancelling them first if asked to."""
+        with self._lock:
+            self.stopping = True
+            if cancel_jobs:
+                for job in self.jobs.values():
+                    job.control.cancel()
+        if self.server:
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+        self.pool.shutdown(wait=True)
+        self.background_pool.shutdown(wait=True)
+
+    def handle(self, request: Dict[str, Any], send: Callable[[Dict[str, Any]], None], connection: socket.socket):
+        op = request.get('op')
+        if op == 'ping':
+            with self._lock:
+                running = sum(1 for job in self.jobs.values() if job.state != 'done')
+            send({'event': 'pong', 'pid': os.getpid(), 'workers': self.workers, 'running': running})
+        elif op == 'status':
+            with self._lock:
+                self._forget_old_jobs()
+                jobs = [job.describe() for job in self.jobs.values()
+                        if request.get('job') is None or job.id == request.get('job')]
+            send({'event': 'status', 'jobs': jobs})
+        elif op == 'cancel':
+            job = self.jobs.get(request.get('job'))
+            if job is None:
+                return send({'event': 'error', 'message': _("No such job.")})
+            job.control.cancel()
+            send({'event': 'ok'})
+        elif op == 'shutdown':
+            send({'event': 'ok'})
+            threading.Thread(target=self.stop, daemon=True).start()
+        elif op in JOB_OPS:
+            self._run_request(request, send, connection)
+        else:
+            send({'event': 'error', 'message': _("Unknown request: {}").format(op)})
+
+    def _forget_old_jobs(self):
+        cutoff = time.time() - FINISHED_JOB_TTL
+        for job_id in [job.id for job in self.jobs.values() if job.finished and job.finished < cutoff]:
+            del self.jobs[job_id]
+
+    def _run_request(self, request: Dict[str, Any], send, connection: socket.socket):
+        path = request.get('path')
+        options = request.get('options') or {}
+        if not isinstance(path, str) or not os.path.isabs(path) or not isinstance(options, dict):
+            return send({'event': 'error', 'message': _("Malformed request.")})
+        if not os.path.exists(path):
+            return send({'event': 'error', 'message': _("The specified path does not exist: {}").format(path)})
+        if request['op'] != 'verify' and not request.get('password'):
+            return send({'event': 'error', 'message': _("Password cannot be empty.")})
+
+        settings = self.current_settings()
+        rate_limit = options.get('limit_mb')
+        low_priority = options.get('low_priority')
+        control = OperationControl(
+            rate_limit_mb=rate_limit if rate_limit is not None else settings.get('io_rate_limit_mb'),
+            low_priority=low_priority if low_priority is not None else settings.get('low_priority_mode'))
+        with self._lock:
+            if self.stopping:
+                return send({'event': 'error', 'message': _("The daemon is shutting down.")})
+            self._forget_old_jobs()
+            job = Job(self._next_id, request['op'], path, control)
+            self._next_id += 1
+            self.jobs[job.id] = job
+        job.operation = self._operation(job)
+        pool = self.background_pool if control.low_priority else self.pool
+        try:
+            pool.submit(self._run_job, job, request.get('password'), options)
+        except RuntimeError: # shut down in the meantime
+            job.finish(False, _("The daemon is shutting down."))
+            return send({'event': 'error', 'message': job.message})
+        send({'event': 'accepted', 'job': job.id, 'operation': job.operation})
+        if request.get('detach'):
+            return
+
+        # Follow the job until it's done, and cancel it if the client hangs up
+        seen, last_percent = 0, None
+        try:
+            while True:
+                events, percent, finished = job.wait(seen, 0.25)
+                if int(percent) != last_percent and not finished:
+                    last_percent = int(percent)
+                    send({'event': 'progress', 'job': job.id, 'percent': percent})
+                for event in events:
+                    send(event)
+                seen += len(events)
+                if finished:
+                    return
+                if _client_gone(connection):
+                    job.control.cancel()
+                    return
+        except OSError:
+            job.control.cancel()
+            raise
+
+    def _operation(self, job: Job) -> Optional[str]:
+        """What the job will do, the same names as Encryption.get_operation_type() (plus unlock_tree/verify)."""
+        if job.op == 'verify':
+            return 'verify'
+        if job.op == 'lock':
+            return 'encrypt_folder' if os.path.isdir(job.path) else 'encrypt_file'
+        if os.path.isdir(job.path):
+            return 'unlock_tree'
+        from core_encryption import Encryption
+        op_type = Encryption().get_operation_type(job.path)
+        return op_type if op_type and op_type.startswith('decrypt') else None
+
+    def _encryption(self, job: Job, options: Dict[str, Any]):
+        from core_encryption import Encryption
+        from core_metrics import create_log_sink
+        from core_walk import PathFilter
+
+        settings = self.current_settings()
+        if settings.get('metrics_log_enabled') and self._log_sink is None:
+            self._log_sink = create_log_sink()
+        encryption = Encryption(metrics_sink=self._log_sink if settings.get('metrics_log_enabled') else None,
+                                workers=options.get('workers') or settings.get('folder_workers') or None,
+                                cipher_backend=options.get('cipher_backend') or settings.get('cipher_backend'),
+                                kdf_algorithm=settings.get('kdf_algorithm'),
+                                kdf_cost=settings.get('kdf_cost'),
+                                io_mode=options.get('io_mode') or settings.get('io_mode'))
+        if job.op == 'lock':
+            encryption.path_filter = PathFilter.from_settings(settings, options.get('exclude') or [], options.get('include') or [])
+        return encryption
+
+    def _run_job(self, job: Job, password: Optional[str], options: Dict[str, Any]):
+        job.state = 'running'
+        try:
+            encryption = self._encryption(job, options)
+            stats = lambda: encryption.last_metrics.summary() if options.get('stats') and encryption.last_metrics else None
+            if job.operation == 'verify':
+                self._verify(job, encryption, stats)
+            elif job.operation == 'unlock_tree':
+                import core_header
+                unlocked, failures = core_header.unlock_tree(
+                    encryption, job.path, password, workers=options.get('workers'), control=job.control,
+                    on_result=lambda path, success, message: job.emit(
+                        {'event': 'result', 'path': path, 'success': success, 'message': message}))
+                job.finish(not failures and not job.control.is_cancelled(), None, unlocked=unlocked, failed=len(failures))
+            elif job.operation is None:
+                job.finish(False, _("Not a valid encrypted file or folder: {}").format(job.path))
+            else:
+                success, message = getattr(encryption, job.operation)(
+                    job.path, password, progress_callback=job.set_progress, control=job.control)
+                job.finish(success, message, stats=stats())
+        except Exception as e:
+            job.finish(False, str(e))
+
+    def _verify(self, job: Job, encryption, stats: Callable[[], Optional[str]]):
+        from core_header import find_locked_files
+
+        for path in find_locked_files(encryption, job.path):
+            report, message = encryption.verify_file(path, progress_callback=job.set_progress, control=job.control)
+            if job.control.is_cancelled():
+                break
+            job.emit({'event': 'report', 'path': path, 'message': message, 'stats': stats(),
+                      'report': None if report is None else {
+                          'chunks': report.chunks, 'chunk_size': report.chunk_size, 'intact': report.intact,
+                          'damaged': report.damaged, 'tree_damaged': report.tree_damaged}})
+        job.finish(not job.control.is_cancelled(), None)
+
+def serve(settings, workers: Optional[int] = None, tcp_port: Optional[int] = None,
+          on_ready: Optional[Callable[[Any], None]] = None):
+    """Run a daemon in the foreground until shut down (or Ctrl+C, which cancels the running jobs)."""
+    daemon = Daemon(settings, workers, tcp_port)
+    daemon.warm_up()
+    if sys.platform != 'win32':
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+            target=daemon.stop, kwargs={'cancel_jobs': True}, daemon=True).start())
+    try:
+        daemon.serve_forever(on_ready)
+    except KeyboardInterrupt:
+        daemon.stop(cancel_jobs=True)
@@ -1,19 +1,50 @@
 from Crypto.Cipher import AES
-from Crypto.Protocol.KDF import PBKDF2
-from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad, unpad
 import base64
 import os
 import shutil
 import io
 import zipfile
-from pathlib import Path
-from typing import Callable, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 from translate import _ # import for errors
+from core_control import OperationControl, OperationCancelled, in_background
+from core_metrics import OperationMetrics
+import core_cipher
+import core_kdf
+import core_stream
+import core_legacy
+import core_header
+import core_archive
+import core_io
+import core_merkle
+import core_space
+import core_sparse
+from core_header import KdfParams, LockHeader
+import core_walk
+import core_watch
+from core_archive import ArchiveEntry, ArchiveReader, ArchiveWriter
+from core_walk import PathFilter
+
+class PasswordMatch(NamedTuple):
+    """A candidate find_password() found to fit, key ready for the decrypt methods' key=."""
+    password: str
+    key: bytes
+    # False for v1 files, where only the padding could be checked: about 1 in 256 wrong
+    # passwords fit as well, and without a MAC no amount of decrypting can tell them apart
+    exact: bool
 
 class Encryption:
-    def __init__(self):
+    def __init__(self,
+                 metrics_sink: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 workers: Optional[int] = None,
+                 path_filter: Optional[PathFilter] = None,
+                 cipher_backend: Optional[str] = None,
+                 kdf_algorithm: Optional[str] = None,
+                 kdf_cost: int = 0,
+                 io_mode: Optional[str] = None):
         self.salt_length = 32
         self.iv_length = 16
         self.key_length = 32
@@ -21,14 +52,140 @@ class Encryption:
         self.chunk_size = 64 * 1024  # 64KB chunks
         self.file_magic = b'FLCK'
         self.folder_magic = b'FLKA' # File Locker Archive
+        self.metrics_sink = metrics_sink
+        self.workers = workers # threads used for folder archives, None = one per CPU core
+        self.path_filter = path_filter # exclude/include rules applied when locking folders
+        self.cipher_backend = cipher_backend # 'pycryptodome', 'cryptography' or None/'auto' for the fastest
+        self._ciphers: Optional[core_cipher.CipherSuite] = None
+        self._ciphers_for: Optional[str] = None
+        # KDF for newly locked v2 items, stored in each header (see core_header.KDF_NAMES)
+        self.kdf_algorithm = kdf_algorithm or 'pbkdf2-sha1'
+        self.kdf_cost = kdf_cost # iterations, or n for scrypt, 0 = the algorithm's default
+        self.io_mode = io_mode # how single files are read/written, see core_io.MODES
+        self.last_metrics: Optional[OperationMetrics] = None
+
+    @property
+    def ciphers(self) -> "core_cipher.CipherSuite":
+        """AES-CBC backends in use, picked on first use (see core_cipher)."""
+        if self._ciphers is None or self._ciphers_for != self.cipher_backend:
+            self._ciphers = core_cipher.get_suite(self.cipher_backend)
+            self._ciphers_for = self.cipher_backend
+        return self._ciphers
+
+    def new_kdf_params(self) -> KdfParams:
+        """KDF parameters with a fresh salt for something about to be locked."""
+        return KdfParams.from_name(self.kdf_algorithm, self.kdf_cost)
 
     def generate_key(self, password: str, salt: bytes) -> bytes:
-        return PBKDF2(
-            password.encode(),
-            salt,
-            dkLen=self.key_length,
-            count=self.iterations
-        )
+        # PBKDF2-HMAC-SHA1, which is what pycryptodome's PBKDF2 defaulted to for FLCK/FLKA
+        return core_kdf.pbkdf2(core_kdf.PBKDF2_SHA1, password.encode(), salt, self.iterations, self.key_length)
+
+    def derive_file_key(self, path: str, password: str) -> bytes:
+        """
+        Run the KDF for one locked item without touching its content: the v2 key-encryption
+        key, the v1 content key or the legacy key pair, depending on the header. Pass the
+        result as key= to the decrypt methods. Raises ValueError if it isn't locked.
+        """
+        with open(path, 'rb') as f:
+            magic = f.read(4)
+            if magic in core_header.MAGICS:
+                return LockHeader.read(f, magic).kdf.derive(password)
+            if magic in (self.file_magic, self.folder_magic):
+                return self.generate_key(password, f.read(self.salt_length))
+        if core_legacy.is_legacy_file(path):
+            with open(path, 'rb') as f:
+                return core_legacy.derive_legacy_key(password, f.read(core_legacy.SALT_LENGTH))
+        raise ValueError(_("Not a valid encrypted file or folder: {}").format(path))
+
+    def _password_check(self, path: str) -> Tuple[Callable[[str], Optional[bytes]], bool]:
+        """
+        Read what it takes to test passwords against a locked item, once. Returns a function
+        giving the derive_file_key() result for a password that fits (or None), and whether
+        that check is exact. v2 headers have an exact check (the wrapped key's GCM tag) and
+        legacy files their HMAC. v1 files only have their padding, plus the zip signature
+        for folder archives, which makes those exact enough.
+        """
+        with open(path, 'rb') as f:
+            magic = f.read(4)
+            if magic in core_header.MAGICS:
+                header = LockHeader.read(f, magic)
+
+                def check(password: str) -> Optional[bytes]:
+                    kek = header.kdf.derive(password)
+                    try:
+                        header.unwrap_with_kek(kek)
+                    except ValueError:
+                        return None
+                    return kek
+                return check, True
+
+            if magic in (self.file_magic, self.folder_magic):
+                salt = f.read(self.salt_length)
+                iv = f.read(self.iv_length)
+                first = f.read(AES.block_size)
+                body_size = os.path.getsize(path) - len(magic) - len(salt) - len(iv)
+                if not first or body_size % AES.block_size:
+                    raise ValueError(_("Incorrect password or corrupted file."))
+                # The last block decrypts with the block before it (or the iv) as its iv
+                previous = iv
+                if body_size > AES.block_size:
+                    f.seek(-2 * AES.block_size, os.SEEK_END)
+                    previous = f.read(AES.block_size)
+                last = f.read(AES.block_size) if body_size > AES.block_size else first
+                is_archive = magic == self.folder_magic
+
+                def check(password: str) -> Optional[bytes]:
+                    key = self.generate_key(password, salt)
+                    try:
+                        unpad(self.ciphers.decryptor(key, previous).decrypt(last), AES.block_size)
+                    except ValueError:
+                        return None
+                    if is_archive and not self.ciphers.decryptor(key, iv).decrypt(first).startswith((b'PK\x03\x04', b'PK\x05\x06')):
+                        return None
+                    return key
+                return check, is_archive
+
+        if core_legacy.is_legacy_file(path):
+            return core_legacy.legacy_password_check(path, self.ciphers), True
+        raise ValueError(_("Not a valid encrypted file or folder: {}").format(path))
+
+    def find_password(self,
+                      path: str,
+                      candidates: List[str],
+                      workers: Optional[int] = None,
+                      control: Optional[OperationControl] = None) -> List[PasswordMatch]:
+        """
+        Try candidate passwords against a locked item on a thread pool, using only its
+        header (and a block or two). Nothing is written. Returns the candidates that fit,
+        in the order they were given: the first one is tried on its own before the rest,
+        and with an exact check the search stops at the first fit. With an inexact one
+        (v1 files) every candidate gets tried, and more than one match means the right
+        password can't be told apart, so callers must not unlock with any of them.
+        """
+        check, exact = self._password_check(path)
+        candidates = list(dict.fromkeys(candidate for candidate in candidates if candidate))
+        if not candidates:
+            return []
+        key = check(candidates[0])
+        matches = [PasswordMatch(candidates[0], key, exact)] if key else []
+        if matches and exact:
+            return matches
+        found = {}
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4) as pool:
+            futures = {pool.submit(check, candidate): index for index, candidate in enumerate(candidates[1:], 1)}
+            try:
+                for future in as_completed(futures):
+                    if control:
+                        control.checkpoint()
+                    key = future.result()
+                    if key:
+                        found[futures[future]] = key
+                        if exact:
+                            break
+            finally:
+                for future in futures:
+                    future.cancel()
+        return matches + [PasswordMatch(candidates[index], found[index], exact) for index in sorted(found)]
 
     def get_operation_type(self, path: str) -> Optional[str]:
         """Check if a path is an encrypted file, folder, or neither."""
@@ -36,218 +193,869 @@ class Encryption:
             return None
         if os.path.isdir(path):
             return "encrypt_folder"
-        
+
         try:
             with open(path, 'rb') as f:
                 magic = f.read(4)
-                if magic == self.file_magic:
+                if magic in (self.file_magic, core_header.FILE_MAGIC):
                     return "decrypt_file"
-                if magic == self.folder_magic:
+                if magic in (self.folder_magic, core_header.FOLDER_MAGIC, core_header.ARCHIVE_MAGIC):
                     return "decrypt_folder"
         except IOError:
             return None # Can't read file
-            
+
+        # Files from the old core.py engine have no magic, just salt + Fernet token
+        if path.endswith('.locked') and core_legacy.is_legacy_file(path):
+            return "decrypt_legacy_file"
+
         # If no magic bytes, assume it's a regular file to be encrypted
         return "encrypt_file"
 
+    def get_output_path(self, path: str, op_type: str) -> str:
+        """Where an operation of the given type writes its result."""
+        if op_type == "encrypt_file":
+            return path + '.locked'
+        if op_type == "encrypt_folder":
+            return path + '.flka'
+        if op_type in ("decrypt_file", "decrypt_legacy_file"):
+            return path[:-7] if path.endswith('.locked') else path + '.unlocked'
+        if op_type == "decrypt_folder":
+            return path[:-5] if path.endswith('.flka') else path
+        return path
+
+    def open(self, path: str, mode: str, password: str):
+        """
+        Open a locked file as a streaming file object. 'rb' gives the decrypted content of
+        an existing locked file, 'wb' creates a locked file from whatever gets written.
+        No plaintext ever touches the disk. Files written this way have no Merkle tree
+        for verify(), there's no knowing how much room to leave for it. If the with
+        block around a 'wb' file raises, the half written file is removed.
+        """
+        if mode in ('r', 'rb'):
+            raw = open(path, 'rb')
+            try:
+                return io.BufferedReader(core_stream.LockedFileReader(raw, self, password), self.chunk_size)
+            except Exception:
+                raw.close()
+                raise
+        if mode in ('w', 'wb'):
+            raw = open(path, 'wb')
+            try:
+                return core_stream.LockedBufferedWriter(core_stream.LockedFileWriter(raw, self, password), self.chunk_size)
+            except Exception:
+                raw.close()
+                raise
+        raise ValueError(_("Unsupported mode: {}").format(mode))
+
+    def locked_size(self, plaintext_size: int) -> int:
+        """
+        Size of locked bytes (encrypt_bytes, encrypt_into, open) for a plaintext of the
+        given size. Those carry no Merkle tree, encrypt_file adds one on top, see
+        core_merkle.tree_size.
+        """
+        return core_stream.locked_size(self, plaintext_size)
+
+    def encrypt_into(self, data, out, password: str) -> int:
+        """Lock a bytes-like object into a preallocated buffer, see core_stream.encrypt_into."""
+        return core_stream.encrypt_into(self, data, out, password)
+
+    def decrypt_into(self, data, out, password: str) -> int:
+        """Unlock locked bytes into a preallocated buffer, see core_stream.decrypt_into."""
+        return core_stream.decrypt_into(self, data, out, password)
+
+    def encrypt_bytes(self, data, password: str) -> bytes:
+        out = bytearray(self.locked_size(len(memoryview(data).cast('B'))))
+        size = self.encrypt_into(data, out, password)
+        return bytes(out[:size])
+
+    def decrypt_bytes(self, data, password: str) -> bytes:
+        out = bytearray(len(data))
+        size = self.decrypt_into(data, out, password)
+        del out[size:]
+        return bytes(out)
+
+    def _start_metrics(self, operation: str, path: str) -> OperationMetrics:
+        metrics = OperationMetrics(operation, path)
+        self.last_metrics = metrics
+        return metrics
+
+    def _finish_metrics(self, metrics: OperationMetrics, success: bool, error: Optional[str] = None) -> Tuple[bool, Optional[str]]:
+        """Close the metrics record, hand it to the sink and build the usual result tuple."""
+        metrics.finish(success, error)
+        if self.metrics_sink:
+            try:
+                self.metrics_sink(metrics.as_dict())
+            except Exception:
+                pass # a broken sink must never fail the actual operation
+        return success, error
+
+    def _encrypt_chunks(self,
+                        in_stream,
+                        out_stream,
+                        cipher,
+                        metrics: OperationMetrics,
+                        control: Optional[OperationControl] = None,
+                        progress_callback: Optional[Callable[[float], None]] = None,
+                        total_size: Optional[int] = None) -> int:
+        """
+        Encrypt everything in in_stream until it runs dry. The last block is found by
+        reading one chunk ahead, so the input doesn't need a known size or to be seekable.
+        total_size is only used for progress. Returns the number of plaintext bytes.
+        """
+        processed = 0
+        leftover = b''
+        with metrics.phase('read'):
+            chunk = in_stream.read(self.chunk_size)
+        while True:
+            with metrics.phase('read'):
+                next_chunk = in_stream.read(self.chunk_size) if chunk else b''
+
+            if control:
+                control.checkpoint(len(chunk))
+            processed += len(chunk)
+            metrics.count('bytes_read', len(chunk))
+            metrics.count('chunks')
+
+            data = leftover + chunk if leftover else chunk
+            if next_chunk:
+                # Pipes can hand us short reads, only encrypt whole blocks until the end
+                cut = len(data) - len(data) % AES.block_size
+                leftover = data[cut:]
+                data = data[:cut]
+            else:
+                data = pad(data, AES.block_size)
+
+            with metrics.phase('cipher'):
+                encrypted_chunk = cipher.encrypt(data)
+            with metrics.phase('write'):
+                out_stream.write(encrypted_chunk)
+            metrics.count('bytes_written', len(encrypted_chunk))
+
+            if not next_chunk:
+                break
+            chunk = next_chunk
+
+            if progress_callback and total_size:
+                progress_callback(min((processed / total_size) * 100, 100.0))
+        return processed
+
+    def _decrypt_chunks(self,
+                        in_stream,
+                        out_stream,
+                        cipher,
+                        metrics: OperationMetrics,
+                        control: Optional[OperationControl] = None,
+                        progress_callback: Optional[Callable[[float], None]] = None,
+                        total_size: Optional[int] = None) -> int:
+        """
+        Decrypt everything in in_stream until it runs dry, stripping the padding when the
+        stream ends. Like _encrypt_chunks it reads one chunk ahead instead of relying on
+        the file size. Returns the number of ciphertext bytes consumed.
+        """
+        processed = 0
+        leftover = b''
+        with metrics.phase('read'):
+            chunk = in_stream.read(self.chunk_size)
+        while chunk:
+            with metrics.phase('read'):
+                next_chunk = in_stream.read(self.chunk_size)
+
+            if control:
+                control.checkpoint(len(chunk))
+            processed += len(chunk)
+            metrics.count('bytes_read', len(chunk))
+            metrics.count('chunks')
 
-    def encrypt_file(self, 
-                    input_path: str, 
-                    password: str, 
-                    progress_callback: Optional[Callable[[float], None]] = None) -> Tuple[bool, Optional[str]]:
+            data = leftover + chunk if leftover else chunk
+            cut = len(data) - len(data) % AES.block_size
+            leftover = data[cut:]
+            data = data[:cut]
+            if not next_chunk and leftover:
+                raise ValueError(_("Incorrect password or corrupted file."))
+
+            with metrics.phase('cipher'):
+                decrypted_chunk = cipher.decrypt(data)
+
+            if not next_chunk:
+                try:
+                    decrypted_chunk = unpad(decrypted_chunk, AES.block_size)
+                except ValueError:
+                    raise ValueError(_("Incorrect password or corrupted file."))
+
+            with metrics.phase('write'):
+                out_stream.write(decrypted_chunk)
+            metrics.count('bytes_written', len(decrypted_chunk))
+
+            chunk = next_chunk
+            if progress_callback and total_size:
+                progress_callback(min((processed / total_size) * 100, 100.0))
+        return processed
+
+    def _create_file_header(self,
+                            password: str,
+                            metrics: OperationMetrics,
+                            folder: bool = False,
+                            new_key: Optional[Tuple[KdfParams, bytes]] = None):
+        """
+        New v2 header (FLC2, or FLA2 for folders) and the cipher for the content that goes
+        with it. new_key is an already derived (KdfParams, key) for password.
+        """
+        magic = core_header.FOLDER_MAGIC if folder else core_header.FILE_MAGIC
+        with metrics.phase('kdf'):
+            header, content_key = LockHeader.create(magic, password, *(new_key or (self.new_kdf_params(),)))
+        return header, self.ciphers.encryptor(content_key, header.content_iv)
+
+    def _write_file_header(self,
+                           out_stream,
+                           password: str,
+                           metrics: OperationMetrics,
+                           folder: bool = False,
+                           new_key: Optional[Tuple[KdfParams, bytes]] = None):
+        """Write a new v2 header and return the cipher for the content that follows."""
+        header, cipher = self._create_file_header(password, metrics, folder, new_key)
+        packed = header.pack()
+        out_stream.write(packed)
+        metrics.count('bytes_written', len(packed))
+        return cipher
+
+    def _read_file_header(self,
+                          in_stream,
+                          password: str,
+                          metrics: OperationMetrics,
+                          folder: bool = False,
+                          key: Optional[bytes] = None):
+        """
+        Read and check a v1 or v2 header, return the cipher for the content that follows.
+        key is what derive_file_key() returned for this file, it saves running the KDF here.
+        For callers that can't recreate holes, so sparse files are refused.
+        """
+        cipher, header = self._read_header(in_stream, password, metrics, folder, key)
+        if core_sparse.map_length(header) is not None:
+            raise ValueError(_("This file was locked as a sparse file, unlock it as a file instead."))
+        return cipher
+
+    def _read_header(self,
+                     in_stream,
+                     password: str,
+                     metrics: OperationMetrics,
+                     folder: bool = False,
+                     key: Optional[bytes] = None):
+        """Like _read_file_header, but returns (cipher, v2 header or None for v1)."""
+        magic = in_stream.read(4)
+        v1_magic, v2_magic = (self.folder_magic, core_header.FOLDER_MAGIC) if folder else (self.file_magic, core_header.FILE_MAGIC)
+
+        if magic == v2_magic:
+            header = LockHeader.read(in_stream, magic)
+            metrics.count('bytes_read', header.data_offset)
+            with metrics.phase('kdf'):
+                content_key = header.unwrap_with_kek(key) if key else header.unwrap(password)
+            return self.ciphers.decryptor(content_key, header.content_iv), header
+
+        if magic != v1_magic:
+            if folder:
+                raise ValueError(_("Not a valid locked folder archive or incorrect password"))
+            raise ValueError(_("Not a valid locked file or incorrect password"))
+
+        # v1: the content key is derived straight from the password
+        salt = in_stream.read(self.salt_length)
+        iv = in_stream.read(self.iv_length)
+        metrics.count('bytes_read', len(magic) + len(salt) + len(iv))
+
+        if not key:
+            with metrics.phase('kdf'):
+                key = self.generate_key(password, salt)
+        return self.ciphers.decryptor(key, iv), None
+
+    @in_background
+    def encrypt_file(self,
+                    input_path: str,
+                    password: str,
+                    progress_callback: Optional[Callable[[float], None]] = None,
+                    control: Optional[OperationControl] = None,
+                    new_key: Optional[Tuple[KdfParams, bytes]] = None) -> Tuple[bool, Optional[str]]:
+        """
+        Lock a file into input_path + '.locked' and remove the original. new_key is an
+        already derived (KdfParams, key) for password, so batches can skip the KDF.
+        The header gets a Merkle tree of the content for verify() (see core_merkle), and
+        of a sparse file only the data gets locked (see core_sparse).
+        """
         output_path = input_path + '.locked'
+        metrics = self._start_metrics("encrypt_file", input_path)
         try:
-            salt = get_random_bytes(self.salt_length)
-            iv = get_random_bytes(self.iv_length)
-            
-            key = self.generate_key(password, salt)
-            cipher = AES.new(key, AES.MODE_CBC, iv)
-
             file_size = os.path.getsize(input_path)
-            processed = 0
-            
-            with open(input_path, 'rb') as in_file, open(output_path, 'wb') as out_file:
-                out_file.write(self.file_magic)
-                out_file.write(salt)
-                out_file.write(iv)
-                
-                while True:
-                    chunk = in_file.read(self.chunk_size)
-                    if not chunk:
-                        break
-                    
-                    processed += len(chunk)
-                    
-                    if processed >= file_size:
-                        chunk = pad(chunk, AES.block_size)
-                        out_file.write(cipher.encrypt(chunk))
-                        break
-                    
-                    encrypted_chunk = cipher.encrypt(chunk)
-                    out_file.write(encrypted_chunk)
-                    
-                    if progress_callback:
-                        progress_callback((processed / file_size) * 100)
-
-            os.remove(input_path)
-            return True, None
+
+            with core_io.open_input(input_path, self.io_mode) as in_file:
+                source, plain_size = in_file, file_size
+                with metrics.phase('scan'):
+                    extents = core_sparse.data_extents(in_file, file_size)
+                if extents is not None:
+                    source = core_sparse.ExtentReader(in_file, file_size, extents)
+                    plain_size = source.packed_size
+                    metrics.count('bytes_skipped', file_size - plain_size)
+
+                content_size = (plain_size // AES.block_size + 1) * AES.block_size
+                tree_area = core_merkle.tree_size(core_merkle.leaf_count(content_size))
+                # The original stays until the locked copy is complete, so all of it has to fit
+                output_size = self.locked_size(plain_size) + tree_area
+                core_space.check_space(output_path, output_size)
+
+                with core_io.open_output(output_path, self.io_mode) as out_file:
+                    core_space.preallocate(out_file, output_size)
+                    header, cipher = self._create_file_header(password, metrics, new_key=new_key)
+                    if extents is not None:
+                        header.fields[core_header.TAG_SPARSE] = core_sparse.pack_field(source.map_size)
+                    # Room for the tree between the fields and the content, filled in at the end
+                    header.header_size += tree_area
+                    packed = header.pack() + bytes(tree_area)
+                    out_file.write(packed)
+                    metrics.count('bytes_written', len(packed))
+                    tree = core_merkle.TreeBuilder(out_file)
+                    self._encrypt_chunks(source, tree, cipher, metrics, control, progress_callback, plain_size)
+                    out_file.truncate() # in case the input changed size under us
+
+            with metrics.phase('write'):
+                core_merkle.store_tree(output_path, header, tree.finish())
+
+            with metrics.phase('cleanup'):
+                os.remove(input_path)
+            return self._finish_metrics(metrics, True, None)
 
         except Exception as e:
             if os.path.exists(output_path):
                 os.remove(output_path)
-            return False, str(e)
+            return self._finish_metrics(metrics, False, str(e))
 
-    def decrypt_file(self, 
-                    input_path: str, 
-                    password: str, 
-                    progress_callback: Optional[Callable[[float], None]] = None) -> Tuple[bool, Optional[str]]:
-        
+    @in_background
+    def decrypt_file(self,
+                    input_path: str,
+                    password: str,
+                    progress_callback: Optional[Callable[[float], None]] = None,
+                    control: Optional[OperationControl] = None,
+                    key: Optional[bytes] = None,
+                    keep_input: bool = False) -> Tuple[bool, Optional[str]]:
+        """
+        Unlock a .locked file. key is an already derived key from derive_file_key().
+        keep_input leaves the .locked file in place, for passwords find_password() could
+        only check inexactly.
+        """
         # Ensure we're removing the .locked suffix correctly
-        output_path = input_path
-        if input_path.endswith('.locked'):
-            output_path = input_path[:-7]
-        else:
-            # Fallback for files that might not have the extension
-            output_path = input_path + '.unlocked'
-
-        try:
-            with open(input_path, 'rb') as in_file, open(output_path, 'wb') as out_file:
-                magic = in_file.read(4)
-                if magic != self.file_magic:
-                    raise ValueError(_("Not a valid locked file or incorrect password"))
-                
-                salt = in_file.read(self.salt_length)
-                iv = in_file.read(self.iv_length)
-                
-                key = self.generate_key(password, salt)
-                cipher = AES.new(key, AES.MODE_CBC, iv)
-                
-                file_size = os.path.getsize(input_path)
-                header_size = 4 + self.salt_length + self.iv_length
-                content_size = file_size - header_size
-                processed_content = 0
-
-                while True:
-                    chunk = in_file.read(self.chunk_size)
-                    if not chunk:
-                        break
-                    
-                    processed_content += len(chunk)
-                    decrypted_chunk = cipher.decrypt(chunk)
-                    
-                    if processed_content >= content_size:
-                        try:
-                            decrypted_chunk = unpad(decrypted_chunk, AES.block_size)
-                        except ValueError:
-                            raise ValueError(_("Incorrect password or corrupted file."))
-                    
-                    out_file.write(decrypted_chunk)
-                    
-                    if progress_callback:
-                        progress = ((header_size + processed_content) / file_size) * 100
-                        progress_callback(min(progress, 100.0))
-
-            os.remove(input_path)
-            return True, None
+        output_path = self.get_output_path(input_path, "decrypt_file")
+
+        metrics = self._start_metrics("decrypt_file", input_path)
+        try:
+            with core_io.open_input(input_path, self.io_mode) as in_file:
+                cipher, header = self._read_header(in_file, password, metrics, key=key)
+                content_size = os.path.getsize(input_path) - in_file.tell()
+                map_length = core_sparse.map_length(header)
+                # The plaintext is the content minus 1-16 bytes of padding (and the extent map
+                # for sparse files, whose holes take no space)
+                core_space.check_space(output_path, content_size)
+                # Holes need seeks, which O_DIRECT output can't do
+                io_mode = core_io.STREAM if map_length is not None and self.io_mode == core_io.DIRECT else self.io_mode
+
+                with core_io.open_output(output_path, io_mode) as out_file:
+                    if map_length is None:
+                        core_space.preallocate(out_file, content_size)
+                        self._decrypt_chunks(in_file, out_file, cipher, metrics, control, progress_callback, content_size)
+                        out_file.truncate()
+                    else:
+                        sparse_out = core_sparse.SparseWriter(out_file, map_length, holes=True)
+                        self._decrypt_chunks(in_file, sparse_out, cipher, metrics, control, progress_callback, content_size)
+                        sparse_out.finish()
+
+            if not keep_input:
+                with metrics.phase('cleanup'):
+                    os.remove(input_path)
+            return self._finish_metrics(metrics, True, None)
 
         except ValueError as ve:
             if os.path.exists(output_path):
                 os.remove(output_path)
-            return False, str(ve)
+            return self._finish_metrics(metrics, False, str(ve))
         except Exception as e:
             if os.path.exists(output_path):
                 os.remove(output_path)
+            return self._finish_metrics(metrics, False, str(e))
+
+    @in_background
+    def decrypt_legacy_file(self,
+                            input_path: str,
+                            password: str,
+                            progress_callback: Optional[Callable[[float], None]] = None,
+                            control: Optional[OperationControl] = None,
+                            key: Optional[bytes] = None) -> Tuple[bool, Optional[str]]:
+        """Unlock a .locked file written by the old core.py engine, streaming it instead of loading it."""
+        output_path = self.get_output_path(input_path, "decrypt_legacy_file")
+        metrics = self._start_metrics("decrypt_legacy_file", input_path)
+        try:
+            total_size = os.path.getsize(input_path)
+            # base64 makes 3 bytes out of every 4 characters, the plaintext is a bit less than that
+            output_size = (total_size - core_legacy.SALT_LENGTH) * 3 // 4
+            core_space.check_space(output_path, output_size)
+            with core_io.open_input(input_path, self.io_mode) as in_file, core_io.open_output(output_path, self.io_mode) as out_file:
+                core_space.preallocate(out_file, output_size)
+                core_legacy.decrypt_legacy_stream(in_file, out_file, password, metrics, self.chunk_size,
+                                                  control, progress_callback, total_size, self.ciphers,
+                                                  key)
+                out_file.truncate()
+
+            with metrics.phase('cleanup'):
+                os.remove(input_path)
+            return self._finish_metrics(metrics, True, None)
+
+        except Exception as e:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            return self._finish_metrics(metrics, False, str(e))
+
+    @in_background
+    def migrate_legacy_file(self,
+                            input_path: str,
+                            password: str,
+                            progress_callback: Optional[Callable[[float], None]] = None,
+                            control: Optional[OperationControl] = None) -> Tuple[bool, Optional[str]]:
+        """
+        Rewrite a legacy core.py file into the current format in one streaming pass.
+        The plaintext only ever exists in memory, chunk by chunk, and the original is
+        swapped for the new file atomically at the end. Gets a Merkle tree like
+        encrypt_file does.
+        """
+        temp_path = input_path + '.migrating'
+        metrics = self._start_metrics("migrate_legacy_file", input_path)
+        try:
+            total_size = os.path.getsize(input_path)
+            # The new content is a bit smaller than the old file, so a tree for that size fits
+            tree_area = core_merkle.tree_size(core_merkle.leaf_count(total_size))
+            # Both files exist until the swap
+            output_size = self.locked_size(total_size) + tree_area
+            core_space.check_space(temp_path, output_size)
+            with core_io.open_input(input_path, self.io_mode) as in_file, core_io.open_output(temp_path, self.io_mode) as raw_out:
+                core_space.preallocate(raw_out, output_size)
+                writer = core_stream.LockedFileWriter(raw_out, self, password, close_raw=False, metrics=metrics,
+                                                      tree_area=tree_area)
+                with core_stream.LockedBufferedWriter(writer, self.chunk_size) as out_file:
+                    core_legacy.decrypt_legacy_stream(in_file, out_file, password, metrics, self.chunk_size,
+                                                      control, progress_callback, total_size, self.ciphers)
+                raw_out.truncate()
+
+            with metrics.phase('write'):
+                core_merkle.store_tree(temp_path, writer.header, writer.tree.finish())
+            with metrics.phase('cleanup'):
+                os.replace(temp_path, input_path)
+            return self._finish_metrics(metrics, True, None)
+
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return self._finish_metrics(metrics, False, str(e))
+
+    @in_background
+    def rekey(self,
+              input_path: str,
+              old_password: str,
+              new_password: str,
+              progress_callback: Optional[Callable[[float], None]] = None,
+              control: Optional[OperationControl] = None,
+              new_key: Optional[Tuple[KdfParams, bytes]] = None) -> Tuple[bool, Optional[str]]:
+        """
+        Change the password of a locked file or folder archive. In the v2 format only the
+        wrapped content key changes, so the 512 byte header gets rewritten in place and the
+        data is never touched. v1 and core.py files get converted to v2 once, in a single
+        streaming pass. new_key is an already derived (KdfParams, key) for new_password,
+        so a batch can share one derivation.
+        """
+        metrics = self._start_metrics("rekey", input_path)
+        try:
+            if control:
+                control.checkpoint()
+            with open(input_path, 'rb') as f:
+                magic = f.read(4)
+
+            if magic not in core_header.MAGICS:
+                self._convert_to_v2(input_path, old_password, new_password, metrics, control, progress_callback)
+                return self._finish_metrics(metrics, True, None)
+
+            with open(input_path, 'r+b') as f:
+                header = LockHeader.read(f)
+                metrics.count('bytes_read', header.data_offset)
+                with metrics.phase('kdf'):
+                    content_key = header.unwrap(old_password)
+                    if new_key:
+                        header.kdf, kek = new_key
+                    else:
+                        # Picks up the current KDF settings, so a rekey also upgrades old parameters
+                        header.kdf = self.new_kdf_params()
+                        kek = header.kdf.derive(new_password)
+                header.wrap(content_key, kek)
+                packed = header.pack()
+
+                with metrics.phase('write'):
+                    f.seek(0)
+                    f.write(packed)
+                    f.flush()
+                    os.fsync(f.fileno())
+                metrics.count('bytes_written', len(packed))
+
+            if progress_callback:
+                progress_callback(100)
+            return self._finish_metrics(metrics, True, None)
+
+        except Exception as e:
+            return self._finish_metrics(metrics, False, str(e))
+
+    def _convert_to_v2(self,
+                       input_path: str,
+                       old_password: str,
+                       new_password: str,
+                       metrics: OperationMetrics,
+                       control: Optional[OperationControl] = None,
+                       progress_callback: Optional[Callable[[float], None]] = None):
+        """
+        Re-encrypt a v1 or legacy file into v2 under a new password, swapping it in atomically.
+        Files get a Merkle tree like encrypt_file gives them, folder archives have none.
+        """
+        op_type = self.get_operation_type(input_path)
+        if op_type not in ("decrypt_file", "decrypt_folder", "decrypt_legacy_file"):
+            raise ValueError(_("Not a valid encrypted file or folder: {}").format(input_path))
+
+        temp_path = input_path + '.rekeying'
+        total_size = os.path.getsize(input_path)
+        folder = op_type == "decrypt_folder"
+        # The new content is no bigger than the old file, so a tree for that size fits
+        tree_area = 0 if folder else core_merkle.tree_size(core_merkle.leaf_count(total_size))
+        # The v2 copy is at most a bigger header away from the original, and both exist until the swap
+        output_size = self.locked_size(total_size) + tree_area
+        core_space.check_space(temp_path, output_size)
+        try:
+            with core_io.open_input(input_path, self.io_mode) as in_file, core_io.open_output(temp_path, self.io_mode) as raw_out:
+                core_space.preallocate(raw_out, output_size)
+                writer = core_stream.LockedFileWriter(raw_out, self, new_password, close_raw=False,
+                                                      metrics=metrics, folder=folder, tree_area=tree_area)
+                with core_stream.LockedBufferedWriter(writer, self.chunk_size) as out_file:
+                    if op_type == "decrypt_legacy_file":
+                        core_legacy.decrypt_legacy_stream(in_file, out_file, old_password, metrics, self.chunk_size,
+                                                          control, progress_callback, total_size, self.ciphers)
+                    else:
+                        cipher = self._read_file_header(in_file, old_password, metrics, folder=folder)
+                        self._decrypt_chunks(in_file, out_file, cipher, metrics, control, progress_callback, total_size)
+                raw_out.truncate()
+
+            if writer.tree:
+                with metrics.phase('write'):
+                    core_merkle.store_tree(temp_path, writer.header, writer.tree.finish())
+            with metrics.phase('cleanup'):
+                os.replace(temp_path, input_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @in_background
+    def watch_folder(self,
+                     folder: str,
+                     password: str,
+                     workers: Optional[int] = None,
+                     settle_seconds: float = 2.0,
+                     state_path: Optional[str] = None,
+                     control: Optional[OperationControl] = None,
+                     on_result: Optional[Callable[[str, bool, Optional[str]], None]] = None,
+                     use_polling: bool = False) -> Tuple[bool, Optional[str]]:
+        """
+        Lock every file that shows up in folder until control gets cancelled, see core_watch.
+        Blocks the calling thread. on_result(path, success, message) is called per file.
+        """
+        control = control or OperationControl()
+        try:
+            watcher = core_watch.FolderWatcher(self, folder, password, workers, settle_seconds, state_path,
+                                               control, on_result, use_polling)
+            watcher.run()
+            return True, None
+        except Exception as e:
             return False, str(e)
-            
+
+    @in_background
+    def encrypt_stream(self,
+                       in_stream,
+                       out_stream,
+                       password: str,
+                       progress_callback: Optional[Callable[[float], None]] = None,
+                       control: Optional[OperationControl] = None,
+                       total_size: Optional[int] = None) -> Tuple[bool, Optional[str]]:
+        """
+        Lock whatever comes out of a binary stream (e.g. stdin) into another one (e.g. stdout).
+        Memory use is constant and output starts with the first chunk. Nothing can be rolled
+        back here, on failure the output stream is left half written. There's no Merkle
+        tree, the size isn't known up front and the output might not be seekable.
+        """
+        metrics = self._start_metrics("encrypt_stream", "-")
+        try:
+            cipher = self._write_file_header(out_stream, password, metrics)
+            self._encrypt_chunks(in_stream, out_stream, cipher, metrics, control, progress_callback, total_size)
+            out_stream.flush()
+            return self._finish_metrics(metrics, True, None)
+        except Exception as e:
+            return self._finish_metrics(metrics, False, str(e))
+
+    @in_background
+    def decrypt_stream(self,
+                       in_stream,
+                       out_stream,
+                       password: str,
+                       progress_callback: Optional[Callable[[float], None]] = None,
+                       control: Optional[OperationControl] = None,
+                       total_size: Optional[int] = None,
+                       holes: bool = False) -> Tuple[bool, Optional[str]]:
+        """
+        Unlock a locked file coming in on a binary stream. A wrong password is only noticed
+        at the very end (padding check), by then the garbage is already in out_stream.
+        The holes of sparse files are written out as zeros, unless holes=True says
+        out_stream is an empty file of the caller's own that they can be seeked over in.
+        """
+        metrics = self._start_metrics("decrypt_stream", "-")
+        try:
+            cipher, header = self._read_header(in_stream, password, metrics)
+            map_length = core_sparse.map_length(header)
+            if map_length is None:
+                self._decrypt_chunks(in_stream, out_stream, cipher, metrics, control, progress_callback, total_size)
+            else:
+                sparse_out = core_sparse.SparseWriter(out_stream, map_length, holes=holes)
+                self._decrypt_chunks(in_stream, sparse_out, cipher, metrics, control, progress_callback, total_size)
+                sparse_out.finish()
+            out_stream.flush()
+            return self._finish_metrics(metrics, True, None)
+        except Exception as e:
+            return self._finish_metrics(metrics, False, str(e))
+
+    @in_background
     def encrypt_folder(self,
                      input_path: str,
                      password: str,
-                     progress_callback: Optional[Callable[[float], None]] = None) -> Tuple[bool, Optional[str]]:
+                     progress_callback: Optional[Callable[[float], None]] = None,
+                     control: Optional[OperationControl] = None) -> Tuple[bool, Optional[str]]:
+        """Lock a folder into input_path + '.flka' and remove what went into it."""
         output_path = input_path + '.flka'
+        metrics = self._start_metrics("encrypt_folder", input_path)
         try:
-            # Step 1: Create an in-memory zip archive
-            zip_buffer = io.BytesIO()
-            
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                p = Path(input_path)
-                for file in p.glob('**/*'):
-                    if file.is_file():
-                        zipf.write(file, file.relative_to(p))
-
-            zip_data = zip_buffer.getvalue()
-            
-            # Step 2: Encrypt the zip data
-            salt = get_random_bytes(self.salt_length)
-            iv = get_random_bytes(self.iv_length)
-            key = self.generate_key(password, salt)
-            cipher = AES.new(key, AES.MODE_CBC, iv)
-            
-            padded_data = pad(zip_data, AES.block_size)
-            encrypted_data = cipher.encrypt(padded_data)
-            
-            # Step 3: Write to output file
+            with metrics.phase('scan'):
+                items = list(core_walk.walk(input_path, self.path_filter, on_skip=lambda path, reason: metrics.count('skipped')))
+            total_size = sum(item.size for item in items)
+            # Compression can only make it smaller, so reserve the worst case and trim afterwards
+            output_size = core_archive.size_bound(items)
+            core_space.check_space(output_path, output_size)
+
+            # Every file becomes its own encrypted entry, prepared in parallel and written in order
             with open(output_path, 'wb') as out_file:
-                out_file.write(self.folder_magic)
-                out_file.write(salt)
-                out_file.write(iv)
-                out_file.write(encrypted_data)
+                core_space.preallocate(out_file, output_size)
+                writer = ArchiveWriter(out_file, password, metrics, control, self.chunk_size, self.ciphers,
+                                       self.new_kdf_params())
+                core_archive.write_items(writer, items, self.workers, progress_callback, total_size)
+                writer.close()
+                out_file.truncate()
 
             if progress_callback:
-                progress_callback(100) # Simplified progress for now
+                progress_callback(100)
+
+            with metrics.phase('cleanup'):
+                # Only what went into the archive, excluded and skipped items stay where they are
+                core_walk.remove_walked(input_path, items)
+            return self._finish_metrics(metrics, True, None)
 
-            shutil.rmtree(input_path)
-            return True, None
-            
         except Exception as e:
             if os.path.exists(output_path):
                 os.remove(output_path)
-            return False, str(e)
+            return self._finish_metrics(metrics, False, str(e))
 
+    @in_background
     def decrypt_folder(self,
                      input_path: str,
                      password: str,
-                     progress_callback: Optional[Callable[[float], None]] = None) -> Tuple[bool, Optional[str]]:
+                     progress_callback: Optional[Callable[[float], None]] = None,
+                     control: Optional[OperationControl] = None,
+                     key: Optional[bytes] = None) -> Tuple[bool, Optional[str]]:
+        """Unlock a folder archive. key is an already derived key from derive_file_key()."""
         output_path = input_path
         if input_path.endswith('.flka'):
             output_path = input_path[:-5]
-            
+        created_output = False
+        extracted = []
+
+        metrics = self._start_metrics("decrypt_folder", input_path)
         try:
-            # Step 1: Read and decrypt the file content
             with open(input_path, 'rb') as in_file:
-                magic = in_file.read(4)
-                if magic != self.folder_magic:
-                    raise ValueError(_("Not a valid locked folder archive or incorrect password"))
-                
-                salt = in_file.read(self.salt_length)
-                iv = in_file.read(self.iv_length)
-                encrypted_data = in_file.read()
-            
-            key = self.generate_key(password, salt)
-            cipher = AES.new(key, AES.MODE_CBC, iv)
-            
-            decrypted_padded_data = cipher.decrypt(encrypted_data)
-            try:
-                decrypted_data = unpad(decrypted_padded_data, AES.block_size)
-            except ValueError:
-                raise ValueError(_("Incorrect password or corrupted file."))
-            
-            # Step 2: Extract the in-memory zip archive
-            zip_buffer = io.BytesIO(decrypted_data)
-            
-            if not os.path.exists(output_path):
-                os.makedirs(output_path)
-                
-            with zipfile.ZipFile(zip_buffer, 'r') as zipf:
-                zipf.extractall(output_path)
+                if in_file.read(4) == core_header.ARCHIVE_MAGIC:
+                    in_file.seek(0)
+                    reader = ArchiveReader(in_file, password, metrics, self.chunk_size, self.ciphers, key)
+                    core_space.check_space(output_path, sum(entry.size for entry in reader.entries))
+                    if not os.path.exists(output_path):
+                        os.makedirs(output_path)
+                        created_output = True
+                    self._extract_entries(reader, reader.entries, output_path, extracted, progress_callback, control)
+                    zipf = None
+                else:
+                    zipf = self._open_zip_archive(in_file, password, metrics, key)
+
+            if zipf is not None:
+                # FLKA/FLA2: one big encrypted zip, already decrypted into memory above
+                core_space.check_space(output_path, sum(info.file_size for info in zipf.infolist()))
+                if not os.path.exists(output_path):
+                    os.makedirs(output_path)
+                    created_output = True
+
+                with metrics.phase('extract'):
+                    with zipf:
+                        for member in zipf.infolist():
+                            if control:
+                                control.checkpoint(member.file_size)
+                            extracted.append(zipf.extract(member, output_path))
+                            metrics.count('bytes_written', member.file_size)
+                            metrics.count('files')
 
             if progress_callback:
-                progress_callback(100) # Simplified progress for now
+                progress_callback(100)
 
-            os.remove(input_path)
-            return True, None
+            with metrics.phase('cleanup'):
+                os.remove(input_path)
+            return self._finish_metrics(metrics, True, None)
 
+        except OperationCancelled as oc:
+            # The user asked for this, so undo whatever was extracted so far
+            self._rollback_extraction(output_path, created_output, extracted)
+            return self._finish_metrics(metrics, False, str(oc))
         except ValueError as ve:
             # Don't delete partial extraction for data recovery reasons
-            return False, str(ve)
+            return self._finish_metrics(metrics, False, str(ve))
         except Exception as e:
-            return False, str(e)
\ No newline at end of file
+            return self._finish_metrics(metrics, False, str(e))
+
+    def _open_zip_archive(self, in_file, password: str, metrics: OperationMetrics, key: Optional[bytes] = None) -> zipfile.ZipFile:
+        """Decrypt an FLKA/FLA2 archive (a single encrypted zip) into memory."""
+        in_file.seek(0)
+        cipher = self._read_file_header(in_file, password, metrics, folder=True, key=key)
+        with metrics.phase('read'):
+            encrypted_data = in_file.read()
+        metrics.count('bytes_read', len(encrypted_data))
+
+        with metrics.phase('cipher'):
+            decrypted_padded_data = cipher.decrypt(encrypted_data)
+        try:
+            decrypted_data = unpad(decrypted_padded_data, AES.block_size)
+        except ValueError:
+            raise ValueError(_("Incorrect password or corrupted file."))
+        return zipfile.ZipFile(io.BytesIO(decrypted_data), 'r')
+
+    def _extract_entries(self,
+                         reader: ArchiveReader,
+                         entries: List[ArchiveEntry],
+                         output_path: str,
+                         extracted: list,
+                         progress_callback: Optional[Callable[[float], None]] = None,
+                         control: Optional[OperationControl] = None):
+        """Extract FLA3 entries under output_path, recording what got written for rollback."""
+        with reader.metrics.phase('extract'):
+            core_archive.extract_entries(reader, entries, output_path, self.workers, control, progress_callback, extracted)
+
+    def list_archive(self, input_path: str, password: str) -> Tuple[Optional[List[ArchiveEntry]], Optional[str]]:
+        """
+        Contents of a locked folder archive without extracting it. For FLA3 only the index
+        gets decrypted, older archives have to be decrypted into memory first.
+        Returns (entries, None) or (None, error).
+        """
+        metrics = self._start_metrics("list_archive", input_path)
+        try:
+            with open(input_path, 'rb') as in_file:
+                if in_file.read(4) == core_header.ARCHIVE_MAGIC:
+                    in_file.seek(0)
+                    entries = ArchiveReader(in_file, password, metrics, self.chunk_size, self.ciphers).entries
+                else:
+                    with self._open_zip_archive(in_file, password, metrics) as zipf:
+                        entries = [ArchiveEntry(info.filename.rstrip('/'), info.is_dir(), info.file_size,
+                                                datetime(*info.date_time).timestamp())
+                                   for info in zipf.infolist()]
+            self._finish_metrics(metrics, True, None)
+            return entries, None
+        except Exception as e:
+            return None, self._finish_metrics(metrics, False, str(e))[1]
+
+    @in_background
+    def verify_file(self,
+                    input_path: str,
+                    progress_callback: Optional[Callable[[float], None]] = None,
+                    control: Optional[OperationControl] = None) -> Tuple[Optional[core_merkle.VerifyReport], Optional[str]]:
+        """
+        Check a locked file against the Merkle tree in its header, chunks hashed on
+        self.workers threads. No password needed. Returns (report, None) or (None, error).
+        """
+        metrics = self._start_metrics("verify_file", input_path)
+        try:
+            with metrics.phase('hash'):
+                report = core_merkle.verify(input_path, self.workers, control, progress_callback)
+            metrics.count('bytes_read', os.path.getsize(input_path))
+            metrics.count('chunks', report.chunks)
+            self._finish_metrics(metrics, True, None)
+            return report, None
+        except Exception as e:
+            return None, self._finish_metrics(metrics, False, str(e))[1]
+
+    @in_background
+    def extract_members(self,
+                        input_path: str,
+                        password: str,
+                        members: List[str],
+                        output_path: Optional[str] = None,
+                        progress_callback: Optional[Callable[[float], None]] = None,
+                        control: Optional[OperationControl] = None) -> Tuple[bool, Optional[str]]:
+        """
+        Pull selected files (or whole directories) out of a locked folder archive. The
+        archive stays locked and in place. For FLA3 only the requested entries are read.
+        """
+        output_path = output_path or self.get_output_path(input_path, "decrypt_folder")
+        created_output = False
+        extracted = []
+        metrics = self._start_metrics("extract_members", input_path)
+        try:
+            with open(input_path, 'rb') as in_file:
+                if in_file.read(4) == core_header.ARCHIVE_MAGIC:
+                    in_file.seek(0)
+                    reader = ArchiveReader(in_file, password, metrics, self.chunk_size, self.ciphers)
+                    entries = reader.find(members)
+                    core_space.check_space(output_path, sum(entry.size for entry in entries))
+                    if not os.path.exists(output_path):
+                        os.makedirs(output_path)
+                        created_output = True
+                    self._extract_entries(reader, entries, output_path, extracted, progress_callback, control)
+                else:
+                    with self._open_zip_archive(in_file, password, metrics) as zipf:
+                        wanted = [m.replace('\\', '/').strip('/') for m in members]
+                        infos = [info for info in zipf.infolist()
+                                 if any(info.filename.rstrip('/') == m or info.filename.startswith(m + '/') for m in wanted)]
+                        if not infos:
+                            raise ValueError(_("Not found in archive: {}").format(", ".join(members)))
+                        core_space.check_space(output_path, sum(info.file_size for info in infos))
+                        if not os.path.exists(output_path):
+                            os.makedirs(output_path)
+                            created_output = True
+                        for info in infos:
+                            if control:
+                                control.checkpoint(info.file_size)
+                            extracted.append(zipf.extract(info, output_path))
+                            metrics.count('bytes_written', info.file_size)
+                            metrics.count('files')
+            return self._finish_metrics(metrics, True, None)
+
+        except OperationCancelled as oc:
+            self._rollback_extraction(output_path, created_output, extracted)
+            return self._finish_metrics(metrics, False, str(oc))
+        except Exception as e:
+            return self._finish_metrics(metrics, False, str(e))
+
+    def _rollback_extraction(self, output_path: str, created_output: bool, extracted: list):
+        """Remove the results of a cancelled folder extraction."""
+        try:
+            if created_output:
+                shutil.rmtree(output_path, ignore_errors=True)
+                return
+            for path in reversed(extracted):
+                if os.path.isfile(path):
+                    os.remove(path)
+        except OSError:
+            pass
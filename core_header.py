@@ -0,0 +1,379 @@
+"""
+Version 2 header for locked files (FLC2) and folder archives (FLA2, and the
+seekable FLA3 from core_archive).
+
+    magic        4 bytes
+    header_size  4 bytes, big endian, size of what follows up to the content
+    fields       tag (1) + length (2) + value, zero padded to DEFAULT_HEADER_SIZE
+    (data area)  only if header_size is bigger, data fields point into (see core_merkle)
+    content      AES-256-CBC with a random content key, PKCS7 padded
+
+The content key is never derived from the password directly. It's wrapped with
+AES-GCM under a key derived from the password (the KEK), so changing the password
+only means re-wrapping 32 bytes and rewriting this fixed size block in place.
+The GCM tag also tells us right away when a password is wrong.
+
+The KDF field holds algorithm (1) + salt length (1) + salt + cost (4), plus r (1)
+and p (1) for scrypt, so every file carries the parameters it was locked with.
+"""
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+from translate import _ # import for errors
+from core_control import OperationControl
+import core_kdf
+
+FILE_MAGIC = b'FLC2'
+FOLDER_MAGIC = b'FLA2'
+ARCHIVE_MAGIC = b'FLA3' # seekable folder archive, see core_archive
+MAGICS = (FILE_MAGIC, FOLDER_MAGIC, ARCHIVE_MAGIC)
+
+# Room for the fields plus whatever later versions add, without moving the content.
+# Preamble + header is exactly 512 bytes, so a rekey is a single sector write.
+DEFAULT_HEADER_SIZE = 504
+PREAMBLE_SIZE = 8 # magic + header_size
+
+# Field tags
+TAG_END = 0x00
+TAG_KDF = 0x01
+TAG_WRAPPED_KEY = 0x02
+TAG_CONTENT_IV = 0x03
+TAG_INDEX = 0x04 # FLA3 only: offset + length + iv of the encrypted index
+TAG_MERKLE = 0x05 # FLC2 only: chunk size + leaf count + root of the tree in the data area
+TAG_SPARSE = 0x06 # FLC2 only: length of the extent map the content starts with, see core_sparse
+
+# KDF algorithm ids
+KDF_PBKDF2_SHA1 = 1
+KDF_PBKDF2_SHA256 = 2
+KDF_SCRYPT = 3
+# Names used in settings and on the command line
+KDF_NAMES = {'pbkdf2-sha1': KDF_PBKDF2_SHA1, 'pbkdf2-sha256': KDF_PBKDF2_SHA256, 'scrypt': KDF_SCRYPT}
+_KDF_ENGINES = {KDF_PBKDF2_SHA1: core_kdf.PBKDF2_SHA1, KDF_PBKDF2_SHA256: core_kdf.PBKDF2_SHA256, KDF_SCRYPT: core_kdf.SCRYPT}
+
+KEY_LENGTH = 32
+SALT_LENGTH = 32
+DEFAULT_ITERATIONS = 100000
+DEFAULT_SCRYPT_COST = 2 ** 15
+WRAP_NONCE_LENGTH = 12
+WRAP_TAG_LENGTH = 16
+
+class KdfParams:
+    """
+    Which KDF turns the password into the key-encryption key, and with what settings.
+    iterations is the cost: PBKDF2 rounds, or n for scrypt (which also has block_size
+    r and parallelism p). Everything needed to derive the key again is stored in the
+    header, so changing the defaults never breaks existing files.
+    """
+    def __init__(self,
+                 algorithm: int = KDF_PBKDF2_SHA1,
+                 salt: Optional[bytes] = None,
+                 iterations: Optional[int] = None,
+                 block_size: int = core_kdf.SCRYPT_BLOCK_SIZE,
+                 parallelism: int = core_kdf.SCRYPT_PARALLELISM):
+        self.algorithm = algorithm
+        self.salt = salt if salt is not None else get_random_bytes(SALT_LENGTH)
+        if iterations is None:
+            iterations = DEFAULT_SCRYPT_COST if algorithm == KDF_SCRYPT else DEFAULT_ITERATIONS
+        self.iterations = iterations
+        self.block_size = block_size
+        self.parallelism = parallelism
+
+    @classmethod
+    def from_name(cls, name: Optional[str], cost: Optional[int] = None) -> "KdfParams":
+        """Fresh parameters (new salt) for a KDF_NAMES name, cost None/0 = the default."""
+        if name and name not in KDF_NAMES:
+            raise ValueError(_("Unsupported key derivation algorithm: {}").format(name))
+        return cls(KDF_NAMES.get(name or '', KDF_PBKDF2_SHA1), None, cost or None)
+
+    @classmethod
+    def calibrate(cls, name: str, target_ms: float) -> "KdfParams":
+        """Parameters that take about target_ms to derive on this machine."""
+        params = cls.from_name(name)
+        params.iterations = core_kdf.calibrate(_KDF_ENGINES[params.algorithm], target_ms)
+        return params
+
+    @property
+    def name(self) -> str:
+        for name, algorithm in KDF_NAMES.items():
+            if algorithm == self.algorithm:
+                return name
+        return str(self.algorithm)
+
+    def derive(self, password: str) -> bytes:
+        if self.algorithm in (KDF_PBKDF2_SHA1, KDF_PBKDF2_SHA256):
+            return core_kdf.pbkdf2(_KDF_ENGINES[self.algorithm], password.encode(), self.salt, self.iterations, KEY_LENGTH)
+        if self.algorithm == KDF_SCRYPT:
+            return core_kdf.scrypt(password.encode(), self.salt, self.iterations, self.block_size, self.parallelism, KEY_LENGTH)
+        raise ValueError(_("Unsupported key derivation algorithm: {}").format(self.algorithm))
+
+    def with_new_salt(self) -> "KdfParams":
+        return KdfParams(self.algorithm, None, self.iterations, self.block_size, self.parallelism)
+
+    def pack(self) -> bytes:
+        packed = struct.pack('>BB', self.algorithm, len(self.salt)) + self.salt + struct.pack('>I', self.iterations)
+        if self.algorithm == KDF_SCRYPT:
+            packed += struct.pack('>BB', self.block_size, self.parallelism)
+        return packed
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "KdfParams":
+        algorithm, salt_length = struct.unpack_from('>BB', data)
+        salt = data[2:2 + salt_length]
+        (iterations,) = struct.unpack_from('>I', data, 2 + salt_length)
+        if algorithm == KDF_SCRYPT:
+            block_size, parallelism = struct.unpack_from('>BB', data, 6 + salt_length)
+            return cls(algorithm, salt, iterations, block_size, parallelism)
+        return cls(algorithm, salt, iterations)
+
+class LockHeader:
+    def __init__(self,
+                 magic: bytes,
+                 kdf: KdfParams,
+                 wrapped_key: bytes,
+                 content_iv: bytes,
+                 fields: Optional[Dict[int, bytes]] = None,
+                 header_size: int = DEFAULT_HEADER_SIZE):
+        self.magic = magic
+        self.kdf = kdf
+        self.wrapped_key = wrapped_key
+        self.content_iv = content_iv
+        # Fields this version doesn't know about are kept as-is so rewrites don't drop them
+        self.fields = fields or {}
+        self.header_size = header_size
+
+    @property
+    def data_offset(self) -> int:
+        """Where the encrypted content starts."""
+        return PREAMBLE_SIZE + self.header_size
+
+    @property
+    def fields_size(self) -> int:
+        """Size of the field block, the rest of header_size (if any) is the data area."""
+        return min(self.header_size, DEFAULT_HEADER_SIZE)
+
+    @classmethod
+    def create(cls,
+               magic: bytes,
+               password: str,
+               kdf: Optional[KdfParams] = None,
+               kek: Optional[bytes] = None) -> Tuple["LockHeader", bytes]:
+        """
+        New header with a fresh random content key. Returns (header, content key).
+        Pass kek (already derived from password with kdf) to skip the derivation.
+        """
+        kdf = kdf or KdfParams()
+        content_key = get_random_bytes(KEY_LENGTH)
+        header = cls(magic, kdf, b'', get_random_bytes(AES.block_size))
+        header.wrap(content_key, kek or kdf.derive(password))
+        return header, content_key
+
+    def wrap(self, content_key: bytes, kek: bytes):
+        """Store content_key encrypted under kek (which must match self.kdf)."""
+        nonce = get_random_bytes(WRAP_NONCE_LENGTH)
+        cipher = AES.new(kek, AES.MODE_GCM, nonce=nonce, mac_len=WRAP_TAG_LENGTH)
+        cipher.update(self.magic)
+        encrypted, tag = cipher.encrypt_and_digest(content_key)
+        self.wrapped_key = nonce + encrypted + tag
+
+    def unwrap_with_kek(self, kek: bytes) -> bytes:
+        nonce = self.wrapped_key[:WRAP_NONCE_LENGTH]
+        encrypted = self.wrapped_key[WRAP_NONCE_LENGTH:-WRAP_TAG_LENGTH]
+        tag = self.wrapped_key[-WRAP_TAG_LENGTH:]
+        cipher = AES.new(kek, AES.MODE_GCM, nonce=nonce, mac_len=WRAP_TAG_LENGTH)
+        cipher.update(self.magic)
+        try:
+            return cipher.decrypt_and_verify(encrypted, tag)
+        except ValueError:
+            raise ValueError(_("Incorrect password or corrupted file."))
+
+    def unwrap(self, password: str) -> bytes:
+        """Get the content key back. Raises ValueError for a wrong password."""
+        return self.unwrap_with_kek(self.kdf.derive(password))
+
+    def pack(self) -> bytes:
+        fields = {
+            TAG_KDF: self.kdf.pack(),
+            TAG_WRAPPED_KEY: self.wrapped_key,
+            TAG_CONTENT_IV: self.content_iv,
+        }
+        fields.update({tag: value for tag, value in self.fields.items() if tag not in fields})
+
+        block = b''.join(struct.pack('>BH', tag, len(value)) + value for tag, value in fields.items())
+        if len(block) > self.fields_size:
+            raise ValueError(_("Header does not fit in {} bytes.").format(self.fields_size))
+        # Only the field block, a data area after it is left alone
+        block += b'\x00' * (self.fields_size - len(block))
+        return self.magic + struct.pack('>I', self.header_size) + block
+
+    @classmethod
+    def read(cls, stream, magic: Optional[bytes] = None) -> "LockHeader":
+        """Read a header from the start of a stream. Pass magic if it was already consumed."""
+        if magic is None:
+            magic = stream.read(4)
+        if magic not in MAGICS:
+            raise ValueError(_("Not a valid locked file or incorrect password"))
+        size_data = stream.read(4)
+        if len(size_data) != 4:
+            raise ValueError(_("Incorrect password or corrupted file."))
+        (header_size,) = struct.unpack('>I', size_data)
+        block = stream.read(min(header_size, DEFAULT_HEADER_SIZE))
+        if len(block) != min(header_size, DEFAULT_HEADER_SIZE):
+            raise ValueError(_("Incorrect password or corrupted file."))
+        _skip(stream, header_size - len(block)) # the data area, whoever needs it reads it by offset
+
+        fields: Dict[int, bytes] = {}
+        pos = 0
+        while pos + 3 <= len(block):
+            tag, length = struct.unpack_from('>BH', block, pos)
+            if tag == TAG_END:
+                break
+            fields[tag] = block[pos + 3:pos + 3 + length]
+            pos += 3 + length
+
+        try:
+            kdf = KdfParams.unpack(fields.pop(TAG_KDF))
+            wrapped_key = fields.pop(TAG_WRAPPED_KEY)
+            content_iv = fields.pop(TAG_CONTENT_IV)
+        except (KeyError, struct.error):
+            raise ValueError(_("Incorrect password or corrupted file."))
+        return cls(magic, kdf, wrapped_key, content_iv, fields, header_size)
+
+def _skip(stream, count: int):
+    if count <= 0:
+        return
+    try:
+        if stream.seekable():
+            stream.seek(count, os.SEEK_CUR)
+            return
+    except (AttributeError, OSError):
+        pass
+    while count > 0:
+        data = stream.read(min(count, 1024 * 1024))
+        if not data:
+            raise ValueError(_("Incorrect password or corrupted file."))
+        count -= len(data)
+
+def find_locked_files(encryption, root: str) -> Iterator[str]:
+    """Yield every locked file or folder archive under root (or root itself if it's one)."""
+    if os.path.isfile(root):
+        if (encryption.get_operation_type(root) or "").startswith("decrypt"):
+            yield root
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith(('.locked', '.flka')):
+                path = os.path.join(dirpath, name)
+                if (encryption.get_operation_type(path) or "").startswith("decrypt"):
+                    yield path
+
+def rekey_tree(encryption,
+               root: str,
+               old_password: str,
+               new_password: str,
+               workers: Optional[int] = None,
+               control: Optional[OperationControl] = None,
+               on_result: Optional[Callable[[str, bool, Optional[str]], None]] = None) -> Tuple[int, List[Tuple[str, str]]]:
+    """
+    Change the password of every locked item under root. The new key is derived once
+    and shared by the whole batch, so per file only the old password's KDF and a
+    512 byte write are left. Returns (rekeyed count, [(path, error), ...]).
+    """
+    kdf = encryption.new_kdf_params()
+    new_key = (kdf, kdf.derive(new_password))
+    rekeyed = 0
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4) as pool:
+        futures = {
+            pool.submit(encryption.rekey, path, old_password, new_password, control=control, new_key=new_key): path
+            for path in find_locked_files(encryption, root)
+        }
+        for future in as_completed(futures):
+            path = futures[future]
+            success, message = future.result()
+            if success:
+                rekeyed += 1
+            else:
+                failures.append((path, message))
+            if on_result:
+                on_result(path, success, message)
+    return rekeyed, failures
+
+def derive_keys(encryption,
+                paths: List[str],
+                password: str,
+                workers: Optional[int] = None,
+                control: Optional[OperationControl] = None,
+                on_key: Optional[Callable[[str, bytes], None]] = None) -> Dict[str, bytes]:
+    """
+    Read the header of every path and run the KDFs on a thread pool (all our KDF
+    engines release the GIL), so a batch unlock uses every core for the slow part.
+    Returns {path: key} for Encryption.decrypt_*(key=...). Paths that aren't locked
+    or can't be read are left out, unlocking them normally reports the problem.
+    """
+    keys: Dict[str, bytes] = {}
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4) as pool:
+        futures = {pool.submit(encryption.derive_file_key, path, password): path for path in paths}
+        for future in as_completed(futures):
+            if control and control.is_cancelled():
+                for pending in futures:
+                    pending.cancel()
+                break
+            path = futures[future]
+            try:
+                keys[path] = future.result()
+            except (OSError, ValueError):
+                continue
+            if on_key:
+                on_key(path, keys[path])
+    return keys
+
+def unlock_tree(encryption,
+                root: str,
+                password: str,
+                workers: Optional[int] = None,
+                control: Optional[OperationControl] = None,
+                on_result: Optional[Callable[[str, bool, Optional[str]], None]] = None) -> Tuple[int, List[Tuple[str, str]]]:
+    """
+    Unlock every locked item under root with one password. All the key derivations
+    get queued on the pool up front and run ahead of the decryption, which goes
+    through the items in order. Returns (unlocked count, [(path, error), ...]).
+    """
+    operations = {
+        "decrypt_file": encryption.decrypt_file,
+        "decrypt_legacy_file": encryption.decrypt_legacy_file,
+        "decrypt_folder": encryption.decrypt_folder,
+    }
+    paths = list(find_locked_files(encryption, root))
+    unlocked = 0
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4) as pool:
+        futures = [(path, pool.submit(encryption.derive_file_key, path, password)) for path in paths]
+        try:
+            for path, future in futures:
+                if control and control.is_cancelled():
+                    break
+                try:
+                    key = future.result()
+                except (OSError, ValueError):
+                    key = None # let the decrypt below report what's wrong
+                operation = operations.get(encryption.get_operation_type(path))
+                if operation is None:
+                    continue
+                success, message = operation(path, password, control=control, key=key)
+                if success:
+                    unlocked += 1
+                else:
+                    failures.append((path, message))
+                if on_result:
+                    on_result(path, success, message)
+        finally:
+            for path, future in futures:
+                future.cancel()
+    return unlocked, failures
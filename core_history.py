@@ -64,6 +64,12 @@ class PasswordHistory:
         all_entries.sort(key=lambda x: x['timestamp'], reverse=True)
         return all_entries[:limit]
     
+    def candidate_passwords(self, filepath: Optional[str] = None) -> List[str]:
+        """Every distinct password in the history, the ones used for filepath first, then newest first."""
+        candidates = [entry['password'] for entry in self.get_history_for_file(filepath)] if filepath else []
+        candidates += [entry['password'] for entry in self.get_recent_passwords(limit=None)]
+        return list(dict.fromkeys(candidates))
+    
     def clear_history(self):
         """Clear all history"""
         self.history = {}
@@ -0,0 +1,228 @@
+"""
+I/O modes for locking and unlocking big files.
+
+    buffered   plain buffered files (default). Everything read and written stays in
+               the page cache until the kernel needs the memory for something else.
+    stream     the input gets sequential read ahead and is dropped from the cache as it
+               is consumed. The output is handed to writeback every FLUSH_INTERVAL with
+               sync_file_range and dropped once it's on disk, so at most two intervals
+               of dirty data are around at any time and there's no big stall at the end.
+    direct     like stream, but the output is written with O_DIRECT from page aligned
+               buffers and never goes through the cache at all. Falls back to stream on
+               filesystems that refuse O_DIRECT (tmpfs, some network mounts).
+
+The point is that locking a 500 GB file shouldn't push everything else on the
+machine out of memory. Both are Linux features, elsewhere stream and direct quietly
+behave like buffered.
+"""
+import ctypes
+import io
+import mmap
+import os
+from typing import Optional
+
+from translate import _ # import for errors
+
+BUFFERED = 'buffered'
+STREAM = 'stream'
+DIRECT = 'direct'
+MODES = (BUFFERED, STREAM, DIRECT)
+
+FLUSH_INTERVAL = 64 * 1024 * 1024
+# O_DIRECT wants the buffer, the length and the file offset aligned, a multiple of the page size covers every device
+DIRECT_BUFFER_SIZE = 1024 * 1024
+
+_SYNC_FILE_RANGE_WAIT_BEFORE = 1
+_SYNC_FILE_RANGE_WRITE = 2
+_SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+def _load_sync_file_range():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        sync_file_range = libc.sync_file_range
+    except (OSError, AttributeError):
+        return None
+    sync_file_range.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint)
+    return sync_file_range
+
+_sync_file_range = _load_sync_file_range() if hasattr(os, 'posix_fadvise') else None
+
+def _sync_range(fd: int, offset: int, length: int, flags: int):
+    """sync_file_range(), or fdatasync() for the waiting part where it doesn't exist."""
+    if _sync_file_range is not None and _sync_file_range(fd, offset, length, flags) == 0:
+        return
+    if flags & _SYNC_FILE_RANGE_WAIT_AFTER:
+        os.fdatasync(fd)
+
+def _fadvise(fd: int, offset: int, length: int, advice: Optional[int]):
+    if advice is None:
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass # only a hint
+
+_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', None)
+_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', None)
+
+class StreamReader(io.FileIO):
+    """Unbuffered input that tells the kernel it reads front to back and won't come back."""
+    def __init__(self, path: str):
+        super().__init__(path, 'rb')
+        self._dropped = 0
+        _fadvise(self.fileno(), 0, 0, _SEQUENTIAL)
+
+    def read(self, size: int = -1) -> bytes:
+        data = super().read(size)
+        self._consumed()
+        return data
+
+    def readinto(self, buffer) -> int:
+        count = super().readinto(buffer)
+        self._consumed()
+        return count
+
+    def _consumed(self):
+        position = self.tell()
+        if position - self._dropped >= FLUSH_INTERVAL:
+            _fadvise(self.fileno(), self._dropped, position - self._dropped, _DONTNEED)
+            self._dropped = position
+
+    def close(self):
+        if not self.closed:
+            _fadvise(self.fileno(), 0, 0, _DONTNEED)
+        super().close()
+
+class StreamWriter(io.FileIO):
+    """
+    Unbuffered output that keeps writeback going in the background. Every FLUSH_INTERVAL
+    the interval just written is handed to writeback, then the one before it is waited
+    for and dropped from the cache.
+    """
+    def __init__(self, path: str):
+        super().__init__(path, 'wb')
+        self._started = 0 # end of what's been handed to writeback
+        self._in_flight: Optional[tuple] = None # (start, end) handed over but not waited for
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast('B')
+        total = len(view)
+        while view:
+            view = view[super().write(view):]
+        end = self.tell()
+        if end - self._started >= FLUSH_INTERVAL:
+            self._writeback(end)
+        return total
+
+    def _writeback(self, end: int):
+        fd = self.fileno()
+        _sync_range(fd, self._started, end - self._started, _SYNC_FILE_RANGE_WRITE)
+        if self._in_flight:
+            start, stop = self._in_flight
+            _sync_range(fd, start, stop - start,
+                        _SYNC_FILE_RANGE_WAIT_BEFORE | _SYNC_FILE_RANGE_WRITE | _SYNC_FILE_RANGE_WAIT_AFTER)
+            _fadvise(fd, start, stop - start, _DONTNEED)
+        self._in_flight = (self._started, end)
+        self._started = end
+
+    def close(self):
+        if not self.closed:
+            try:
+                # Pages only leave the cache once they're clean
+                os.fdatasync(self.fileno())
+                _fadvise(self.fileno(), 0, 0, _DONTNEED)
+            except OSError:
+                pass
+        super().close()
+
+class DirectWriter(io.RawIOBase):
+    """
+    O_DIRECT output. Writes collect in a page aligned buffer that goes to disk whenever
+    it's full, the last partial buffer is written through the cache by close().
+    """
+    def __init__(self, path: str):
+        super().__init__()
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o666)
+        self._buffer = mmap.mmap(-1, DIRECT_BUFFER_SIZE) # anonymous maps are always page aligned
+        self._view = memoryview(self._buffer)
+        self._used = 0
+        self._offset = 0 # where the buffer goes in the file
+
+    def writable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def tell(self) -> int:
+        return self._offset + self._used
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast('B')
+        total = len(data)
+        while data:
+            count = min(len(data), DIRECT_BUFFER_SIZE - self._used)
+            self._view[self._used:self._used + count] = data[:count]
+            self._used += count
+            data = data[count:]
+            if self._used == DIRECT_BUFFER_SIZE:
+                self._write_buffer()
+        return total
+
+    def _write_buffer(self):
+        written = 0
+        while written < self._used:
+            written += os.pwrite(self._fd, self._view[written:self._used], self._offset + written)
+        self._offset += self._used
+        self._used = 0
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        size = self.tell() if size is None else size
+        os.ftruncate(self._fd, size)
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._used:
+                import fcntl
+                flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
+                fcntl.fcntl(self._fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+                self._write_buffer()
+                os.fdatasync(self._fd)
+                _fadvise(self._fd, 0, 0, _DONTNEED)
+        finally:
+            self._view.release()
+            self._buffer.close()
+            os.close(self._fd)
+            super().close()
+
+def effective_mode(mode: Optional[str]) -> str:
+    """The mode that will actually be used here for the requested one."""
+    mode = mode or BUFFERED
+    if mode not in MODES:
+        raise ValueError(_("Unknown I/O mode: {}").format(mode))
+    if mode != BUFFERED and not hasattr(os, 'posix_fadvise'):
+        return BUFFERED
+    if mode == DIRECT and not hasattr(os, 'O_DIRECT'):
+        return STREAM
+    return mode
+
+def open_input(path: str, mode: Optional[str] = BUFFERED):
+    """Open a file to read in the given I/O mode."""
+    if effective_mode(mode) == BUFFERED:
+        return open(path, 'rb')
+    return StreamReader(path)
+
+def open_output(path: str, mode: Optional[str] = BUFFERED):
+    """Create (or truncate) a file to write in the given I/O mode."""
+    mode = effective_mode(mode)
+    if mode == DIRECT:
+        try:
+            return DirectWriter(path)
+        except OSError:
+            pass # EINVAL from a filesystem without O_DIRECT support
+    if mode == BUFFERED:
+        return open(path, 'wb')
+    return StreamWriter(path)
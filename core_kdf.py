@@ -0,0 +1,176 @@
+"""
+Key derivation engines.
+
+    pbkdf2-sha1     FLCK/FLKA files (Encryption.generate_key) and v2 headers
+    pbkdf2-sha256   files from the old core.py engine, and v2 headers
+    scrypt          v2 headers only, memory hard
+
+hashlib (OpenSSL), cryptography (OpenSSL) and pycryptodome all have a C
+implementation, how fast each one is depends on the build. On first use every
+available engine is checked against known test vectors (RFC 6070 and friends), so
+keys always come out bit for bit the same as before, and then the fastest one is
+kept for each hash. scrypt comes from hashlib with pycryptodome as the fallback.
+
+calibrate() measures this machine and picks the cost that makes one derivation
+take about a given time, see KdfParams in core_header for where it ends up.
+"""
+import hashlib
+import math
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from translate import _ # import for errors
+
+PBKDF2_SHA1 = 'sha1'
+PBKDF2_SHA256 = 'sha256'
+HASHES = (PBKDF2_SHA1, PBKDF2_SHA256)
+SCRYPT = 'scrypt'
+
+# (password, salt, iterations, length) -> expected key
+TEST_VECTORS = {
+    PBKDF2_SHA1: (b'password', b'salt', 4096, 20, bytes.fromhex('4b007901b765489abead49d926f721d065a429c1')),
+    PBKDF2_SHA256: (b'password', b'salt', 4096, 32,
+                    bytes.fromhex('c5e478d59288c841aa530db6845c4c8d962893a001ce4e11a4963873aa98134a')),
+}
+BENCHMARK_ITERATIONS = 10000
+
+SCRYPT_BLOCK_SIZE = 8 # r
+SCRYPT_PARALLELISM = 1 # p
+# Calibration never goes below these, a fast machine shouldn't mean weak files
+MIN_PBKDF2_ITERATIONS = 100000
+MIN_SCRYPT_COST = 2 ** 14
+MAX_SCRYPT_COST = 2 ** 20 # 1 GB of memory with r = 8
+MAX_SCRYPT_MEMORY = 128 * SCRYPT_BLOCK_SIZE * MAX_SCRYPT_COST
+
+def _hashlib_engine(hash_name: str) -> Callable[[bytes, bytes, int, int], bytes]:
+    def derive(password: bytes, salt: bytes, iterations: int, length: int) -> bytes:
+        return hashlib.pbkdf2_hmac(hash_name, password, salt, iterations, length)
+    return derive
+
+def _cryptography_engine(hash_name: str) -> Callable[[bytes, bytes, int, int], bytes]:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    algorithm = {PBKDF2_SHA1: hashes.SHA1, PBKDF2_SHA256: hashes.SHA256}[hash_name]
+
+    def derive(password: bytes, salt: bytes, iterations: int, length: int) -> bytes:
+        return PBKDF2HMAC(algorithm=algorithm(), length=length, salt=salt, iterations=iterations).derive(password)
+    return derive
+
+def _pycryptodome_engine(hash_name: str) -> Callable[[bytes, bytes, int, int], bytes]:
+    from Crypto.Hash import SHA1, SHA256
+    from Crypto.Protocol.KDF import PBKDF2
+    # Passing the module explicitly avoids the deprecated implicit SHA1 default (and its warning)
+    module = {PBKDF2_SHA1: SHA1, PBKDF2_SHA256: SHA256}[hash_name]
+
+    def derive(password: bytes, salt: bytes, iterations: int, length: int) -> bytes:
+        return PBKDF2(password, salt, dkLen=length, count=iterations, hmac_hash_module=module)
+    return derive
+
+ENGINES = {
+    'hashlib': _hashlib_engine,
+    'cryptography': _cryptography_engine,
+    'pycryptodome': _pycryptodome_engine,
+}
+
+def _load(name: str, hash_name: str) -> Optional[Callable[[bytes, bytes, int, int], bytes]]:
+    """The engine's derive function, or None if it's missing or gets the test vector wrong."""
+    try:
+        derive = ENGINES[name](hash_name)
+        password, salt, iterations, length, expected = TEST_VECTORS[hash_name]
+        if derive(password, salt, iterations, length) != expected:
+            return None
+    except (ImportError, ValueError, TypeError):
+        return None
+    return derive
+
+def benchmark(iterations: int = BENCHMARK_ITERATIONS, rounds: int = 2) -> Dict[str, Dict[str, float]]:
+    """Milliseconds per derivation for every working engine, scaled to 100k iterations."""
+    salt = b'\x00' * 32
+    results: Dict[str, Dict[str, float]] = {}
+    for hash_name in HASHES:
+        for name in ENGINES:
+            derive = _load(name, hash_name)
+            if derive is None:
+                continue
+            best = None
+            for _round in range(rounds):
+                start = time.perf_counter()
+                derive(b'benchmark', salt, iterations, 32)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results.setdefault(name, {})[hash_name] = best * 1000 * 100000 / iterations
+    return results
+
+_selected: Dict[str, Callable[[bytes, bytes, int, int], bytes]] = {}
+_selected_names: Dict[str, str] = {}
+_lock = threading.Lock()
+
+def _select():
+    timings = benchmark()
+    for hash_name in HASHES:
+        candidates = [name for name in timings if hash_name in timings[name]]
+        if not candidates:
+            raise ImportError(_("No PBKDF2 implementation available."))
+        fastest = min(candidates, key=lambda name: timings[name][hash_name])
+        _selected[hash_name] = _load(fastest, hash_name)
+        _selected_names[hash_name] = fastest
+
+def engine_names() -> Dict[str, str]:
+    """Which engine got picked for each hash, e.g. {'sha1': 'pycryptodome', ...}."""
+    with _lock:
+        if not _selected:
+            _select()
+        return dict(_selected_names)
+
+def pbkdf2(hash_name: str, password: bytes, salt: bytes, iterations: int, length: int = 32) -> bytes:
+    """PBKDF2-HMAC with the fastest verified engine. Same result as any other PBKDF2."""
+    derive = _selected.get(hash_name)
+    if derive is None:
+        if hash_name not in HASHES:
+            raise ValueError(_("Unsupported key derivation algorithm: {}").format(hash_name))
+        with _lock:
+            if not _selected:
+                _select()
+        derive = _selected[hash_name]
+    return derive(password, salt, iterations, length)
+
+def scrypt(password: bytes, salt: bytes, n: int, r: int = SCRYPT_BLOCK_SIZE, p: int = SCRYPT_PARALLELISM, length: int = 32) -> bytes:
+    """scrypt with cost n (a power of 2), block size r and parallelism p."""
+    # The parameters come from file headers, don't let a crafted one eat all the memory
+    if n < 2 or n & (n - 1) or r < 1 or p < 1 or 128 * r * n > MAX_SCRYPT_MEMORY:
+        raise ValueError(_("Unsupported key derivation parameters."))
+    try:
+        # OpenSSL wants to be told the memory it may use, 128 * r * n for the big table plus a bit
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, dklen=length,
+                              maxmem=128 * r * (n + p + 2) + 1024 * 1024)
+    except AttributeError:
+        # Python built without OpenSSL scrypt
+        from Crypto.Protocol.KDF import scrypt as pycryptodome_scrypt
+        return pycryptodome_scrypt(password, salt, length, N=n, r=r, p=p)
+
+def _time(derive: Callable[[], bytes], rounds: int = 2) -> float:
+    best = None
+    for _round in range(rounds):
+        start = time.perf_counter()
+        derive()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def calibrate(algorithm: str, target_ms: float) -> int:
+    """
+    Cost for one derivation to take about target_ms on this machine: iterations for
+    PBKDF2_SHA1/PBKDF2_SHA256, n for SCRYPT. Never below the MIN_* values.
+    """
+    salt = b'\x00' * 32
+    if algorithm == SCRYPT:
+        elapsed = _time(lambda: scrypt(b'calibrate', salt, MIN_SCRYPT_COST))
+        # scrypt time grows linearly with n, and n has to be a power of 2
+        exponent = round(math.log2(MIN_SCRYPT_COST * target_ms / 1000 / max(elapsed, 1e-6)))
+        return max(MIN_SCRYPT_COST, min(MAX_SCRYPT_COST, 2 ** exponent))
+    if algorithm not in HASHES:
+        raise ValueError(_("Unsupported key derivation algorithm: {}").format(algorithm))
+    elapsed = _time(lambda: pbkdf2(algorithm, b'calibrate', salt, BENCHMARK_ITERATIONS))
+    iterations = int(BENCHMARK_ITERATIONS * target_ms / 1000 / max(elapsed, 1e-6))
+    return max(MIN_PBKDF2_ITERATIONS, iterations - iterations % 1000)
@@ -0,0 +1,280 @@
+"""
+Support for .locked files written by the old core.py engine.
+
+Layout: salt (16 bytes) + Fernet token (urlsafe base64 text). Decoded, the token is
+version 0x80 | timestamp (8) | IV (16) | AES-128-CBC ciphertext | HMAC-SHA256 (32).
+The decoder here walks that stream chunk by chunk instead of loading and base64
+decoding the whole thing in memory like core.decrypt_file does.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import unpad
+
+from translate import _ # import for errors
+from core_control import OperationControl
+from core_metrics import OperationMetrics
+import core_cipher
+import core_kdf
+from core_cipher import CipherSuite
+
+SALT_LENGTH = 16
+LEGACY_ITERATIONS = 100000 # what core._derive_key uses
+FERNET_VERSION = 0x80
+FERNET_HEADER_LENGTH = 1 + 8 + 16 # version, timestamp, iv
+HMAC_LENGTH = 32
+# A Fernet token always starts with version 0x80, which is "gA" in base64
+TOKEN_PREFIX = b'gA'
+_BASE64URL = re.compile(rb'^[A-Za-z0-9_\-]+=*$')
+
+def is_legacy_file(path: str) -> bool:
+    """Check the first bytes of a file for the salt + Fernet token layout."""
+    try:
+        size = os.path.getsize(path)
+        # salt + smallest possible token (57 bytes decoded -> 76 base64 chars)
+        if size < SALT_LENGTH + 76 or (size - SALT_LENGTH) % 4:
+            return False
+        with open(path, 'rb') as f:
+            head = f.read(SALT_LENGTH + 64)
+            f.seek(-4, os.SEEK_END)
+            tail = f.read()
+    except OSError:
+        return False
+    token_head = head[SALT_LENGTH:]
+    return token_head.startswith(TOKEN_PREFIX) and bool(_BASE64URL.match(token_head)) and bool(_BASE64URL.match(tail))
+
+def derive_legacy_key(password: str, salt: bytes) -> bytes:
+    """Same PBKDF2-SHA256 derivation as core.py (before its base64 step)."""
+    return core_kdf.pbkdf2(core_kdf.PBKDF2_SHA256, password.encode(), salt, LEGACY_ITERATIONS, 32)
+
+def derive_legacy_keys(password: str, salt: bytes) -> Tuple[bytes, bytes]:
+    """The core.py key split into (signing key, encryption key)."""
+    key = derive_legacy_key(password, salt)
+    return key[:16], key[16:]
+
+def legacy_password_check(path: str, ciphers: Optional[CipherSuite] = None) -> Callable[[str], Optional[bytes]]:
+    """
+    Cheap password test for a legacy file: only the salt and the base64 tail get read,
+    and a candidate is rejected when the last AES block doesn't unpad. The few that
+    do unpad get their HMAC checked over the whole token, still without decrypting.
+    The returned function gives the derive_legacy_key() result for a password that
+    passes, else None.
+    """
+    ciphers = ciphers or core_cipher.get_suite()
+    with open(path, 'rb') as f:
+        salt = f.read(SALT_LENGTH)
+        token_chars = os.path.getsize(path) - SALT_LENGTH
+        # Start on a base64 quantum so the tail decodes on its own
+        start = max(0, token_chars - 128)
+        start -= start % 4
+        f.seek(SALT_LENGTH + start)
+        try:
+            tail = base64.urlsafe_b64decode(f.read())
+        except ValueError:
+            raise ValueError(_("Invalid password or corrupted file."))
+    # ... + previous block (or the iv) + last block + HMAC
+    if len(tail) < HMAC_LENGTH + 2 * AES.block_size:
+        raise ValueError(_("Invalid password or corrupted file."))
+    previous = tail[-HMAC_LENGTH - 2 * AES.block_size:-HMAC_LENGTH - AES.block_size]
+    last = tail[-HMAC_LENGTH - AES.block_size:-HMAC_LENGTH]
+
+    def check(password: str) -> Optional[bytes]:
+        key = derive_legacy_key(password, salt)
+        try:
+            unpad(ciphers.decryptor(key[16:], previous).decrypt(last), AES.block_size)
+        except ValueError:
+            return None
+        # About 1 in 256 wrong keys still unpad, the HMAC settles it for those few
+        return key if _hmac_matches(path, key[:16]) else None
+    return check
+
+def _hmac_matches(path: str, signing_key: bytes, chunk_size: int = 64 * 1024) -> bool:
+    """Check a legacy file's HMAC without decrypting anything."""
+    mac = hmac.new(signing_key, digestmod=hashlib.sha256)
+    held = b'' # the last HMAC_LENGTH bytes seen so far, which might be the tag
+    chunk_size -= chunk_size % 4
+    with open(path, 'rb') as f:
+        f.seek(SALT_LENGTH)
+        text = f.read(chunk_size)
+        while text:
+            try:
+                data = held + base64.urlsafe_b64decode(text)
+            except ValueError:
+                return False
+            mac.update(data[:-HMAC_LENGTH])
+            held = data[-HMAC_LENGTH:]
+            text = f.read(chunk_size)
+    return len(held) == HMAC_LENGTH and hmac.compare_digest(mac.digest(), held)
+
+def decrypt_legacy_stream(in_stream,
+                          out_stream,
+                          password: str,
+                          metrics: OperationMetrics,
+                          chunk_size: int = 64 * 1024,
+                          control: Optional[OperationControl] = None,
+                          progress_callback: Optional[Callable[[float], None]] = None,
+                          total_size: Optional[int] = None,
+                          ciphers: Optional[CipherSuite] = None,
+                          key: Optional[bytes] = None):
+    """
+    Stream a legacy file's plaintext into out_stream with constant memory. The HMAC
+    only gets checked at the very end, so on a ValueError the caller has to throw
+    away what was written. key is an already derived derive_legacy_key() result.
+    """
+    salt = in_stream.read(SALT_LENGTH)
+    metrics.count('bytes_read', len(salt))
+    if key:
+        signing_key, encryption_key = key[:16], key[16:]
+    else:
+        with metrics.phase('kdf'):
+            signing_key, encryption_key = derive_legacy_keys(password, salt)
+
+    mac = hmac.new(signing_key, digestmod=hashlib.sha256)
+    cipher = None
+    text_carry = b''       # base64 chars that don't make a full quantum yet
+    pending = bytearray()  # decoded bytes not written out yet
+    processed = SALT_LENGTH
+    # Read a multiple of 4 chars so every decoded piece lines up
+    chunk_size -= chunk_size % 4
+
+    with metrics.phase('read'):
+        text = in_stream.read(chunk_size)
+    while text:
+        with metrics.phase('read'):
+            next_text = in_stream.read(chunk_size)
+        if control:
+            control.checkpoint(len(text))
+        processed += len(text)
+        metrics.count('bytes_read', len(text))
+        metrics.count('chunks')
+
+        data = text_carry + text if text_carry else text
+        cut = len(data) - len(data) % 4
+        text_carry = data[cut:]
+        try:
+            with metrics.phase('decode'):
+                pending += base64.urlsafe_b64decode(data[:cut])
+        except ValueError:
+            raise ValueError(_("Invalid password or corrupted file."))
+
+        if cipher is None and len(pending) >= FERNET_HEADER_LENGTH:
+            if pending[0] != FERNET_VERSION:
+                raise ValueError(_("Invalid password or corrupted file."))
+            cipher = (ciphers or core_cipher.get_suite()).decryptor(encryption_key, bytes(pending[9:FERNET_HEADER_LENGTH]))
+            mac.update(pending[:FERNET_HEADER_LENGTH])
+            del pending[:FERNET_HEADER_LENGTH]
+
+        if cipher is not None and next_text:
+            # Hold back the HMAC plus one block until we know where the stream ends
+            ready = len(pending) - HMAC_LENGTH - AES.block_size
+            ready -= ready % AES.block_size
+            if ready > 0:
+                body = bytes(pending[:ready])
+                del pending[:ready]
+                with metrics.phase('hmac'):
+                    mac.update(body)
+                with metrics.phase('cipher'):
+                    plain = cipher.decrypt(body)
+                with metrics.phase('write'):
+                    out_stream.write(plain)
+                metrics.count('bytes_written', len(plain))
+
+        text = next_text
+        if progress_callback and total_size:
+            progress_callback(min(processed / total_size * 100, 100.0))
+
+    body = bytes(pending[:-HMAC_LENGTH])
+    tag = bytes(pending[-HMAC_LENGTH:])
+    if cipher is None or text_carry or len(tag) < HMAC_LENGTH or not body or len(body) % AES.block_size:
+        raise ValueError(_("Invalid password or corrupted file."))
+
+    with metrics.phase('hmac'):
+        mac.update(body)
+        if not hmac.compare_digest(mac.digest(), tag):
+            raise ValueError(_("Invalid password or corrupted file."))
+    with metrics.phase('cipher'):
+        plain = cipher.decrypt(body)
+    try:
+        plain = unpad(plain, AES.block_size)
+    except ValueError:
+        raise ValueError(_("Invalid password or corrupted file."))
+    with metrics.phase('write'):
+        out_stream.write(plain)
+    metrics.count('bytes_written', len(plain))
+
+def find_legacy_files(root: str) -> Iterator[str]:
+    """Yield every legacy .locked file under root (or root itself if it's one)."""
+    if os.path.isfile(root):
+        if is_legacy_file(root):
+            yield root
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith('.locked'):
+                path = os.path.join(dirpath, name)
+                if is_legacy_file(path):
+                    yield path
+
+class MigrationLog:
+    """
+    Append-only list of files that were already migrated, so an interrupted bulk
+    migration can pick up where it stopped. One absolute path per line.
+    """
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.done = set()
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.done = {line.rstrip('\n') for line in f if line.strip()}
+
+    def is_done(self, file_path: str) -> bool:
+        return os.path.abspath(file_path) in self.done
+
+    def mark_done(self, file_path: str):
+        file_path = os.path.abspath(file_path)
+        with self.lock:
+            self.done.add(file_path)
+            if self.path:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(file_path + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+
+def migrate_tree(encryption,
+                 root: str,
+                 password: str,
+                 workers: Optional[int] = None,
+                 resume_log: Optional[str] = None,
+                 control: Optional[OperationControl] = None,
+                 on_result: Optional[Callable[[str, bool, Optional[str]], None]] = None) -> Tuple[int, List[Tuple[str, str]]]:
+    """
+    Rewrite every legacy file under root into the current format using a pool of
+    workers. Each worker streams one file at a time, so memory stays bounded by
+    workers x chunk size. Returns (migrated count, [(path, error), ...]).
+    """
+    log = MigrationLog(resume_log)
+    pending = [p for p in find_legacy_files(root) if not log.is_done(p)]
+    migrated = 0
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4) as pool:
+        futures = {pool.submit(encryption.migrate_legacy_file, path, password, control=control): path for path in pending}
+        for future in as_completed(futures):
+            path = futures[future]
+            success, message = future.result()
+            if success:
+                migrated += 1
+                log.mark_done(path)
+            else:
+                failures.append((path, message))
+            if on_result:
+                on_result(path, success, message)
+    return migrated, failures
@@ -0,0 +1,241 @@
+"""
+Merkle tree over the encrypted content of a locked file (FLC2).
+
+The content is cut into CHUNK_SIZE pieces of ciphertext. Every piece is a leaf,
+SHA-256(0x00 + chunk), and every level above hashes pairs, SHA-256(0x01 + left +
+right) (or just 0x01 + left for the odd one out), up to a single root. encrypt_file
+builds the tree from what it writes, so there is no second read, and stores it in
+the header's data area with the root, chunk size and leaf count in TAG_MERKLE:
+
+    header fields | leaves | level 1 | ... | root | content
+
+It covers the ciphertext, so verify() needs no password. The chunks get hashed in
+parallel, and where a leaf doesn't match, the stored levels above it tell whether
+that chunk or the tree itself was damaged. This catches corruption, not tampering:
+whoever can rewrite the content can rewrite the tree as well.
+
+migrate and rekey (when converting an older file) write the tree the same way.
+Output whose size isn't known before it's written gets none, as there's nowhere
+to reserve room for it: encrypt_stream, Encryption.open('wb') and the in-memory
+encrypt_bytes/encrypt_into. Those files unlock fine, verify just reports that they
+were locked without integrity data.
+"""
+import hashlib
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from translate import _ # import for errors
+from core_control import OperationControl
+import core_header
+from core_header import LockHeader
+
+CHUNK_SIZE = 1024 * 1024
+HASH_SIZE = 32
+# Chunks hashed by one worker task, each task opens the file once
+CHUNKS_PER_TASK = 64
+
+def leaf_hash(data) -> bytes:
+    digest = hashlib.sha256(b'\x00')
+    digest.update(data)
+    return digest.digest()
+
+def node_hash(left: bytes, right: Optional[bytes] = None) -> bytes:
+    return hashlib.sha256(b'\x01' + left + (right or b'')).digest()
+
+def build_levels(leaves: List[bytes]) -> List[List[bytes]]:
+    """Every level of the tree, leaves first and the root (a list of one) last."""
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        below = levels[-1]
+        levels.append([node_hash(below[i], below[i + 1] if i + 1 < len(below) else None)
+                       for i in range(0, len(below), 2)])
+    return levels
+
+def leaf_count(content_size: int, chunk_size: int = CHUNK_SIZE) -> int:
+    return -(-content_size // chunk_size)
+
+def tree_size(leaves: int) -> int:
+    """Bytes the stored tree takes for this many leaves."""
+    nodes = leaves
+    while leaves > 1:
+        leaves = (leaves + 1) // 2
+        nodes += leaves
+    return nodes * HASH_SIZE
+
+def pack_field(chunk_size: int, leaves: int, root: bytes) -> bytes:
+    return struct.pack('>IQ', chunk_size, leaves) + root
+
+def unpack_field(value: bytes) -> Tuple[int, int, bytes]:
+    chunk_size, leaves = struct.unpack_from('>IQ', value)
+    root = value[12:12 + HASH_SIZE]
+    if not chunk_size or len(root) != HASH_SIZE:
+        raise ValueError(_("Incorrect password or corrupted file."))
+    return chunk_size, leaves, root
+
+class TreeBuilder:
+    """Passes writes on to out_stream and hashes them into CHUNK_SIZE leaves on the way."""
+    def __init__(self, out_stream, chunk_size: int = CHUNK_SIZE):
+        self._out = out_stream
+        self.chunk_size = chunk_size
+        self.leaves: List[bytes] = []
+        self._current = None
+        self._filled = 0
+
+    def write(self, data) -> int:
+        self._out.write(data)
+        view = memoryview(data).cast('B')
+        while view:
+            if self._current is None:
+                self._current = hashlib.sha256(b'\x00')
+            take = min(len(view), self.chunk_size - self._filled)
+            self._current.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.chunk_size:
+                self._finish_leaf()
+        return len(data)
+
+    def _finish_leaf(self):
+        self.leaves.append(self._current.digest())
+        self._current = None
+        self._filled = 0
+
+    def finish(self) -> List[List[bytes]]:
+        if self._current is not None:
+            self._finish_leaf()
+        return build_levels(self.leaves)
+
+def store_tree(path: str, header: LockHeader, levels: List[List[bytes]]) -> bool:
+    """
+    Put the tree in the data area a header reserved for it and rewrite the header to
+    point at it. Returns False (and leaves the file without one) if it doesn't fit,
+    e.g. because the input grew while it was being locked.
+    """
+    tree = b''.join(b''.join(level) for level in levels)
+    if len(tree) > header.header_size - header.fields_size or not levels[0]:
+        return False
+    header.fields[core_header.TAG_MERKLE] = pack_field(CHUNK_SIZE, len(levels[0]), levels[-1][0])
+    with open(path, 'r+b') as f:
+        f.write(header.pack())
+        f.write(tree)
+        f.flush()
+        os.fsync(f.fileno())
+    return True
+
+class VerifyReport(NamedTuple):
+    """
+    What verify() found. damaged holds (start, end) offsets into the content, the
+    ciphertext after the header. For most files those are also the offsets in the
+    unlocked file (CBC carries damage into the next 16 bytes). Not for sparse files,
+    whose content is the extent map and then only the data extents, and the map is
+    encrypted, so without the password there's no telling where the damage lands.
+    """
+    chunks: int
+    chunk_size: int
+    damaged: List[Tuple[int, int]]
+    tree_damaged: bool
+
+    @property
+    def intact(self) -> bool:
+        return not self.damaged and not self.tree_damaged
+
+def _hash_chunks(path: str, offset: int, chunk_size: int, first: int, last: int,
+                 control: Optional[OperationControl]) -> List[bytes]:
+    leaves = []
+    with open(path, 'rb') as f:
+        f.seek(offset + first * chunk_size)
+        for _index in range(first, last):
+            data = f.read(chunk_size)
+            if control:
+                control.checkpoint(len(data))
+            leaves.append(leaf_hash(data))
+    return leaves
+
+def verify(path: str,
+           workers: Optional[int] = None,
+           control: Optional[OperationControl] = None,
+           progress_callback: Optional[Callable[[float], None]] = None) -> VerifyReport:
+    """
+    Check a locked file against its tree, hashing the chunks on a pool of workers.
+    Raises ValueError if the file has no tree (v1 files, streams, folders).
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+        if magic != core_header.FILE_MAGIC:
+            raise ValueError(_("Only files locked by this version carry integrity data."))
+        header = LockHeader.read(f, magic)
+        if core_header.TAG_MERKLE not in header.fields:
+            raise ValueError(_("This file was locked without integrity data."))
+        chunk_size, leaves, root = unpack_field(header.fields[core_header.TAG_MERKLE])
+        size = tree_size(leaves)
+        if size > header.header_size - header.fields_size:
+            raise ValueError(_("Incorrect password or corrupted file."))
+        f.seek(core_header.PREAMBLE_SIZE + header.fields_size)
+        tree = f.read(size)
+    if len(tree) != size:
+        raise ValueError(_("Incorrect password or corrupted file."))
+
+    # The stored levels, same shape as build_levels() gives
+    stored, pos, count = [], 0, leaves
+    while True:
+        stored.append([tree[pos + i * HASH_SIZE:pos + (i + 1) * HASH_SIZE] for i in range(count)])
+        pos += count * HASH_SIZE
+        if count == 1:
+            break
+        count = (count + 1) // 2
+
+    tasks = [(first, min(first + CHUNKS_PER_TASK, leaves)) for first in range(0, leaves, CHUNKS_PER_TASK)]
+    computed_leaves: List[bytes] = []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4,
+                            initializer=control.apply_priority if control else None) as pool:
+        futures = [pool.submit(_hash_chunks, path, header.data_offset, chunk_size, first, last, control)
+                   for first, last in tasks]
+        for done, future in enumerate(futures, 1):
+            computed_leaves += future.result()
+            if progress_callback:
+                progress_callback(done / len(futures) * 100)
+    computed = build_levels(computed_leaves)
+
+    # A stored node can be trusted if it and its sibling hash to a trusted parent
+    top = len(stored) - 1
+    trusted = [[False] * len(level) for level in stored]
+    trusted[top][0] = stored[top][0] == root
+    for level in range(top - 1, -1, -1):
+        nodes = stored[level]
+        for index in range(len(nodes)):
+            parent = index // 2
+            if trusted[level + 1][parent]:
+                right = nodes[parent * 2 + 1] if parent * 2 + 1 < len(nodes) else None
+                trusted[level][index] = node_hash(nodes[parent * 2], right) == stored[level + 1][parent]
+
+    # Walk down from the root along the nodes that don't match. Where the stored tree
+    # can't be trusted any more, the whole subtree below has to count as damaged.
+    bad_leaves = []
+    pending = [(top, 0)] if computed[top][0] != root else []
+    while pending:
+        level, index = pending.pop()
+        if level == 0:
+            bad_leaves.append((index, index + 1))
+            continue
+        children = [child for child in (index * 2, index * 2 + 1) if child < len(stored[level - 1])]
+        if all(trusted[level - 1][child] for child in children):
+            pending += [(level - 1, child) for child in children if computed[level - 1][child] != stored[level - 1][child]]
+        else:
+            bad_leaves.append((index << level, min((index + 1) << level, leaves)))
+
+    content_size = os.path.getsize(path) - header.data_offset
+    damaged: List[Tuple[int, int]] = []
+    for first, last in sorted(bad_leaves):
+        start, end = first * chunk_size, last * chunk_size
+        if last == leaves and content_size > start:
+            end = content_size # only the last chunk can be short, unless the file got cut
+        if damaged and damaged[-1][1] >= start:
+            damaged[-1] = (damaged[-1][0], max(damaged[-1][1], end))
+        else:
+            damaged.append((start, end))
+    if content_size > leaves * chunk_size:
+        damaged.append((leaves * chunk_size, content_size)) # something got appended
+    tree_damaged = not all(all(level) for level in trusted)
+    return VerifyReport(leaves, chunk_size, damaged, tree_damaged)
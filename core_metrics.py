@@ -0,0 +1,107 @@
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+# Phases that are really just waiting on the disk
+IO_PHASES = ('read', 'write', 'cleanup')
+
+class OperationMetrics:
+    """
+    Per-phase timings and counters collected while one operation runs. Safe to share
+    between worker threads, phase times are then summed over all of them.
+    """
+    def __init__(self, operation: str, path: str):
+        self.operation = operation
+        self.path = path
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.phases: Dict[str, float] = {}  # phase name -> seconds
+        self.counters: Dict[str, int] = {'bytes_read': 0, 'bytes_written': 0, 'chunks': 0}
+        self.success: Optional[bool] = None
+        self.error: Optional[str] = None
+        self.total_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, counter: str, amount: int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def finish(self, success: bool, error: Optional[str] = None):
+        self.total_seconds = time.perf_counter() - self._start
+        self.success = success
+        self.error = error
+
+    def phase_ms(self, name: str) -> float:
+        return self.phases.get(name, 0.0) * 1000
+
+    def as_dict(self) -> Dict[str, Any]:
+        total_ms = self.total_seconds * 1000
+        return {
+            'operation': self.operation,
+            'path': self.path,
+            'started': self.started,
+            'success': self.success,
+            'error': self.error,
+            'total_ms': round(total_ms, 3),
+            'kdf_ms': round(self.phase_ms('kdf'), 3),
+            'cipher_ms': round(self.phase_ms('cipher'), 3),
+            'io_wait_ms': round(sum(self.phase_ms(p) for p in IO_PHASES), 3),
+            'phases_ms': {name: round(sec * 1000, 3) for name, sec in self.phases.items()},
+            'counters': dict(self.counters),
+            'mb_per_s': round(self.counters['bytes_read'] / (1024 * 1024) / self.total_seconds, 3) if self.total_seconds else 0.0,
+        }
+
+    def summary(self) -> str:
+        """Human readable breakdown, used by the CLI --stats flag."""
+        data = self.as_dict()
+        lines = [
+            f"{self.operation}: {data['total_ms']:.1f} ms total, {data['mb_per_s']:.2f} MB/s",
+            f"  kdf {data['kdf_ms']:.1f} ms, cipher {data['cipher_ms']:.1f} ms, io wait {data['io_wait_ms']:.1f} ms",
+        ]
+        for name, ms in sorted(data['phases_ms'].items(), key=lambda item: -item[1]):
+            lines.append(f"  {name:<10}{ms:>12.1f} ms")
+        lines.append("  " + ", ".join(f"{k}={v}" for k, v in data['counters'].items()))
+        return "\n".join(lines)
+
+def default_log_path() -> Path:
+    """Metrics log lives in a logs folder next to settings.config."""
+    if getattr(sys, 'frozen', False):
+        base_path = Path(sys.executable).parent
+    else:
+        base_path = Path(__file__).parent
+    return base_path / 'logs' / 'metrics.log'
+
+def create_log_sink(path: Optional[Path] = None,
+                    max_bytes: int = 5 * 1024 * 1024,
+                    backup_count: int = 5) -> Callable[[Dict[str, Any]], None]:
+    """Sink that appends one JSON object per line to a rotating log file."""
+    path = Path(path) if path else default_log_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    logger = logging.getLogger(f"filelocker.metrics.{path}")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if not logger.handlers:
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+
+    def sink(record: Dict[str, Any]):
+        logger.info(json.dumps(record))
+    return sink
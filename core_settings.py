@@ -13,13 +13,25 @@ DEFAULT_SETTINGS = {
     "remember_last_directory": True,
     "last_directory": "",
     "auto_launch_after_unlock": True,
+    "view_memory_budget_mb": 512, # plaintext all "view without unlocking" windows may keep in memory, see core_view
     "default_password_mode": "generate",  # or "manual"
     "confirm_file_operations": True,
     "show_password_strength": True,
     "max_history_entries": 50,
     "theme": "default",
     "nvda_enabled": True,
-    "nvda_verbosity": "default" # quiet, default, verbose
+    "nvda_verbosity": "default", # quiet, default, verbose
+    "io_rate_limit_mb": 0, # MB/s, 0 means unlimited
+    "low_priority_mode": False,
+    "metrics_log_enabled": False, # write per-operation timings to logs/metrics.log
+    "folder_workers": 0, # threads used to build/extract folder archives, 0 = one per CPU core
+    "folder_exclude_patterns": [], # gitignore style, e.g. ".git/", "node_modules/", "*.tmp"
+    "folder_include_patterns": [], # brings back things an exclude pattern caught
+    "cipher_backend": "auto", # auto (fastest on this machine), pycryptodome or cryptography
+    "io_mode": "buffered", # buffered, stream or direct (keeps big files out of the page cache), see core_io
+    "kdf_algorithm": "pbkdf2-sha1", # for newly locked items: pbkdf2-sha1, pbkdf2-sha256 or scrypt
+    "kdf_cost": 0, # iterations (or scrypt n), 0 = default, set by calibration
+    "kdf_target_ms": 0 # the time kdf_cost was calibrated for, 0 = not calibrated
 }
 
 class Settings:
@@ -0,0 +1,71 @@
+"""
+Free space preflight and output preallocation.
+
+Locking and unlocking write the whole output next to the input and only remove the
+input once the output is complete, so for a while both are on disk. check_space()
+makes sure the output fits before the first byte gets written instead of finding
+out from ENOSPC halfway through a big file. preallocate() then reserves the output
+in one go so the filesystem can hand out contiguous extents rather than growing the
+file one small append at a time.
+"""
+import os
+import shutil
+from typing import Optional
+
+from translate import _ # import for errors
+
+# Kept free on top of the output itself, for directory entries, metadata and the like
+SPACE_MARGIN = 1024 * 1024
+
+class InsufficientSpace(Exception):
+    """Raised by check_space() when the output wouldn't fit."""
+    def __init__(self, path: str, needed: int, available: int):
+        self.path = path
+        self.needed = needed
+        self.available = available
+        super().__init__(_("Not enough free space in {}: {} needed, {} available.").format(
+            path, format_size(needed), format_size(available)))
+
+def format_size(size: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if size < 1024:
+            return f"{size:.2f} {unit}"
+        size /= 1024
+    return f"{size:.2f} PB"
+
+def free_space(path: str) -> Optional[int]:
+    """Bytes available to us on the volume holding path (or its closest existing parent)."""
+    directory = os.path.abspath(path)
+    while not os.path.isdir(directory):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+    try:
+        return shutil.disk_usage(directory).free
+    except OSError:
+        return None
+
+def check_space(output_path: str, needed: int):
+    """
+    Raise InsufficientSpace unless needed bytes (plus SPACE_MARGIN) can be written at
+    output_path. Does nothing when the free space can't be found out.
+    """
+    available = free_space(output_path)
+    if available is not None and needed + SPACE_MARGIN > available:
+        raise InsufficientSpace(os.path.dirname(os.path.abspath(output_path)), needed + SPACE_MARGIN, available)
+
+def preallocate(f, size: int):
+    """
+    Reserve size bytes for a file that's just been opened for writing. When the final
+    size is only an upper bound, call f.truncate() after the last write.
+    """
+    if size <= 0:
+        return
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+    except OSError:
+        pass # not supported here, the writes will just allocate as they go
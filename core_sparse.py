@@ -0,0 +1,183 @@
+"""
+Sparse file support for locked files (FLC2).
+
+Disk images and database files are often mostly holes. encrypt_file finds the
+data extents with SEEK_DATA/SEEK_HOLE, and when the holes add up to something
+worth skipping, only the data gets encrypted. The content then starts with an
+extent map, encrypted along with the data:
+
+    logical size (8) + extent count (8) + count x (offset (8) + length (8))
+    followed by the data extents, one after another
+
+and TAG_SPARSE in the header holds the length of that map. Unlocking puts every
+extent back at its offset and seeks over the holes, so both I/O and disk use
+follow the real data size. That only works on a fresh file of our own, streams
+somebody else hands in (a pipe, stdout opened for appending, a BytesIO that's
+already half full) get the holes written out as zeros.
+"""
+import os
+import struct
+from typing import List, Optional, Tuple
+
+from translate import _ # import for errors
+import core_header
+
+# Holes smaller than this just get encrypted as zeros, it isn't worth an extent
+MIN_HOLE = 64 * 1024
+# ...and unless the holes add up to this much the file is locked as usual
+MIN_HOLE_TOTAL = 1024 * 1024
+ZERO_CHUNK = 1024 * 1024
+
+Extent = Tuple[int, int] # (offset, length)
+
+def data_extents(f, size: int) -> Optional[List[Extent]]:
+    """
+    Where the data in an open file is, holes shorter than MIN_HOLE merged away.
+    None if the platform or filesystem can't tell, or the file isn't sparse enough
+    to bother. Leaves the file positioned at 0.
+    """
+    if not hasattr(os, 'SEEK_DATA') or size < MIN_HOLE_TOTAL:
+        return None
+    fd = f.fileno()
+    extents: List[Extent] = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError:
+                break # ENXIO: nothing but a hole from here to the end
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            if extents and start - (extents[-1][0] + extents[-1][1]) < MIN_HOLE:
+                extents[-1] = (extents[-1][0], end - extents[-1][0])
+            else:
+                extents.append((start, end - start))
+            offset = end
+    except OSError:
+        return None # EINVAL: the filesystem doesn't know about holes
+    finally:
+        f.seek(0) # the lseeks went around any buffering the file object does
+    if size - sum(length for _offset, length in extents) < MIN_HOLE_TOTAL:
+        return None
+    return extents
+
+def pack_map(size: int, extents: List[Extent]) -> bytes:
+    return struct.pack('>QQ', size, len(extents)) + b''.join(struct.pack('>QQ', offset, length) for offset, length in extents)
+
+def unpack_map(data: bytes) -> Tuple[int, List[Extent]]:
+    """(logical size, extents), checked so a damaged map can't send writes anywhere odd."""
+    if len(data) < 16:
+        raise ValueError(_("Incorrect password or corrupted file."))
+    size, count = struct.unpack_from('>QQ', data)
+    if len(data) != 16 + 16 * count:
+        raise ValueError(_("Incorrect password or corrupted file."))
+    extents = [struct.unpack_from('>QQ', data, 16 + 16 * i) for i in range(count)]
+    end = 0
+    for offset, length in extents:
+        if offset < end or not length or offset + length > size:
+            raise ValueError(_("Incorrect password or corrupted file."))
+        end = offset + length
+    return size, extents
+
+def pack_field(map_size: int) -> bytes:
+    return struct.pack('>I', map_size)
+
+def map_length(header) -> Optional[int]:
+    """Length of the extent map in front of the content, None if it isn't sparse."""
+    if header is None or core_header.TAG_SPARSE not in header.fields:
+        return None
+    (length,) = struct.unpack('>I', header.fields[core_header.TAG_SPARSE])
+    return length
+
+class ExtentReader:
+    """Reads the extent map and then only the data extents of a file, for encryption."""
+    def __init__(self, f, size: int, extents: List[Extent]):
+        self._f = f
+        self._pending = pack_map(size, extents)
+        self.map_size = len(self._pending)
+        self._extents = list(extents)
+        self._index = 0
+        self._left = 0
+
+    @property
+    def packed_size(self) -> int:
+        """Everything read() hands out, map included."""
+        return self.map_size + sum(length for _offset, length in self._extents)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = ZERO_CHUNK
+        if self._pending:
+            data, self._pending = self._pending[:size], self._pending[size:]
+            return data
+        while not self._left:
+            if self._index == len(self._extents):
+                return b''
+            offset, self._left = self._extents[self._index]
+            self._index += 1
+            self._f.seek(offset)
+        data = self._f.read(min(size, self._left))
+        if not data:
+            raise ValueError(_("The file changed while it was being locked."))
+        self._left -= len(data)
+        return data
+
+class SparseWriter:
+    """
+    Takes the decrypted content of a sparse file and puts every extent back in place.
+    holes=True seeks over the holes and truncates to size at the end, only pass it for an
+    empty file that was just opened for writing, at position 0 and not appending.
+    """
+    def __init__(self, out_stream, map_size: int, holes: bool = False):
+        self._out = out_stream
+        self._map_size = map_size
+        self._map = bytearray()
+        self._extents: Optional[List[Extent]] = None
+        self.size = 0
+        self._index = 0
+        self._left = 0
+        self._position = 0
+        self._holes = holes
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast('B')
+        total = len(view)
+        if self._extents is None:
+            needed = self._map_size - len(self._map)
+            self._map += view[:needed]
+            view = view[needed:]
+            if len(self._map) < self._map_size:
+                return total
+            self.size, self._extents = unpack_map(bytes(self._map))
+        while view:
+            if not self._left:
+                if self._index == len(self._extents):
+                    raise ValueError(_("Incorrect password or corrupted file."))
+                offset, self._left = self._extents[self._index]
+                self._index += 1
+                self._move_to(offset)
+            take = min(len(view), self._left)
+            self._out.write(view[:take])
+            self._position += take
+            self._left -= take
+            view = view[take:]
+        return total
+
+    def _move_to(self, offset: int):
+        if self._holes:
+            self._out.seek(offset) # writing past the end leaves a hole
+        else:
+            while self._position < offset:
+                count = min(ZERO_CHUNK, offset - self._position)
+                self._out.write(bytes(count))
+                self._position += count
+        self._position = offset
+
+    def finish(self):
+        """Check everything arrived and give the output its full size."""
+        if self._extents is None or self._left or self._index != len(self._extents):
+            raise ValueError(_("Incorrect password or corrupted file."))
+        if self._holes:
+            self._out.truncate(self.size)
+        else:
+            self._move_to(self.size)
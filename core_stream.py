@@ -0,0 +1,217 @@
+import io
+import os
+from typing import Optional
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad, unpad
+
+from translate import _ # import for errors
+from core_metrics import OperationMetrics
+import core_header
+import core_merkle
+
+class LockedFileReader(io.RawIOBase):
+    """
+    Readable file object that hands out the plaintext of a locked file while decrypting
+    it chunk by chunk. Nothing gets written to disk. Use Encryption.open() to get one.
+    """
+    def __init__(self, raw, encryption, password: str, close_raw: bool = True, metrics: Optional[OperationMetrics] = None):
+        super().__init__()
+        self._raw = raw
+        self._close_raw = close_raw
+        self._chunk_size = encryption.chunk_size
+        self.metrics = metrics or OperationMetrics("open_read", getattr(raw, 'name', '-'))
+        self._cipher = encryption._read_file_header(raw, password, self.metrics)
+        self._plain = bytearray()
+        self._carry = b''
+        self._next = raw.read(self._chunk_size) # read ahead to spot the last block
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self):
+        chunk = self._next
+        if not chunk:
+            self._eof = True
+            return
+        self._next = self._raw.read(self._chunk_size)
+
+        data = self._carry + chunk if self._carry else chunk
+        cut = len(data) - len(data) % AES.block_size
+        self._carry = data[cut:]
+        if not self._next and self._carry:
+            raise ValueError(_("Incorrect password or corrupted file."))
+
+        plain = self._cipher.decrypt(data[:cut])
+        if not self._next:
+            try:
+                plain = unpad(plain, AES.block_size)
+            except ValueError:
+                raise ValueError(_("Incorrect password or corrupted file."))
+            self._eof = True
+        self._plain += plain
+
+    def readinto(self, buffer) -> int:
+        while not self._plain and not self._eof:
+            self._fill()
+        n = min(len(buffer), len(self._plain))
+        buffer[:n] = self._plain[:n]
+        del self._plain[:n]
+        return n
+
+    def close(self):
+        if not self.closed and self._close_raw:
+            self._raw.close()
+        super().close()
+
+class LockedFileWriter(io.RawIOBase):
+    """
+    Writable file object that encrypts everything written to it into the locked format.
+    The padding block is added on close(), so always close it (or use it in a with block).
+    After abort() close() adds nothing, and removes the file if it was ours to close.
+
+    tree_area reserves that many bytes after the header for a Merkle tree, which gets
+    built from the ciphertext as it goes by. Once closed, hand header and tree.finish()
+    to core_merkle.store_tree(). Only for FLC2 files of a known maximum size.
+    """
+    def __init__(self,
+                 raw,
+                 encryption,
+                 password: str,
+                 close_raw: bool = True,
+                 metrics: Optional[OperationMetrics] = None,
+                 folder: bool = False,
+                 tree_area: int = 0):
+        super().__init__()
+        self._raw = raw
+        self._close_raw = close_raw
+        self.metrics = metrics or OperationMetrics("open_write", getattr(raw, 'name', '-'))
+        self.header, self.tree = None, None
+        if tree_area:
+            self.header, self._cipher = encryption._create_file_header(password, self.metrics, folder=folder)
+            self.header.header_size += tree_area
+            packed = self.header.pack() + bytes(tree_area)
+            raw.write(packed)
+            self.metrics.count('bytes_written', len(packed))
+            self.tree = core_merkle.TreeBuilder(raw)
+        else:
+            self._cipher = encryption._write_file_header(raw, password, self.metrics, folder=folder)
+        self._out = self.tree or raw # where the ciphertext goes
+        self._carry = bytearray()
+        self.aborted = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast('B')
+        size = len(view)
+        if self.aborted:
+            return size # what's still buffered on top of us goes nowhere
+        if self._carry:
+            # Top up the partial block first
+            take = min(AES.block_size - len(self._carry), size)
+            self._carry += view[:take]
+            view = view[take:]
+            if len(self._carry) == AES.block_size:
+                self._out.write(self._cipher.encrypt(bytes(self._carry)))
+                self._carry.clear()
+        cut = len(view) - len(view) % AES.block_size
+        if cut:
+            # Whole blocks go straight from the caller's buffer into the cipher
+            self._out.write(self._cipher.encrypt(view[:cut]))
+        self._carry += view[cut:]
+        return size
+
+    def abort(self):
+        """The writing went wrong, so don't finish the file into something that unlocks."""
+        self.aborted = True
+
+    def close(self):
+        if not self.closed:
+            try:
+                if not self.aborted:
+                    self._out.write(self._cipher.encrypt(pad(bytes(self._carry), AES.block_size)))
+                    self._raw.flush()
+            finally:
+                if self._close_raw:
+                    self._raw.close()
+                    name = getattr(self._raw, 'name', None)
+                    if self.aborted and isinstance(name, str) and os.path.exists(name):
+                        os.remove(name)
+        super().close()
+
+class LockedBufferedWriter(io.BufferedWriter):
+    """BufferedWriter for a LockedFileWriter that aborts it when the with block raises."""
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.raw.abort()
+        return super().__exit__(exc_type, exc_value, traceback)
+
+def locked_size(encryption, plaintext_size: int) -> int:
+    """Exact size of the locked output for a plaintext of the given size."""
+    header_size = core_header.PREAMBLE_SIZE + core_header.DEFAULT_HEADER_SIZE
+    return header_size + (plaintext_size // AES.block_size + 1) * AES.block_size
+
+def header_length(encryption, data) -> int:
+    """Size of the header at the start of locked bytes, v1 or v2."""
+    magic = bytes(data[:4])
+    if magic == encryption.file_magic:
+        return len(magic) + encryption.salt_length + encryption.iv_length
+    if magic in core_header.MAGICS and len(data) >= core_header.PREAMBLE_SIZE:
+        return core_header.PREAMBLE_SIZE + int.from_bytes(bytes(data[4:8]), 'big')
+    raise ValueError(_("Not a valid locked file or incorrect password"))
+
+def encrypt_into(encryption, data, out, password: str) -> int:
+    """
+    Lock a bytes-like object into the writable buffer `out`, which must hold at least
+    locked_size(len(data)) bytes. With pycryptodome the whole blocks get encrypted right
+    into `out` and only the final partial block is copied, the cryptography backend
+    returns new bytes that get copied in once. Returns the number of bytes written.
+    """
+    src = memoryview(data).cast('B')
+    dst = memoryview(out).cast('B')
+    total = locked_size(encryption, len(src))
+    if len(dst) < total:
+        raise ValueError(_("Output buffer is too small, {} bytes needed.").format(total))
+
+    header = io.BytesIO()
+    cipher = encryption._write_file_header(header, password, OperationMetrics("encrypt_into", "-"))
+    header_bytes = header.getvalue()
+    pos = len(header_bytes)
+    dst[:pos] = header_bytes
+
+    cut = len(src) - len(src) % AES.block_size
+    if cut:
+        cipher.encrypt(src[:cut], output=dst[pos:pos + cut])
+        pos += cut
+    last = cipher.encrypt(pad(bytes(src[cut:]), AES.block_size))
+    dst[pos:pos + len(last)] = last
+    return pos + len(last)
+
+def decrypt_into(encryption, data, out, password: str) -> int:
+    """
+    Unlock locked bytes into the writable buffer `out`, which must be at least as big as
+    the ciphertext part of `data`. Returns the plaintext length (the padding that was
+    written past it can be ignored). Like encrypt_into, there's one extra copy with the
+    cryptography backend.
+    """
+    src = memoryview(data).cast('B')
+    dst = memoryview(out).cast('B')
+    header_size = header_length(encryption, src)
+    cipher = encryption._read_file_header(io.BytesIO(src[:header_size]), password, OperationMetrics("decrypt_into", "-"))
+
+    body = src[header_size:]
+    # Even empty content has its padding block
+    if not body or len(body) % AES.block_size:
+        raise ValueError(_("Incorrect password or corrupted file."))
+    if len(dst) < len(body):
+        raise ValueError(_("Output buffer is too small, {} bytes needed.").format(len(body)))
+
+    cipher.decrypt(body, output=dst[:len(body)])
+    try:
+        last_block = unpad(bytes(dst[len(body) - AES.block_size:len(body)]), AES.block_size)
+    except ValueError:
+        raise ValueError(_("Incorrect password or corrupted file."))
+    return len(body) - AES.block_size + len(last_block)
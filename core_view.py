@@ -0,0 +1,172 @@
+"""
+View a locked file without unlocking it.
+
+Unlocking a file just to look at it writes all of it out in plaintext, removes the
+.locked file and then has to lock everything again afterwards. A view decrypts into
+a file that only lives in memory and opens that with the default app instead:
+
+    tmpfs   a private folder on a RAM backed filesystem ($XDG_RUNTIME_DIR or /dev/shm).
+            The file keeps its name, so the right app opens it.
+    memfd   an anonymous memfd_create() file, handed out as /proc/<pid>/fd/<n>, where
+            there's no usable tmpfs. Apps have to go by the content here.
+
+The .locked file is only read, so viewing costs no disk writes and nothing needs
+locking afterwards. Views are read only and go away when they're closed or File
+Locker exits, views left over by a session that crashed are removed by the next one.
+All open views together stay under a memory budget (the view_memory_budget_mb
+setting), and on a sparse file only the data takes memory. Windows and macOS have
+neither, so views aren't available there.
+"""
+import os
+import shutil
+import tempfile
+from typing import Callable, Dict, List, Optional, Tuple
+
+from translate import _ # import for errors
+from core_control import OperationControl
+import core_space
+
+VIEW_PREFIX = 'filelocker-view-'
+# Locations checked for a tmpfs, in order
+TMPFS_CANDIDATES = (os.environ.get('XDG_RUNTIME_DIR'), '/dev/shm')
+MEMORY_FILESYSTEMS = ('tmpfs', 'ramfs')
+
+def _mounts() -> Dict[str, str]:
+    """Mount point -> filesystem type, from /proc/mounts."""
+    mounts = {}
+    try:
+        with open('/proc/mounts', 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 2:
+                    mounts[fields[1].replace('\\040', ' ')] = fields[2]
+    except OSError:
+        pass
+    return mounts
+
+def tmpfs_dir() -> Optional[str]:
+    """A writable directory on a memory backed filesystem, None if there isn't one."""
+    mounts = _mounts()
+    for candidate in TMPFS_CANDIDATES:
+        if not candidate or not os.path.isdir(candidate) or not os.access(candidate, os.W_OK | os.X_OK):
+            continue
+        mount = os.path.realpath(candidate)
+        while mount not in mounts and mount != os.path.dirname(mount):
+            mount = os.path.dirname(mount)
+        if mounts.get(mount) in MEMORY_FILESYSTEMS:
+            return candidate
+    return None
+
+def available() -> bool:
+    return tmpfs_dir() is not None or hasattr(os, 'memfd_create')
+
+def remove_stale_views(directory: Optional[str] = None):
+    """Remove the view folders of File Locker processes that are gone."""
+    directory = directory or tmpfs_dir()
+    if not directory:
+        return
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith(VIEW_PREFIX):
+            continue
+        try:
+            pid = int(name[len(VIEW_PREFIX):].split('-')[0])
+            os.kill(pid, 0)
+            continue # still running
+        except ProcessLookupError:
+            pass
+        except (ValueError, PermissionError):
+            continue # not ours to judge
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+class MemoryView:
+    """One decrypted file in memory. path is what to hand to the viewer."""
+    def __init__(self, path: str, size: int, fd: Optional[int] = None, directory: Optional[str] = None):
+        self.path = path
+        self.size = size
+        self._fd = fd
+        self._directory = directory
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+class ViewManager:
+    """Opens views and keeps track of the memory they use, one per main window."""
+    def __init__(self):
+        self.views: List[MemoryView] = []
+        remove_stale_views()
+
+    @property
+    def used(self) -> int:
+        return sum(view.size for view in self.views)
+
+    def open(self,
+             encryption,
+             input_path: str,
+             password: str,
+             budget_mb: float,
+             progress_callback: Optional[Callable[[float], None]] = None,
+             control: Optional[OperationControl] = None) -> Tuple[Optional[MemoryView], Optional[str]]:
+        """
+        Decrypt a locked file into memory, leaving the file itself alone. Returns
+        (view, None) or (None, error).
+        """
+        if encryption.get_operation_type(input_path) != "decrypt_file":
+            return None, _("Only files locked by File Locker can be viewed, folders and old format files have to be unlocked.")
+        if not available():
+            return None, _("Viewing without unlocking isn't available on this system.")
+
+        # The plaintext is never bigger than the locked file
+        needed = os.path.getsize(input_path)
+        budget = int(budget_mb * 1024 * 1024)
+        if self.used + needed > budget:
+            return None, _("Viewing this file needs {} of memory, but only {} of the view memory budget is left. "
+                           "Close the open views or raise the budget in Settings.").format(
+                core_space.format_size(needed), core_space.format_size(max(budget - self.used, 0)))
+
+        name = os.path.basename(encryption.get_output_path(input_path, "decrypt_file"))
+        base = tmpfs_dir()
+        directory, fd = None, None
+        try:
+            if base:
+                directory = tempfile.mkdtemp(prefix='{}{}-'.format(VIEW_PREFIX, os.getpid()), dir=base) # mode 700
+                core_space.check_space(directory, needed)
+                path = os.path.join(directory, name)
+                out = open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb')
+            else:
+                fd = os.memfd_create(name, os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+                path = '/proc/{}/fd/{}'.format(os.getpid(), fd)
+                out = open(os.dup(fd), 'wb')
+
+            with out, open(input_path, 'rb') as in_file:
+                # out is brand new, so the holes of sparse files can stay holes
+                success, message = encryption.decrypt_stream(in_file, out, password, progress_callback, control,
+                                                             total_size=needed, holes=True)
+            if not success:
+                raise ValueError(message)
+
+            # Read only, so changes can't get lost in a view without anyone noticing
+            if fd is None:
+                os.chmod(path, 0o400)
+            else:
+                import fcntl # memfd means Linux, fcntl isn't there on Windows
+                fcntl.fcntl(fd, fcntl.F_ADD_SEALS, fcntl.F_SEAL_WRITE | fcntl.F_SEAL_GROW | fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_SEAL)
+            view = MemoryView(path, needed, fd, directory)
+            self.views.append(view)
+            return view, None
+        except Exception as e:
+            MemoryView('', 0, fd, directory).close()
+            return None, str(e)
+
+    def close_all(self):
+        for view in self.views:
+            view.close()
+        self.views = []
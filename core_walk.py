@@ -0,0 +1,190 @@
+"""
+Directory walker used when locking folders.
+
+Built on os.scandir so the stat data that comes with each DirEntry gets reused
+instead of stat'ing every path again. Symlinks and special files (sockets, fifos,
+devices) are never followed or archived by accident, they're reported and skipped.
+
+Exclude/include rules use gitignore style patterns, checked against the path
+relative to the folder being locked:
+
+    node_modules/     a directory with that name anywhere (trailing / = directories only)
+    *.tmp             a file name anywhere ('*' and '?' stay inside one path segment)
+    /build            only build at the top level (a '/' anchors the pattern)
+    docs/**/*.pdf     '**' matches any number of directories
+
+The last matching rule wins and includes are checked after excludes, so an include
+can bring back something an exclude caught. An excluded directory is pruned
+without ever being opened, so nothing inside it can be included again (same as git).
+"""
+import os
+import re
+import stat
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from core_archive import SourceItem
+
+def _translate(pattern: str) -> str:
+    """Turn one gitignore style pattern (without leading/trailing '/') into a regex."""
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('/**', i) and i + 3 == len(pattern):
+            regex.append('(?:/.*)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                regex.append('[' + body.replace('\\', '\\\\') + ']')
+                i = end
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return ''.join(regex)
+
+class PathFilter:
+    """Ordered exclude/include rules, see the module docstring for the syntax."""
+    def __init__(self, excludes: Iterable[str] = (), includes: Iterable[str] = ()):
+        self.rules: List[Tuple[re.Pattern, bool, bool]] = [] # (regex, directories only, include)
+        for pattern in excludes:
+            self._add(pattern, include=False)
+        for pattern in includes:
+            self._add(pattern, include=True)
+
+    def _add(self, pattern: str, include: bool):
+        pattern = pattern.strip().replace('\\', '/')
+        if not pattern or pattern.startswith('#'):
+            return
+        if pattern.startswith('!'): # gitignore negation works as an include too
+            pattern, include = pattern[1:], not include
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        regex = _translate(pattern)
+        regex = '^' + regex + '$' if anchored else '^(?:.*/)?' + regex + '$'
+        self.rules.append((re.compile(regex), dir_only, include))
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+    def is_excluded(self, rel_path: str, is_dir: bool) -> bool:
+        """rel_path is '/' separated and relative to the folder being walked."""
+        excluded = False
+        for regex, dir_only, include in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                excluded = not include
+        return excluded
+
+    @classmethod
+    def from_settings(cls, settings, excludes: Iterable[str] = (), includes: Iterable[str] = ()) -> "PathFilter":
+        """Rules from settings plus any extra ones (e.g. from the command line)."""
+        return cls(list(settings.get('folder_exclude_patterns') or []) + list(excludes),
+                   list(settings.get('folder_include_patterns') or []) + list(includes))
+
+def walk(root: str,
+         path_filter: Optional[PathFilter] = None,
+         follow_symlinks: bool = False,
+         on_skip: Optional[Callable[[str, str], None]] = None) -> Iterator[SourceItem]:
+    """
+    Yield every directory and regular file under root (not root itself), parents
+    before children, sorted by name within a directory so archives come out the same
+    every time. on_skip(path, reason) hears about symlinks, special files, unreadable
+    directories and excluded items.
+    """
+    path_filter = path_filter or PathFilter()
+    visited = set() # (device, inode) of directories, only needed when following links
+    if follow_symlinks:
+        st = os.stat(root)
+        visited.add((st.st_dev, st.st_ino))
+    stack = [(root, '')]
+
+    while stack:
+        dir_path, prefix = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            if on_skip:
+                on_skip(dir_path, str(e))
+            continue
+
+        subdirs = []
+        for entry in entries:
+            rel_path = prefix + entry.name
+            try:
+                if entry.is_symlink() and not follow_symlinks:
+                    if on_skip:
+                        on_skip(entry.path, "symlink")
+                    continue
+                # Uses the data scandir already has where the platform provides it
+                st = entry.stat(follow_symlinks=follow_symlinks)
+            except OSError as e:
+                if on_skip:
+                    on_skip(entry.path, str(e))
+                continue
+
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if not is_dir and not stat.S_ISREG(st.st_mode):
+                if on_skip:
+                    on_skip(entry.path, "special file")
+                continue
+            if path_filter and path_filter.is_excluded(rel_path, is_dir):
+                if on_skip:
+                    on_skip(entry.path, "excluded")
+                continue
+
+            if is_dir:
+                if follow_symlinks:
+                    key = (st.st_dev, st.st_ino)
+                    if key in visited:
+                        if on_skip:
+                            on_skip(entry.path, "symlink loop")
+                        continue
+                    visited.add(key)
+                yield SourceItem(entry.path, rel_path, True, 0, st.st_mtime, stat.S_IMODE(st.st_mode))
+                subdirs.append((entry.path, rel_path + '/'))
+            else:
+                yield SourceItem(entry.path, rel_path, False, st.st_size, st.st_mtime, stat.S_IMODE(st.st_mode))
+
+        # Reversed so the stack pops them in name order
+        stack.extend(reversed(subdirs))
+
+def remove_walked(root: str, items: List[SourceItem]):
+    """
+    Delete what a walk returned after it got locked. Excluded and skipped things stay,
+    so directories that still hold some of them aren't removed either.
+    """
+    for item in items:
+        if not item.is_dir:
+            os.remove(item.path)
+    for item in sorted((i for i in items if i.is_dir), key=lambda i: i.arcname.count('/'), reverse=True):
+        try:
+            os.rmdir(item.path)
+        except OSError:
+            pass # still has excluded content
+    try:
+        os.rmdir(root)
+    except OSError:
+        pass
@@ -0,0 +1,357 @@
+"""
+Watch-folder mode: anything written into a drop folder gets locked automatically.
+
+Changes come from inotify on Linux (through ctypes, no extra packages) and from a
+polling scanner everywhere else. A file is only locked once it has stopped changing
+for `settle_seconds`, so half-copied files are left alone. Locking runs on a bounded
+thread pool, and the key for the password is derived once and reused for every file.
+
+Progress is kept in a small JSON state file. After a crash or restart, files that
+were in the middle of being locked get their partial .locked output cleaned up and
+are locked again, and files that failed are only retried once they change.
+"""
+import ctypes
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from core_control import OperationControl
+from core_header import KdfParams
+
+STATE_FILE_NAME = '.filelocker-watch.json'
+# Our own outputs and temporaries, never lock these
+SKIP_SUFFIXES = ('.locked', '.flka', '.migrating', '.rekeying')
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, name length
+
+class PollingSource:
+    """Finds new or changed files by rescanning the folder every `interval` seconds."""
+    def __init__(self, root: str, accept: Callable[[str], bool], interval: float = 1.0):
+        self.root = root
+        self.accept = accept
+        self.interval = interval
+        self._seen: Dict[str, Tuple[int, int]] = {}
+        self._next_scan = 0.0
+
+    def events(self, timeout: float) -> List[str]:
+        now = time.monotonic()
+        if now < self._next_scan:
+            time.sleep(min(timeout, self._next_scan - now))
+            return []
+        self._next_scan = now + self.interval
+
+        changed = []
+        current = {}
+        for path, st in _scan_files(self.root, self.accept):
+            signature = (st.st_size, st.st_mtime_ns)
+            current[path] = signature
+            if self._seen.get(path) != signature:
+                changed.append(path)
+        self._seen = current
+        return changed
+
+    def close(self):
+        pass
+
+class InotifySource:
+    """Linux inotify through ctypes. Subfolders get their own watch as they show up."""
+    def __init__(self, root: str, accept: Callable[[str], bool]):
+        self.root = root
+        self.accept = accept
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs: Dict[int, str] = {}
+        self._add_tree(root)
+
+    def _add_watch(self, path: str):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed: {}".format(path))
+        self._dirs[wd] = path
+
+    def _add_tree(self, path: str):
+        self._add_watch(path)
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames:
+                self._add_watch(os.path.join(dirpath, name))
+
+    def events(self, timeout: float) -> List[str]:
+        readable, _w, _x = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+
+        changed = []
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+            name = data[pos + _EVENT_HEADER.size:pos + _EVENT_HEADER.size + length].rstrip(b'\0')
+            pos += _EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # The kernel dropped events, fall back to a full scan
+                changed.extend(path for path, st in _scan_files(self.root, self.accept))
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may have landed before the watch existed, pick them up too
+                    try:
+                        self._add_tree(path)
+                    except OSError:
+                        continue
+                    changed.extend(p for p, st in _scan_files(path, self.accept))
+            else:
+                changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+def _scan_files(root: str, accept: Callable[[str], bool]) -> Iterator[Tuple[str, os.stat_result]]:
+    """Every regular file under root that accept() likes, with its stat."""
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False) and accept(entry.path):
+                            yield entry.path, entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+
+class WatchState:
+    """
+    JSON file remembering files being locked and files that failed, written atomically
+    (temp file + rename) and at most every `save_interval` seconds.
+    """
+    def __init__(self, path: str, save_interval: float = 1.0):
+        self.path = path
+        self.save_interval = save_interval
+        self.in_progress: Dict[str, float] = {}             # path -> start time
+        self.failed: Dict[str, Tuple[int, int, str]] = {}  # path -> (size, mtime_ns, error)
+        self.locked_count = 0
+        self._dirty = False
+        self._last_save = 0.0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.in_progress = dict(data.get('in_progress', {}))
+                self.failed = {k: tuple(v) for k, v in data.get('failed', {}).items()}
+                self.locked_count = data.get('locked_count', 0)
+            except (OSError, ValueError):
+                pass # unreadable state, start over, the folder scan finds everything again
+
+    def start(self, path: str):
+        with self._lock:
+            self.in_progress[path] = time.time()
+            self._dirty = True
+
+    def finish(self, path: str, success: bool, signature: Tuple[int, int], error: Optional[str]):
+        with self._lock:
+            self.in_progress.pop(path, None)
+            if success:
+                self.failed.pop(path, None)
+                self.locked_count += 1
+            else:
+                self.failed[path] = (signature[0], signature[1], error or "")
+            self._dirty = True
+
+    def abandon(self, path: str):
+        """Forget a file that got cancelled half way, it'll be picked up again next run."""
+        with self._lock:
+            self.in_progress.pop(path, None)
+            self._dirty = True
+
+    def take_in_progress(self) -> List[str]:
+        """Files the previous run was still working on, cleared from the state."""
+        with self._lock:
+            paths = list(self.in_progress)
+            self.in_progress.clear()
+            self._dirty = True
+        return paths
+
+    def should_skip(self, path: str, signature: Tuple[int, int]) -> bool:
+        """A failed file is only retried once it changed."""
+        failed = self.failed.get(path)
+        return failed is not None and (failed[0], failed[1]) == signature
+
+    def save(self, force: bool = False):
+        with self._lock:
+            now = time.monotonic()
+            if not self._dirty or (not force and now - self._last_save < self.save_interval):
+                return
+            data = {'version': 1, 'in_progress': self.in_progress, 'failed': self.failed, 'locked_count': self.locked_count}
+            self._dirty = False
+            self._last_save = now
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+class FolderWatcher:
+    """Runs the watch loop for one folder until the control gets cancelled."""
+    def __init__(self,
+                 encryption,
+                 folder: str,
+                 password: str,
+                 workers: Optional[int] = None,
+                 settle_seconds: float = 2.0,
+                 state_path: Optional[str] = None,
+                 control: Optional[OperationControl] = None,
+                 on_result: Optional[Callable[[str, bool, Optional[str]], None]] = None,
+                 use_polling: bool = False,
+                 poll_interval: float = 1.0):
+        self.encryption = encryption
+        self.folder = os.path.abspath(folder)
+        self.password = password
+        self.workers = workers or os.cpu_count() or 4
+        self.settle_seconds = settle_seconds
+        self.state = WatchState(state_path or os.path.join(self.folder, STATE_FILE_NAME))
+        self.control = control or OperationControl()
+        self.on_result = on_result
+        self.use_polling = use_polling
+        self.poll_interval = poll_interval
+        # path -> (last change seen, (size, mtime_ns) at that point)
+        self._pending: Dict[str, Tuple[float, Optional[Tuple[int, int]]]] = {}
+        self._inflight: Dict[str, object] = {}
+
+    def accept(self, path: str) -> bool:
+        """Whether a path is something we should lock at all."""
+        name = os.path.basename(path)
+        if name.startswith(STATE_FILE_NAME) or name.endswith(SKIP_SUFFIXES):
+            return False
+        path_filter = self.encryption.path_filter
+        if path_filter:
+            rel_path = os.path.relpath(path, self.folder).replace(os.sep, '/')
+            parts = rel_path.split('/')
+            # Excluding a folder excludes everything in it
+            for i in range(1, len(parts)):
+                if path_filter.is_excluded('/'.join(parts[:i]), True):
+                    return False
+            if path_filter.is_excluded(rel_path, False):
+                return False
+        return True
+
+    def _create_source(self):
+        if not self.use_polling and sys.platform.startswith('linux'):
+            try:
+                return InotifySource(self.folder, self.accept)
+            except (OSError, AttributeError):
+                pass # no inotify (or out of watches), polling still works
+        return PollingSource(self.folder, self.accept, self.poll_interval)
+
+    def _recover(self):
+        """Clean up after files that were being locked when the last run stopped."""
+        for path in self.state.take_in_progress():
+            partial = path + '.locked'
+            if os.path.exists(path) and os.path.exists(partial):
+                os.remove(partial) # the original is still there, so the output is incomplete
+        self.state.save(force=True)
+
+    def _touch(self, path: str):
+        if path not in self._inflight:
+            self._pending[path] = (time.monotonic(), self._signature(path))
+
+    def _signature(self, path: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def _dispatch(self, pool: ThreadPoolExecutor, new_key: Tuple[KdfParams, bytes]):
+        """Submit every pending file that has been quiet long enough, up to the in-flight limit."""
+        now = time.monotonic()
+        for path, (changed_at, last_signature) in list(self._pending.items()):
+            if len(self._inflight) >= self.workers * 4:
+                return
+            if now - changed_at < self.settle_seconds:
+                continue
+            signature = self._signature(path)
+            if signature is None:
+                del self._pending[path] # gone (moved away or deleted)
+                continue
+            if signature != last_signature:
+                # Still being written, give it another settle period
+                self._pending[path] = (now, signature)
+                continue
+            del self._pending[path]
+            if self.state.should_skip(path, signature):
+                continue
+            if self.encryption.get_operation_type(path) != "encrypt_file":
+                continue # already locked under some other name
+            self.state.start(path)
+            self._inflight[path] = pool.submit(self._lock_file, path, signature, new_key)
+
+    def _lock_file(self, path: str, signature: Tuple[int, int], new_key: Tuple[KdfParams, bytes]):
+        success, message = self.encryption.encrypt_file(path, self.password, control=self.control, new_key=new_key)
+        if not success and self.control.is_cancelled():
+            self.state.abandon(path) # rolled back, not a real failure
+            return
+        self.state.finish(path, success, signature, message)
+        if self.on_result:
+            self.on_result(path, success, message)
+
+    def _reap(self):
+        for path, future in list(self._inflight.items()):
+            if future.done():
+                del self._inflight[path]
+
+    def run(self):
+        self._recover()
+        source = self._create_source()
+        try:
+            # Whatever is already sitting in the folder counts as new
+            for path, st in _scan_files(self.folder, self.accept):
+                self._pending[path] = (time.monotonic(), (st.st_size, st.st_mtime_ns))
+
+            kdf = self.encryption.new_kdf_params()
+            new_key = (kdf, kdf.derive(self.password))
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="filelocker-watch",
+                                    initializer=self.control.apply_priority) as pool:
+                while not self.control.is_cancelled():
+                    # Only idle long when nothing is queued, otherwise the pool starves
+                    timeout = 0.02 if self._pending or self._inflight else 0.25
+                    for path in source.events(timeout=timeout):
+                        if self.accept(path):
+                            self._touch(path)
+                    self._reap()
+                    self._dispatch(pool, new_key)
+                    self.state.save()
+        finally:
+            source.close()
+            self.state.save(force=True)
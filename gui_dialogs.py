@@ -12,6 +12,7 @@ from nvda import speak
 # my custom stuff
 from variables import SUPPORTED_LANGUAGES
 from paths import CONFIG_FILE
+from core_header import KdfParams
 
 class PasswordGeneratorDialog(wx.Dialog):
     def __init__(self, parent, settings):
@@ -159,13 +160,14 @@ class PasswordGeneratorDialog(wx.Dialog):
             wx.MessageBox(msg, _("Success"), wx.OK | wx.ICON_INFORMATION)
 
 class ProgressDialog(wx.Dialog):
-    def __init__(self, parent, title: str, message: str):
+    def __init__(self, parent, title: str, message: str, control=None):
         super().__init__(
             parent,
             title=title,
-            size=(400, 150),
+            size=(400, 190 if control else 150),
             style=wx.DEFAULT_DIALOG_STYLE & ~wx.CLOSE_BOX
         )
+        self.control = control
         self.init_ui(message)
         speak(message)
     
@@ -182,9 +184,37 @@ class ProgressDialog(wx.Dialog):
         self.status = wx.StaticText(panel, label="0%")
         vbox.Add(self.status, 0, wx.ALL | wx.ALIGN_CENTER, 5)
         
+        if self.control:
+            btn_sizer = wx.BoxSizer(wx.HORIZONTAL)
+            self.pause_btn = wx.Button(panel, label=_("Pause"))
+            self.cancel_btn = wx.Button(panel, wx.ID_CANCEL, label=_("Cancel"))
+            self.pause_btn.Bind(wx.EVT_BUTTON, self.on_pause)
+            self.cancel_btn.Bind(wx.EVT_BUTTON, self.on_cancel)
+            btn_sizer.Add(self.pause_btn, 0, wx.ALL, 5)
+            btn_sizer.Add(self.cancel_btn, 0, wx.ALL, 5)
+            vbox.Add(btn_sizer, 0, wx.ALIGN_CENTER)
+        
         panel.SetSizer(vbox)
         self.Center()
     
+    def on_pause(self, event):
+        if self.control.is_paused():
+            self.control.resume()
+            self.pause_btn.SetLabel(_("Pause"))
+            speak(_("Resumed"))
+        else:
+            self.control.pause()
+            self.pause_btn.SetLabel(_("Resume"))
+            speak(_("Paused"))
+    
+    def on_cancel(self, event):
+        # The worker thread notices this at its next checkpoint and rolls back
+        self.control.cancel()
+        self.pause_btn.Disable()
+        self.cancel_btn.Disable()
+        self.status.SetLabel(_("Cancelling..."))
+        speak(_("Cancelling"))
+    
     def update(self, value: float, status_text: str = None):
         wx.CallAfter(self._do_update, value, status_text)
     
@@ -238,6 +268,9 @@ class SettingsDialog(wx.Dialog):
         accessibility_panel = self.create_accessibility_panel(notebook)
         notebook.AddPage(accessibility_panel, _("Accessibility"))
         
+        performance_panel = self.create_performance_panel(notebook)
+        notebook.AddPage(performance_panel, _("Performance"))
+        
         sizer = wx.BoxSizer(wx.VERTICAL)
         sizer.Add(notebook, 1, wx.EXPAND | wx.ALL, 5)
         
@@ -271,6 +304,14 @@ class SettingsDialog(wx.Dialog):
         self.auto_launch = wx.CheckBox(panel, label=_("Auto-launch files after unlock"))
         self.auto_launch.SetValue(self.settings.get('auto_launch_after_unlock'))
         
+        view_budget_label = wx.StaticText(panel, label=_("Memory for viewing files without unlocking (MB):"))
+        self.view_budget = wx.SpinCtrl(panel, min=16, max=65536)
+        self.view_budget.SetValue(int(self.settings.get('view_memory_budget_mb')))
+        
+        view_budget_box = wx.BoxSizer(wx.HORIZONTAL)
+        view_budget_box.Add(view_budget_label, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
+        view_budget_box.Add(self.view_budget, 0)
+        
         theme_label = wx.StaticText(panel, label=_("Theme:"))
         self.theme_choice = wx.Choice(panel, choices=[_("Default"), _("Dark")])
         self.theme_choice.SetSelection(0 if self.settings.get('theme') == 'default' else 1)
@@ -296,6 +337,7 @@ class SettingsDialog(wx.Dialog):
         
         box_sizer.Add(self.remember_dir, 0, wx.ALL, 5)
         box_sizer.Add(self.auto_launch, 0, wx.ALL, 5)
+        box_sizer.Add(view_budget_box, 0, wx.ALL, 5)
         box_sizer.Add(theme_box, 0, wx.ALL, 5)
         box_sizer.Add(lang_box, 0, wx.ALL, 5)
         
@@ -401,6 +443,121 @@ class SettingsDialog(wx.Dialog):
         panel.SetSizer(sizer)
         return panel
     
+    def create_performance_panel(self, parent):
+        panel = wx.Panel(parent)
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        
+        box = wx.StaticBox(panel, label=_("Background Jobs"))
+        box_sizer = wx.StaticBoxSizer(box, wx.VERTICAL)
+        
+        rate_label = wx.StaticText(panel, label=_("Disk throughput limit in MB/s (0 = unlimited):"))
+        self.rate_limit = wx.SpinCtrl(panel, min=0, max=100000)
+        self.rate_limit.SetValue(int(self.settings.get('io_rate_limit_mb')))
+        
+        rate_box = wx.BoxSizer(wx.HORIZONTAL)
+        rate_box.Add(rate_label, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
+        rate_box.Add(self.rate_limit, 0)
+        
+        workers_label = wx.StaticText(panel, label=_("Worker threads for folders (0 = automatic):"))
+        self.folder_workers = wx.SpinCtrl(panel, min=0, max=256)
+        self.folder_workers.SetValue(int(self.settings.get('folder_workers')))
+        
+        workers_box = wx.BoxSizer(wx.HORIZONTAL)
+        workers_box.Add(workers_label, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
+        workers_box.Add(self.folder_workers, 0)
+        
+        backend_label = wx.StaticText(panel, label=_("Encryption engine:"))
+        self.backend_choices = [_("Automatic (fastest)"), "PyCryptodome", "cryptography (OpenSSL)"]
+        self.backend_keys = ["auto", "pycryptodome", "cryptography"]
+        self.cipher_backend = wx.Choice(panel, choices=self.backend_choices)
+        
+        try:
+            self.cipher_backend.SetSelection(self.backend_keys.index(self.settings.get('cipher_backend')))
+        except ValueError:
+            self.cipher_backend.SetSelection(0)
+        
+        backend_box = wx.BoxSizer(wx.HORIZONTAL)
+        backend_box.Add(backend_label, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
+        backend_box.Add(self.cipher_backend, 0)
+        
+        io_label = wx.StaticText(panel, label=_("Disk cache use for big files:"))
+        self.io_mode_choices = [_("Normal"), _("Streaming (don't fill the cache)"), _("Direct I/O (bypass the cache)")]
+        self.io_mode_keys = ["buffered", "stream", "direct"]
+        self.io_mode = wx.Choice(panel, choices=self.io_mode_choices)
+        
+        try:
+            self.io_mode.SetSelection(self.io_mode_keys.index(self.settings.get('io_mode')))
+        except ValueError:
+            self.io_mode.SetSelection(0)
+        
+        io_box = wx.BoxSizer(wx.HORIZONTAL)
+        io_box.Add(io_label, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
+        io_box.Add(self.io_mode, 0)
+        
+        self.low_priority = wx.CheckBox(panel, label=_("Run operations with low CPU and disk priority"))
+        self.low_priority.SetValue(self.settings.get('low_priority_mode'))
+        
+        self.metrics_log = wx.CheckBox(panel, label=_("Write operation timings to the metrics log"))
+        self.metrics_log.SetValue(self.settings.get('metrics_log_enabled'))
+        
+        box_sizer.Add(rate_box, 0, wx.ALL, 5)
+        box_sizer.Add(workers_box, 0, wx.ALL, 5)
+        box_sizer.Add(backend_box, 0, wx.ALL, 5)
+        box_sizer.Add(io_box, 0, wx.ALL, 5)
+        box_sizer.Add(self.low_priority, 0, wx.ALL, 5)
+        box_sizer.Add(self.metrics_log, 0, wx.ALL, 5)
+        
+        sizer.Add(box_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        
+        folder_box = wx.StaticBox(panel, label=_("Folder Locking"))
+        folder_sizer = wx.StaticBoxSizer(folder_box, wx.VERTICAL)
+        
+        exclude_label = wx.StaticText(panel, label=_("Leave out (one pattern per line, e.g. .git/ or *.tmp):"))
+        self.exclude_patterns = wx.TextCtrl(panel, style=wx.TE_MULTILINE, size=(-1, 70))
+        self.exclude_patterns.SetValue("\n".join(self.settings.get('folder_exclude_patterns')))
+        
+        include_label = wx.StaticText(panel, label=_("Always include (one pattern per line):"))
+        self.include_patterns = wx.TextCtrl(panel, style=wx.TE_MULTILINE, size=(-1, 50))
+        self.include_patterns.SetValue("\n".join(self.settings.get('folder_include_patterns')))
+        
+        folder_sizer.Add(exclude_label, 0, wx.ALL, 5)
+        folder_sizer.Add(self.exclude_patterns, 0, wx.EXPAND | wx.ALL, 5)
+        folder_sizer.Add(include_label, 0, wx.ALL, 5)
+        folder_sizer.Add(self.include_patterns, 0, wx.EXPAND | wx.ALL, 5)
+        
+        sizer.Add(folder_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        
+        kdf_box = wx.StaticBox(panel, label=_("Key Derivation (newly locked items)"))
+        kdf_sizer = wx.StaticBoxSizer(kdf_box, wx.VERTICAL)
+        
+        kdf_label = wx.StaticText(panel, label=_("Algorithm:"))
+        self.kdf_keys = ["pbkdf2-sha1", "pbkdf2-sha256", "scrypt"]
+        self.kdf_algorithm = wx.Choice(panel, choices=["PBKDF2-SHA1", "PBKDF2-SHA256", _("scrypt (memory hard)")])
+        
+        try:
+            self.kdf_algorithm.SetSelection(self.kdf_keys.index(self.settings.get('kdf_algorithm')))
+        except ValueError:
+            self.kdf_algorithm.SetSelection(0)
+        
+        kdf_algorithm_box = wx.BoxSizer(wx.HORIZONTAL)
+        kdf_algorithm_box.Add(kdf_label, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
+        kdf_algorithm_box.Add(self.kdf_algorithm, 0)
+        
+        target_label = wx.StaticText(panel, label=_("Calibrate to this many ms per password check (0 = standard):"))
+        self.kdf_target = wx.SpinCtrl(panel, min=0, max=10000)
+        self.kdf_target.SetValue(int(self.settings.get('kdf_target_ms')))
+        
+        kdf_target_box = wx.BoxSizer(wx.HORIZONTAL)
+        kdf_target_box.Add(target_label, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
+        kdf_target_box.Add(self.kdf_target, 0)
+        
+        kdf_sizer.Add(kdf_algorithm_box, 0, wx.ALL, 5)
+        kdf_sizer.Add(kdf_target_box, 0, wx.ALL, 5)
+        
+        sizer.Add(kdf_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        panel.SetSizer(sizer)
+        return panel
+    
     def on_save(self, event):
         selected_idx = self.lang_choice.GetSelection()
         new_code = self.the_lang_codes[selected_idx]
@@ -420,6 +577,7 @@ class SettingsDialog(wx.Dialog):
         
         self.settings.set('remember_last_directory', self.remember_dir.GetValue())
         self.settings.set('auto_launch_after_unlock', self.auto_launch.GetValue())
+        self.settings.set('view_memory_budget_mb', self.view_budget.GetValue())
         self.settings.set('theme', 'dark' if self.theme_choice.GetSelection() == 1 else 'default')
         self.settings.set('default_password_mode', 'manual' if self.pwd_mode.GetSelection() == 1 else 'generate')
         self.settings.set('default_password_length', int(self.pwd_length.GetString(self.pwd_length.GetSelection())))
@@ -429,10 +587,33 @@ class SettingsDialog(wx.Dialog):
         self.settings.set('nvda_enabled', self.nvda_enabled.GetValue())
         selected_verbosity_idx = self.nvda_verbosity.GetSelection()
         self.settings.set('nvda_verbosity', self.verbosity_keys[selected_verbosity_idx])
+        self.settings.set('io_rate_limit_mb', self.rate_limit.GetValue())
+        self.settings.set('low_priority_mode', self.low_priority.GetValue())
+        self.settings.set('metrics_log_enabled', self.metrics_log.GetValue())
+        self.settings.set('folder_workers', self.folder_workers.GetValue())
+        self.settings.set('cipher_backend', self.backend_keys[self.cipher_backend.GetSelection()])
+        self.settings.set('io_mode', self.io_mode_keys[self.io_mode.GetSelection()])
+        self.settings.set('folder_exclude_patterns', [line.strip() for line in self.exclude_patterns.GetValue().splitlines() if line.strip()])
+        self.settings.set('folder_include_patterns', [line.strip() for line in self.include_patterns.GetValue().splitlines() if line.strip()])
+        self.save_kdf_settings()
         
         speak(_("Settings saved."))
         self.EndModal(wx.ID_OK)
     
+    def save_kdf_settings(self):
+        algorithm = self.kdf_keys[self.kdf_algorithm.GetSelection()]
+        target_ms = self.kdf_target.GetValue()
+        if algorithm == self.settings.get('kdf_algorithm') and target_ms == self.settings.get('kdf_target_ms'):
+            return
+        cost = 0
+        if target_ms:
+            # Takes a second or two, it times a few real derivations
+            with wx.BusyCursor():
+                cost = KdfParams.calibrate(algorithm, target_ms).iterations
+        self.settings.set('kdf_algorithm', algorithm)
+        self.settings.set('kdf_target_ms', target_ms)
+        self.settings.set('kdf_cost', cost)
+    
     def on_reset_defaults(self, event):
         msg = _("Are you sure you want to reset all settings to defaults?")
         title = _("Confirm Reset")
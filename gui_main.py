@@ -22,7 +22,13 @@ from gui_utils import (
 from gui_dialogs import PasswordGeneratorDialog, ProgressDialog, SettingsDialog
 from core_history import PasswordHistory
 from core_encryption import Encryption
-from core_paths import is_path_restricted, requires_admin, is_admin
+import core_header
+from core_control import OperationControl
+from core_metrics import create_log_sink
+from core_walk import PathFilter
+from core_paths import PathPolicy
+from core_view import ViewManager
+import core_view
 
 class MainWindow(wx.Frame):
     def __init__(self, settings):
@@ -34,13 +40,30 @@ class MainWindow(wx.Frame):
         )
         
         self.settings = settings
-        self.encryption = Encryption()
+        self.encryption = Encryption(
+            metrics_sink=create_log_sink() if self.settings.get('metrics_log_enabled') else None,
+            workers=self.settings.get('folder_workers') or None,
+            path_filter=PathFilter.from_settings(self.settings),
+            cipher_backend=self.settings.get('cipher_backend'),
+            kdf_algorithm=self.settings.get('kdf_algorithm'),
+            kdf_cost=self.settings.get('kdf_cost'),
+            io_mode=self.settings.get('io_mode')
+        )
         self.password_history = PasswordHistory(self.settings.get('max_history_entries'))
         self.current_item = None
         self.item_queue = [] # For batch processing
         self.is_processing = False
+        self.active_control = None
+        # Set when the user reuses one unlock password for the rest of the queue
+        self.batch_password = None
+        self.prepared_keys = {} # path -> key derived ahead of time for batch_password
         self.program_directory = self.get_program_directory()
+        self.path_policy = PathPolicy({
+            self.program_directory.resolve(): _("Cannot lock items in the program directory for safety.")
+        })
         self.history_data = {}
+        self.views = ViewManager() # locked files opened for viewing, decrypted into memory
+        self.views_available = core_view.available() # no tmpfs or memfd (Windows, macOS), no views
         
         self.panel = wx.Panel(self)
         self.main_sizer = wx.BoxSizer(wx.VERTICAL)
@@ -101,7 +124,11 @@ class MainWindow(wx.Frame):
         action_sizer = wx.BoxSizer(wx.HORIZONTAL)
         self.process_btn = wx.Button(self.panel, label=_("Lock/Unlock"))
         self.process_btn.Bind(wx.EVT_BUTTON, self.on_process_action)
-        action_sizer.Add(self.process_btn, 1, wx.EXPAND)
+        self.view_btn = wx.Button(self.panel, label=_("View Without Unlocking"))
+        self.view_btn.Bind(wx.EVT_BUTTON, self.on_view_action)
+        self.view_btn.Show(self.views_available)
+        action_sizer.Add(self.process_btn, 1, wx.EXPAND | wx.RIGHT if self.views_available else wx.EXPAND, 5)
+        action_sizer.Add(self.view_btn, 0, wx.EXPAND)
         
         # History list
         history_box = wx.StaticBox(self.panel, label=_("Recent Items"))
@@ -128,9 +155,17 @@ class MainWindow(wx.Frame):
         open_file_item = file_menu.Append(wx.ID_OPEN, _("Open &File...\tCtrl+O"))
         open_folder_item = file_menu.Append(wx.ID_ANY, _("Open F&older...\tCtrl+Shift+O"))
         file_menu.AppendSeparator()
+        if self.views_available:
+            view_item = file_menu.Append(wx.ID_ANY, _("&View Without Unlocking\tCtrl+Shift+V"))
+            close_views_item = file_menu.Append(wx.ID_ANY, _("&Close Views"))
+            self.Bind(wx.EVT_MENU, self.on_view_action, view_item)
+            self.Bind(wx.EVT_MENU, self.on_close_views, close_views_item)
+            file_menu.AppendSeparator()
         exit_item = file_menu.Append(wx.ID_EXIT, _("E&xit\tAlt+F4"))
         
         settings_item = tools_menu.Append(wx.ID_PREFERENCES, _("&Settings\tCtrl+,"))
+        change_password_item = tools_menu.Append(wx.ID_ANY, _("Change &Password...\tCtrl+K"))
+        known_passwords_item = tools_menu.Append(wx.ID_ANY, _("Unlock with &Known Passwords\tCtrl+U"))
         tools_menu.AppendSeparator()
         clear_history_item = tools_menu.Append(wx.ID_ANY, _("Clear Password &History"))
         
@@ -145,6 +180,8 @@ class MainWindow(wx.Frame):
         self.Bind(wx.EVT_MENU, self.on_browse_folder, open_folder_item)
         self.Bind(wx.EVT_MENU, self.on_exit, exit_item)
         self.Bind(wx.EVT_MENU, self.on_settings, settings_item)
+        self.Bind(wx.EVT_MENU, self.on_change_password, change_password_item)
+        self.Bind(wx.EVT_MENU, self.on_unlock_with_known_passwords, known_passwords_item)
         self.Bind(wx.EVT_MENU, self.on_clear_history, clear_history_item)
         self.Bind(wx.EVT_MENU, self.on_about, about_item)
 
@@ -156,21 +193,18 @@ class MainWindow(wx.Frame):
         self.SetDropTarget(FileDropTarget(self))
 
     def can_process_item(self, path: str) -> tuple[bool, str]:
-        p = Path(path).resolve()
-        if self.program_directory in p.parents or p == self.program_directory:
-            return False, _("Cannot lock items in the program directory for safety.")
-        
-        is_restricted, reason = is_path_restricted(path)
-        return not is_restricted, reason
+        return self.path_policy.check(path)
 
     def update_ui_state(self):
         has_item = bool(self.current_item) and os.path.exists(self.current_item)
         self.process_btn.Enable(has_item and not self.is_processing)
+        self.view_btn.Enable(self.views_available and has_item and not self.is_processing
+                             and self.encryption.get_operation_type(self.current_item) == "decrypt_file")
         
         if has_item:
             self.update_item_info()
             op_type = self.encryption.get_operation_type(self.current_item)
-            if op_type in ["decrypt_file", "decrypt_folder"]:
+            if op_type in ["decrypt_file", "decrypt_legacy_file", "decrypt_folder"]:
                 status_text = _("Locked")
             else:
                 status_text = _("Unlocked")
@@ -231,15 +265,26 @@ class MainWindow(wx.Frame):
         for i in range(3): self.history_list.SetColumnWidth(i, wx.LIST_AUTOSIZE_USEHEADER)
 
     def handle_dropped_items(self, paths: List[str]):
+        self.path_policy.forget()
+        errors = []
+        existing = []
         for path in paths:
             if os.path.exists(path):
-                can_process, reason = self.can_process_item(path)
-                if can_process:
-                    self.item_queue.append(path)
-                else:
-                    show_error_dialog(self, reason)
+                existing.append(path)
             else:
-                show_error_dialog(self, _("Item not found: {}").format(path))
+                errors.append(_("Item not found: {}").format(path))
+        for path, can_process, reason in self.path_policy.check_many(existing):
+            if can_process:
+                self.item_queue.append(path)
+            else:
+                errors.append(reason)
+
+        # One dialog for the whole drop, not one per rejected item
+        if errors:
+            message = "\n".join(errors[:10])
+            if len(errors) > 10:
+                message += "\n" + _("...and {} more.").format(len(errors) - 10)
+            show_error_dialog(self, message)
 
         if not self.is_processing and self.item_queue:
             self.process_next_item()
@@ -247,6 +292,7 @@ class MainWindow(wx.Frame):
     def process_next_item(self):
         if not self.item_queue:
             self.is_processing = False
+            self.end_batch_unlock()
             self.update_ui_state()
             show_success_dialog(self, _("All operations completed!"))
             return
@@ -278,6 +324,7 @@ class MainWindow(wx.Frame):
                 self.set_current_item(dlg.GetPath())
     
     def set_current_item(self, path: str):
+        self.path_policy.forget()
         can_process, reason = self.can_process_item(path)
         if not can_process:
             show_error_dialog(self, reason)
@@ -303,9 +350,12 @@ class MainWindow(wx.Frame):
                 if self.is_processing: self.process_next_item() # Continue queue if batch processing
                 return
         
-        # For decryption, always ask for password
+        # For decryption, always ask for password (unless it's the batch password)
         if not is_encrypt:
-            self.show_password_entry_for_unlock()
+            if self.batch_password:
+                self.start_operation(self.batch_password)
+            else:
+                self.show_password_entry_for_unlock()
             return
 
         # For encryption, check history or show generator/manual entry
@@ -341,16 +391,43 @@ class MainWindow(wx.Frame):
     def show_password_entry_for_unlock(self):
         with wx.TextEntryDialog(self, _("Enter password to unlock:"), _("Unlock"), style=wx.TE_PASSWORD) as dlg:
             if dlg.ShowModal() == wx.ID_OK:
-                self.start_operation(dlg.GetValue())
+                password = dlg.GetValue()
+                if password and self.is_processing:
+                    self.offer_batch_unlock(password)
+                self.start_operation(password)
             elif self.is_processing: self.process_next_item()
+
+    def offer_batch_unlock(self, password: str):
+        """Offer to reuse the password for the other locked items waiting in the queue."""
+        locked = [path for path in self.item_queue
+                  if (self.encryption.get_operation_type(path) or "").startswith("decrypt")]
+        if not locked:
+            return
+        msg = _("Use this password for the other {} locked items in the queue?").format(len(locked))
+        if wx.MessageBox(msg, _("Unlock All"), wx.YES_NO | wx.ICON_QUESTION) != wx.YES:
+            return
+        self.batch_password = password
+        self.prepared_keys = {}
+        prepared_keys = self.prepared_keys
+
+        def derive_thread():
+            # Every KDF runs on the pool now, so the unlocks that follow skip it
+            core_header.derive_keys(self.encryption, locked, password,
+                                    workers=self.encryption.workers, on_key=prepared_keys.__setitem__)
+
+        threading.Thread(target=derive_thread, daemon=True).start()
+
+    def end_batch_unlock(self):
+        self.batch_password = None
+        self.prepared_keys = {}
                 
-    def start_operation(self, password: str):
+    def start_operation(self, password: str, key: Optional[bytes] = None, keep_input: bool = False):
         if not self.current_item or not password:
             if self.is_processing: self.process_next_item()
             return
 
         # *** NEW: Proactive administrator check ***
-        if requires_admin(self.current_item) and not is_admin():
+        if self.path_policy.requires_admin(self.current_item):
             msg = _("This operation requires administrator privileges. Please restart File Locker as an administrator to proceed.")
             show_error_dialog(self, msg, title=_("Administrator Privileges Required"))
             self.on_operation_complete() # Abort and handle UI state
@@ -360,6 +437,7 @@ class MainWindow(wx.Frame):
         op_map = {
             "encrypt_file": (self.encryption.encrypt_file, _("Locking File")),
             "decrypt_file": (self.encryption.decrypt_file, _("Unlocking File")),
+            "decrypt_legacy_file": (self.encryption.decrypt_legacy_file, _("Unlocking File")),
             "encrypt_folder": (self.encryption.encrypt_folder, _("Locking Folder")),
             "decrypt_folder": (self.encryption.decrypt_folder, _("Unlocking Folder")),
         }
@@ -370,18 +448,34 @@ class MainWindow(wx.Frame):
             return
             
         op_func, title = op_map[op_type]
-        progress_dlg = ProgressDialog(self, title, f"{title}...")
+        control = OperationControl(
+            rate_limit_mb=self.settings.get('io_rate_limit_mb'),
+            low_priority=self.settings.get('low_priority_mode')
+        )
+        self.active_control = control
+        progress_dlg = ProgressDialog(self, title, f"{title}...", control=control)
         progress_dlg.Show()
         
+        extra = {}
+        if keep_input and op_type == "decrypt_file":
+            extra['keep_input'] = True
+        if key is not None:
+            extra['key'] = key
+        elif op_type.startswith("decrypt") and password == self.batch_password:
+            # Derived in the background by offer_batch_unlock, None if it isn't ready yet
+            extra['key'] = self.prepared_keys.pop(self.current_item, None)
+
         def operation_thread():
             try:
                 original_path = self.current_item
-                success, msg = op_func(self.current_item, password, progress_dlg.update)
+                success, msg = op_func(self.current_item, password, progress_dlg.update, control=control, **extra)
                 wx.CallAfter(progress_dlg.Destroy)
                 
                 if success:
                     new_path = self.get_new_path(original_path, op_type)
                     wx.CallAfter(self.on_operation_success, original_path, new_path, password, op_type)
+                elif control.is_cancelled():
+                    wx.CallAfter(self.on_operation_cancelled)
                 else:
                     wx.CallAfter(self.on_operation_error, op_type, msg)
             except Exception as e:
@@ -392,11 +486,7 @@ class MainWindow(wx.Frame):
         threading.Thread(target=operation_thread).start()
     
     def get_new_path(self, old_path, op_type):
-        if op_type == 'encrypt_file': return old_path + '.locked'
-        if op_type == 'encrypt_folder': return old_path + '.flka'
-        if op_type == 'decrypt_file': return old_path[:-7]
-        if op_type == 'decrypt_folder': return old_path[:-5]
-        return old_path
+        return self.encryption.get_output_path(old_path, op_type)
 
     def on_operation_success(self, old_path, new_path, password, op_type):
         is_encrypt = "encrypt" in op_type
@@ -437,12 +527,67 @@ class MainWindow(wx.Frame):
         show_error_dialog(self, full_message)
         self.on_operation_complete()
 
+    def on_operation_cancelled(self):
+        # Cancelling stops the whole batch, not just the current item
+        self.item_queue.clear()
+        self.is_processing = False
+        self.end_batch_unlock()
+        self.active_control = None
+        self.update_ui_state()
+        show_success_dialog(self, _("Operation cancelled. No changes were made."), title=_("Cancelled"))
+
     def on_operation_complete(self):
+        self.active_control = None
         if self.is_processing:
             wx.CallAfter(self.process_next_item)
         else:
             self.update_ui_state()
 
+    def on_view_action(self, event):
+        """Decrypt the selected locked file into memory and open that, the .locked file stays as it is."""
+        path = self.current_item
+        if self.is_processing or not path or self.encryption.get_operation_type(path) != "decrypt_file":
+            show_error_dialog(self, _("Select a locked file first."))
+            return
+        with wx.TextEntryDialog(self, _("Enter password to view:"), _("View Without Unlocking"), style=wx.TE_PASSWORD) as dlg:
+            if dlg.ShowModal() != wx.ID_OK or not dlg.GetValue():
+                return
+            password = dlg.GetValue()
+
+        control = OperationControl(
+            rate_limit_mb=self.settings.get('io_rate_limit_mb'),
+            low_priority=self.settings.get('low_priority_mode')
+        )
+        self.active_control = control
+        self.is_processing = True
+        self.update_ui_state()
+        title = _("Opening File")
+        progress_dlg = ProgressDialog(self, title, f"{title}...", control=control)
+        progress_dlg.Show()
+
+        def view_thread():
+            view, msg = self.views.open(self.encryption, path, password, self.settings.get('view_memory_budget_mb'),
+                                        progress_dlg.update, control=control)
+            wx.CallAfter(progress_dlg.Destroy)
+            wx.CallAfter(self.on_view_ready, view, msg, control.is_cancelled())
+
+        threading.Thread(target=view_thread).start()
+
+    def on_view_ready(self, view, error_message: Optional[str], cancelled: bool):
+        self.active_control = None
+        self.is_processing = False
+        self.update_ui_state()
+        if view is not None:
+            self.SetStatusText(_("Viewing {} from memory, the file stays locked.").format(os.path.basename(self.current_item)))
+            self.launch_item(view.path)
+        elif not cancelled:
+            show_error_dialog(self, error_message or _("Could not open item."))
+
+    def on_close_views(self, event):
+        count = len(self.views.views)
+        self.views.close_all()
+        self.SetStatusText(_("{} view(s) closed.").format(count))
+
     def launch_item(self, path):
         try:
             if sys.platform == 'win32':
@@ -469,14 +614,135 @@ class MainWindow(wx.Frame):
         op_type = self.encryption.get_operation_type(path)
         if "decrypt" in op_type:
             speak(_("Attempting to unlock {} from history.").format(os.path.basename(path)))
-            self.start_operation(password)
+            # Checked against the header first, so a wrong entry never writes out garbage
+            self.unlock_with_candidates(path, self.password_history.candidate_passwords(path), chosen=password)
+
+    def on_unlock_with_known_passwords(self, event):
+        path = self.current_item
+        if self.is_processing or not path or "decrypt" not in (self.encryption.get_operation_type(path) or ""):
+            show_error_dialog(self, _("Select a locked file or folder first."))
+            return
+        candidates = self.password_history.candidate_passwords(path)
+        if not candidates:
+            show_error_dialog(self, _("There are no passwords in the history to try."))
+            return
+        self.SetStatusText(_("Trying {} known passwords...").format(len(candidates)))
+        self.unlock_with_candidates(path, candidates)
+
+    def unlock_with_candidates(self, path: str, candidates: List[str], chosen: Optional[str] = None):
+        """
+        Find which candidate opens path (in the background), then unlock it with that one.
+        chosen is the password the user picked, if it fits it's used like a typed one and
+        the other candidates only get tried when it doesn't.
+        """
+        def search_thread():
+            try:
+                if chosen:
+                    found = self.encryption.find_password(path, [chosen])
+                    if found:
+                        wx.CallAfter(self.on_password_search_complete, path, found, True)
+                        return
+                found = self.encryption.find_password(path, [candidate for candidate in candidates if candidate != chosen],
+                                                      workers=self.encryption.workers)
+            except (OSError, ValueError) as e:
+                wx.CallAfter(show_error_dialog, self, str(e))
+                return
+            wx.CallAfter(self.on_password_search_complete, path, found)
+
+        threading.Thread(target=search_thread, daemon=True).start()
+
+    def on_password_search_complete(self, path: str, found, chosen: bool = False):
+        if not found:
+            show_error_dialog(self, _("None of the known passwords unlock this item."))
+            self.update_ui_state()
+            return
+        if len(found) > 1:
+            # v1 files only have their padding to check, which some wrong passwords pass too
+            show_error_dialog(self, _("{} of the known passwords fit this file and it was locked by an older version "
+                                      "that can't tell which one is right. Nothing was unlocked, unlock it by "
+                                      "typing the password.").format(len(found)))
+            self.update_ui_state()
+            return
+        if self.is_processing or self.current_item != path:
+            return # the user moved on in the meantime
+        password, key, exact = found[0]
+        if chosen:
+            self.start_operation(password, key=key)
+            return
+        if not exact:
+            show_success_dialog(self, _("This file was locked by an older version, so the password can't be fully "
+                                        "confirmed. The locked file will be kept, delete it yourself once the "
+                                        "unlocked file checks out."), title=_("Unlock"))
+        self.start_operation(password, key=key, keep_input=not exact)
 
     def on_settings(self, event):
         with SettingsDialog(self, self.settings) as dlg:
             if dlg.ShowModal() == wx.ID_OK:
                 ThemeManager.apply_theme(self, self.settings.get('theme'))
+                self.encryption.workers = self.settings.get('folder_workers') or None
+                self.encryption.path_filter = PathFilter.from_settings(self.settings)
+                self.encryption.cipher_backend = self.settings.get('cipher_backend')
+                self.encryption.kdf_algorithm = self.settings.get('kdf_algorithm')
+                self.encryption.kdf_cost = self.settings.get('kdf_cost')
+                self.encryption.io_mode = self.settings.get('io_mode')
                 self.update_history_list()
     
+    def on_change_password(self, event):
+        path = self.current_item
+        if self.is_processing or not path or "decrypt" not in (self.encryption.get_operation_type(path) or ""):
+            show_error_dialog(self, _("Select a locked file or folder first."))
+            return
+
+        with wx.TextEntryDialog(self, _("Enter current password:"), _("Change Password"), style=wx.TE_PASSWORD) as dlg:
+            if dlg.ShowModal() != wx.ID_OK:
+                return
+            old_password = dlg.GetValue()
+        with wx.TextEntryDialog(self, _("Enter new password:"), _("Change Password"), style=wx.TE_PASSWORD) as dlg:
+            if dlg.ShowModal() != wx.ID_OK:
+                return
+            new_password = dlg.GetValue()
+        if not new_password:
+            show_error_dialog(self, _("Password cannot be empty!"))
+            return
+        with wx.TextEntryDialog(self, _("Confirm new password:"), _("Change Password"), style=wx.TE_PASSWORD) as dlg:
+            if dlg.ShowModal() != wx.ID_OK:
+                return
+            if dlg.GetValue() != new_password:
+                show_error_dialog(self, _("Passwords do not match!"))
+                return
+
+        control = OperationControl(
+            rate_limit_mb=self.settings.get('io_rate_limit_mb'),
+            low_priority=self.settings.get('low_priority_mode')
+        )
+        self.active_control = control
+        self.is_processing = True
+        self.update_ui_state()
+        progress_dlg = ProgressDialog(self, _("Changing Password"), _("Changing Password") + "...", control=control)
+        progress_dlg.Show()
+
+        def rekey_thread():
+            # Current format files only get a new header, older ones are converted once
+            success, msg = self.encryption.rekey(path, old_password, new_password, progress_dlg.update, control=control)
+            wx.CallAfter(progress_dlg.Destroy)
+            wx.CallAfter(self.on_rekey_complete, path, new_password, success, msg)
+
+        threading.Thread(target=rekey_thread).start()
+
+    def on_rekey_complete(self, path: str, new_password: str, success: bool, error_message: Optional[str]):
+        self.is_processing = False
+        self.active_control = None
+        if success:
+            self.password_history.add_entry(path, new_password)
+            self.update_history_list()
+            show_success_dialog(self, _("Password changed successfully!"))
+        else:
+            details = error_message or ""
+            if "Incorrect password" in details or "corrupted file" in details:
+                details = _("Please check the password or the file may be corrupted.")
+            show_error_dialog(self, _("Failed to change password!") + (f"\n\n{_('Reason')}: {details}" if details else ""))
+        self.update_ui_state()
+
     def on_clear_history(self, event):
         if wx.MessageBox(_("Clear all password history? This cannot be undone."), _("Confirm Clear"), wx.YES_NO | wx.ICON_QUESTION) == wx.YES:
             self.password_history.clear_history()
@@ -497,5 +763,9 @@ class MainWindow(wx.Frame):
         if self.is_processing:
             if wx.MessageBox(_("An operation is in progress. Are you sure you want to quit?"), _("Confirm Exit"), wx.YES_NO | wx.ICON_WARNING) != wx.YES:
                 return
+            # Let the worker roll back its partial output before the process exits
+            if self.active_control:
+                self.active_control.cancel()
+        self.views.close_all()
         self.settings.save_settings()
         event.Skip()
\ No newline at end of file
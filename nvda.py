@@ -43,16 +43,16 @@ def load_nvda_dll():
 
         if os.path.exists(local_dll_path):
             nvdaControllerClient = ctypes.cdll.LoadLibrary(local_dll_path)
-            print(f"NVDA Controller DLL loaded successfully from: {local_dll_path}")
+            print(f"NVDA Controller DLL loaded successfully from: {local_dll_path}", file=sys.stderr)
         else:
-            print(f"Warning: NVDA DLL not found at {local_dll_path}. NVDA speech is disabled.")
+            print(f"Warning: NVDA DLL not found at {local_dll_path}. NVDA speech is disabled.", file=sys.stderr)
             nvdaControllerClient = None
 
     except OSError as e:
-        print(f"Warning: Could not load the NVDA Controller DLL. NVDA speech output will be disabled. Error: {e}")
+        print(f"Warning: Could not load the NVDA Controller DLL. NVDA speech output will be disabled. Error: {e}", file=sys.stderr)
         nvdaControllerClient = None
     except Exception as e:
-        print(f"An unexpected error occurred loading NVDA Controller DLL: {e}")
+        print(f"An unexpected error occurred loading NVDA Controller DLL: {e}", file=sys.stderr)
         nvdaControllerClient = None
 
 def _get_settings() -> Settings:
@@ -92,7 +92,7 @@ def speak(text: str, verbosity: str = NVDA_VERBOSITY_DEFAULT, cancel: bool = Tru
                 time.sleep(0.01)
             nvdaControllerClient.nvdaController_speakText(ctypes.c_wchar_p(text_str))
         except Exception as e:
-            print(f"Error calling nvdaController_speakText: {e}")
+            print(f"Error calling nvdaController_speakText: {e}", file=sys.stderr)
 
 # --- Initial Load Attempt ---
 # Load the DLL when this module is imported.